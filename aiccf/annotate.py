@@ -0,0 +1,176 @@
+"""Map large sets of CCF coordinates to atlas structures.
+
+Coordinates are given in the same convention that the viewer copies to the
+clipboard: x;y;z in micrometers along the CCF (posterior, inferior, right)
+axes. For each point, the Allen structure ID, acronym, and ancestor path of
+the label at that location are reported.
+
+Run from the command line::
+
+    $ python -m aiccf.annotate cells.csv -o cells_annotated.csv --resolution 25
+
+"""
+import argparse, itertools, multiprocessing
+from collections import deque
+import numpy as np
+
+from .volume import LazyVolume, gather
+from .ontology import structure_paths
+
+
+class PointAnnotator(object):
+    """Looks up the atlas structure containing each of many CCF coordinates.
+
+    All lookups are vectorized; the label volume may be an ndarray or a
+    LazyVolume (in which case only slabs containing points are read).
+    Instances can be passed to worker processes.
+    """
+    def __init__(self, atlas_data):
+        self.label = atlas_data.label_volume()
+        self.shape = self.label.shape
+        # CCF micrometers -> atlas voxel coordinates
+        self.inverse_transform = np.linalg.inv(atlas_data.ccf_transform())
+        self.inverse_transform[:3, :3] *= 1e-6
+
+        ontology = atlas_data.ontology
+        self.allen_lut = atlas_data.to_allen_ids(np.arange(2**16))
+        self.row_lut = atlas_data.structure_rows(np.arange(2**16))
+        self.acronyms = np.append(ontology['acronym'].astype(str), '')
+        self.paths = np.append(structure_paths(ontology, atlas_data.ontology_ancestors), '')
+
+    def voxel_indices(self, points):
+        """Return (index, mask) where *index* is an (N,3) array of the atlas
+        voxels nearest to the (N,3) CCF *points* (in um) and *mask* marks
+        the points that fall inside the atlas volume.
+        """
+        points = np.asarray(points, dtype=float)
+        index = np.round(np.dot(points, self.inverse_transform[:3, :3].T) + self.inverse_transform[:3, 3]).astype(int)
+        mask = np.all((index >= 0) & (index < np.array(self.shape)), axis=1)
+        return index, mask
+
+    def annotate(self, points):
+        """Return (structure_ids, acronyms, paths) for an (N,3) array of CCF
+        *points* (in um). Points outside the atlas get structure ID -1 and
+        empty acronym and path.
+        """
+        index, mask = self.voxel_indices(points)
+        stored = np.zeros(len(index), dtype=int)
+        stored[mask] = gather(self.label, index[mask])
+        structure_ids = np.where(mask, self.allen_lut[stored], -1)
+        rows = np.where(mask, self.row_lut[stored], -1)
+        return structure_ids, self.acronyms[rows], self.paths[rows]
+
+    def format_csv(self, points, delimiter=';'):
+        """Annotate *points* and return the results as CSV text, one row per
+        point: x, y, z, structure_id, acronym, path.
+        """
+        points = np.asarray(points, dtype=float)
+        structure_ids, acronyms, paths = self.annotate(points)
+        fmt = delimiter.join(['%g'] * 3 + ['%d', '%s', '%s']) + '\n'
+        return ''.join([fmt % row for row in zip(points[:, 0], points[:, 1], points[:, 2], structure_ids, acronyms, paths)])
+
+
+def read_points(filename, chunk_size=1000000, delimiter=';'):
+    """Iterate over (M,3) arrays of points read from *filename*, which may be
+    an .npy file with shape (N,3) or a delimited text file whose first
+    three columns are x, y, z (extra columns and a header line are ignored).
+    """
+    if filename.endswith('.npy'):
+        data = np.load(filename, mmap_mode='r')
+        for start in range(0, len(data), chunk_size):
+            yield np.array(data[start:start+chunk_size, :3], dtype=float)
+        return
+
+    with open(filename, 'r') as fh:
+        first = True
+        while True:
+            lines = list(itertools.islice(fh, chunk_size))
+            if len(lines) == 0:
+                break
+            if first:
+                first = False
+                try:
+                    float(lines[0].split(delimiter)[0])
+                except ValueError:
+                    lines = lines[1:]
+            rows = [line.split(delimiter)[:3] for line in lines if line.strip() != '']
+            if len(rows) > 0:
+                yield np.array(rows, dtype=float).reshape(-1, 3)
+
+
+def annotate_file(atlas_data, in_file, out_file, chunk_size=1000000, processes=None, delimiter=';'):
+    """Annotate all points in *in_file* (see read_points) and write CSV results
+    to *out_file*.
+
+    Chunks of *chunk_size* points are distributed over a pool of *processes*
+    workers (default: number of CPUs; 1 runs in this process). At most two
+    chunks per worker are in flight at any time, so memory use does not
+    depend on the size of the input.
+    """
+    annotator = PointAnnotator(atlas_data)
+    chunks = read_points(in_file, chunk_size=chunk_size, delimiter=delimiter)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    n = 0
+    with open(out_file, 'w') as out:
+        out.write(delimiter.join(['x', 'y', 'z', 'structure_id', 'acronym', 'path']) + '\n')
+        if processes <= 1:
+            _init_worker(annotator)
+            for chunk in chunks:
+                out.write(_annotate_chunk((chunk, delimiter)))
+                n += len(chunk)
+            return n
+
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(annotator,))
+        try:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_annotate_chunk, ((chunk, delimiter),)))
+                n += len(chunk)
+                if len(pending) >= 2 * processes:
+                    out.write(pending.popleft().get())
+            while len(pending) > 0:
+                out.write(pending.popleft().get())
+        finally:
+            pool.close()
+            pool.join()
+    return n
+
+
+_worker_annotator = None
+
+
+def _init_worker(annotator):
+    global _worker_annotator
+    if isinstance(annotator.label, LazyVolume):
+        annotator.label = annotator.label.reopen()
+    _worker_annotator = annotator
+
+
+def _annotate_chunk(args):
+    points, delimiter = args
+    return _worker_annotator.format_csv(points, delimiter=delimiter)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Map CCF coordinates (x;y;z in um) to atlas structures.")
+    parser.add_argument('input', help="CSV/text file (x;y;z per line) or .npy file with shape (N, 3)")
+    parser.add_argument('-o', '--output', required=True, help="CSV file to write")
+    parser.add_argument('--resolution', type=int, default=None, help="atlas resolution in um (default: highest cached)")
+    parser.add_argument('--cache-path', default=None, help="atlas cache folder")
+    parser.add_argument('--processes', type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument('--chunk-size', type=int, default=1000000, help="points per chunk")
+    parser.add_argument('--delimiter', default=';', help="column delimiter for text input and output")
+    parser.add_argument('--lazy', action='store_true', help="read label data from disk instead of loading it into memory")
+    args = parser.parse_args(argv)
+
+    from .data import CCFAtlasData
+    atlas_data = CCFAtlasData(cache_path=args.cache_path, resolution=args.resolution, lazy=args.lazy)
+    n = annotate_file(atlas_data, args.input, args.output, chunk_size=args.chunk_size,
+                      processes=args.processes, delimiter=args.delimiter)
+    print("Annotated %d points." % n)
+
+
+if __name__ == '__main__':
+    main()
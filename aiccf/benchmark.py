@@ -0,0 +1,491 @@
+"""Benchmarks for the data conversion and display hot paths.
+
+Run from the command line::
+
+    $ python -m aiccf.benchmark                    # label remapping
+    $ python -m aiccf.benchmark cache --shape 264 160 228
+    $ python -m aiccf.benchmark cache --resolution 25
+    $ python -m aiccf.benchmark suite -o results.json
+    $ python -m aiccf.benchmark suite --baseline results.json
+
+"""
+import os, sys, time, json, zlib, shutil, platform, tempfile, argparse
+from collections import OrderedDict
+import numpy as np
+from pyqtgraph import metaarray
+
+from .data import label_remap_table, remap_labels, remap_ontology, write_file
+from . import nrrdstream
+
+
+def synthetic_labels(shape, n_labels=1300, n_large=300, seed=0):
+    """Return (labels, ontology) where *labels* is a uint32 volume of blocky
+    regions drawn from *n_labels* structure IDs, *n_large* of which are
+    larger than 65535 (as in the CCF annotation volumes).
+    """
+    rng = np.random.RandomState(seed)
+    small = rng.choice(np.arange(1, 2**16 - 2*n_labels), n_labels - n_large, replace=False)
+    large = np.unique(rng.randint(2**16, 2**30, size=n_large))
+    ids = np.unique(np.concatenate([[0], small, large])).astype('uint32')
+
+    # blocky regions: assign a random ID to each 8x8x8 block
+    block = 8
+    bshape = [(s + block - 1) // block for s in shape]
+    blocks = ids[rng.randint(0, len(ids), size=bshape)]
+    labels = blocks.repeat(block, 0).repeat(block, 1).repeat(block, 2)
+    labels = np.ascontiguousarray(labels[:shape[0], :shape[1], :shape[2]])
+
+    parents = np.concatenate([[-1], ids[rng.randint(0, len(ids)-1, size=len(ids)-1)]])
+    ontology = np.empty(len(ids), dtype=[('id', 'int32'), ('parent', 'int32')])
+    ontology['id'] = ids
+    ontology['parent'] = parents
+    return labels, ontology
+
+
+def loop_remap(data, ontology, max_id=2**16-1):
+    """Reference implementation of the original per-label remapping loop in
+    read_nrrd_labels, kept for comparison.
+    """
+    data = data.copy()
+    u = np.unique(data)
+    mask = u <= max_id
+    next_id = max_id
+    inds = set(u[mask])
+    for i in u[~mask]:
+        while next_id in inds:
+            next_id -= 1
+        inds.add(next_id)
+        data[data == i] = next_id
+        ontology['id'][ontology['id'] == i] = next_id
+        ontology['parent'][ontology['parent'] == i] = next_id
+    return data.astype('uint16')
+
+
+def table_remap(data, ontology):
+    old_ids, new_ids = label_remap_table(data)
+    out = remap_labels(data, old_ids, new_ids)
+    remap_ontology(ontology, old_ids, new_ids)
+    return out
+
+
+def benchmark_remap(shapes=((132, 80, 114), (264, 160, 228)), n_large=300):
+    """Time the original remapping loop against the lookup-table remapping
+    on synthetic label volumes and check that both give the same result.
+    """
+    results = []
+    for shape in shapes:
+        labels, ontology = synthetic_labels(shape, n_large=n_large)
+
+        onto1 = ontology.copy()
+        start = time.time()
+        out1 = loop_remap(labels, onto1)
+        t_loop = time.time() - start
+
+        onto2 = ontology.copy()
+        start = time.time()
+        out2 = table_remap(labels, onto2)
+        t_table = time.time() - start
+
+        assert np.all(out1 == out2) and np.all(onto1 == onto2)
+        results.append({'shape': shape, 'loop': t_loop, 'table': t_table})
+        print("remap %-16s  loop: %8.3f s   table: %8.3f s   speedup: %6.1fx" % (
+            'x'.join(map(str, shape)), t_loop, t_table, t_loop / t_table))
+    return results
+
+
+# (name, write_file options) for benchmark_cache
+CACHE_CONFIGS = [
+    ('contiguous', {'chunks': None}),
+    ('cube', {'chunks': 'cube'}),
+    ('cube-lzf', {'chunks': 'cube', 'compression': 'lzf'}),
+    ('cube-gzip1', {'chunks': 'cube', 'compression': 1}),
+    ('anterior', {'chunks': 'anterior'}),
+    ('anterior-lzf', {'chunks': 'anterior', 'compression': 'lzf'}),
+    ('anterior-gzip1', {'chunks': 'anterior', 'compression': 1}),
+]
+
+
+def synthetic_atlas(shape, seed=0):
+    """Return (image, label) MetaArrays with the axes and dtypes of the atlas
+    cache files. Labels are blocky regions (see synthetic_labels); the image
+    has a different mean intensity in each region plus noise.
+    """
+    labels, ontology = synthetic_labels(shape, seed=seed)
+    labels = table_remap(labels, ontology)
+    rng = np.random.RandomState(seed)
+    image = (rng.randint(0, 200, size=2**16)[labels] + rng.randint(0, 50, size=shape)).astype('ubyte')
+    vxsize = 25e-6
+    info = [
+        {'name': 'anterior', 'values': np.arange(shape[0]) * vxsize, 'units': 'm'},
+        {'name': 'dorsal', 'values': np.arange(shape[1]) * vxsize, 'units': 'm'},
+        {'name': 'right', 'values': np.arange(shape[2]) * vxsize, 'units': 'm'},
+        {'vxsize': vxsize}
+    ]
+    return metaarray.MetaArray(image, info=info), metaarray.MetaArray(labels, info=info)
+
+
+def drop_file_cache(filename):
+    """Ask the OS to evict *filename* from the page cache so that the next
+    read comes from disk. Returns False where this is not supported, in which
+    case "cold" timings are really warm.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+def plane_latency(filename, axis, n_planes=10, seed=0):
+    """Return the median time (s) to read one plane perpendicular to *axis*
+    from the MetaArray file *filename*, starting from a cold page cache.
+    """
+    ma = metaarray.MetaArray(file=filename, readAllData=False)
+    try:
+        data = ma._data
+        rng = np.random.RandomState(seed)
+        times = []
+        for i in rng.randint(0, data.shape[axis], size=n_planes):
+            index = [slice(None)] * data.ndim
+            index[axis] = int(i)
+            start = time.time()
+            data[tuple(index)]
+            times.append(time.time() - start)
+    finally:
+        ma._data.file.close()
+    return np.median(times)
+
+
+def benchmark_cache(image, label, configs=None, n_planes=10, tmpdir=None):
+    """Write the *image* and *label* MetaArrays with each of *configs* (a list
+    of (name, write_file options); default CACHE_CONFIGS) and report file
+    size, cold load time, and median per-plane read latency along each axis.
+    """
+    configs = CACHE_CONFIGS if configs is None else configs
+    tmpdir = tempfile.mkdtemp() if tmpdir is None else tmpdir
+    results = []
+    print("%-6s %-16s %10s %8s %10s %10s %10s %10s" % (
+        'volume', 'config', 'size (MB)', 'write s', 'cold load', 'plane 0', 'plane 1', 'plane 2'))
+    try:
+        for vol_name, data in (('image', image), ('label', label)):
+            for name, opts in configs:
+                filename = os.path.join(tmpdir, '%s_%s.ma' % (vol_name, name))
+                start = time.time()
+                write_file(data, filename, **opts)
+                t_write = time.time() - start
+
+                drop_file_cache(filename)
+                start = time.time()
+                metaarray.MetaArray(file=filename)
+                t_load = time.time() - start
+
+                planes = []
+                for axis in range(3):
+                    drop_file_cache(filename)
+                    planes.append(plane_latency(filename, axis, n_planes))
+
+                result = {'volume': vol_name, 'config': name, 'options': opts, 'bytes': os.path.getsize(filename),
+                          'write': t_write, 'load': t_load, 'plane': planes}
+                results.append(result)
+                print("%-6s %-16s %10.1f %8.2f %10.3f %8.1f ms %7.1f ms %7.1f ms" % (
+                    vol_name, name, result['bytes'] / 1e6, t_write, t_load,
+                    planes[0] * 1e3, planes[1] * 1e3, planes[2] * 1e3))
+                os.remove(filename)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+# atlas volume shapes (anterior, dorsal, right) at each CCF resolution (um)
+ATLAS_SHAPES = OrderedDict([
+    (100, (132, 80, 114)),
+    (50, (264, 160, 228)),
+    (25, (528, 320, 456)),
+    (10, (1320, 800, 1140)),
+])
+
+
+def synthetic_ontology(n_structures=1300, n_large=300, seed=0):
+    """Return a flat ontology table (as returned by read_ontology) for a
+    random tree of *n_structures* structures, *n_large* of which have IDs
+    larger than 65535 (as in the CCF ontology). The first row is the root.
+    """
+    rng = np.random.RandomState(seed)
+    small = rng.choice(np.arange(1, 2**16 - 2*n_structures), n_structures - n_large, replace=False)
+    large = 2**16 + rng.choice(2**20, n_large, replace=False)
+    ids = np.concatenate([small, large])
+    rng.shuffle(ids)
+
+    # random recursive tree: each structure is attached to an earlier one
+    parents = np.concatenate([[-1], ids[[rng.randint(0, i) for i in range(1, n_structures)]]])
+    ontology = np.empty(n_structures, dtype=[('id', 'int32'), ('parent', 'int32'), ('name', 'S16'),
+                                             ('acronym', 'S8'), ('color', 'S6')])
+    ontology['id'] = ids
+    ontology['parent'] = parents
+    ontology['name'] = ['Structure %d' % i for i in range(n_structures)]
+    ontology['acronym'] = ['S%d' % i for i in range(n_structures)]
+    ontology['color'] = ['%06x' % c for c in rng.randint(0, 2**24, size=n_structures)]
+    return ontology
+
+
+def write_ontology_json(ontology, filename):
+    """Write a flat *ontology* table as a nested structure graph in the format
+    served by the Allen API (see read_ontology).
+    """
+    nodes = OrderedDict()
+    for row in ontology:
+        nodes[int(row['id'])] = {'id': int(row['id']), 'name': row['name'].decode('ascii'),
+                                 'acronym': row['acronym'].decode('ascii'),
+                                 'color_hex_triplet': row['color'].decode('ascii'), 'children': []}
+    for row in ontology[1:]:
+        nodes[int(row['parent'])]['children'].append(nodes[int(row['id'])])
+    with open(filename, 'w') as fh:
+        json.dump({'success': True, 'msg': [nodes[int(ontology['id'][0])]]}, fh)
+
+
+def write_synthetic_atlas(path, resolution, ontology, block=8, max_voxels=2**24, seed=0):
+    """Write synthetic template and annotation NRRD files (gzip-encoded, as
+    distributed by the Allen Institute) and an ontology JSON file for the
+    atlas shape at *resolution* (see ATLAS_SHAPES) into *path*.
+
+    Labels are blocks of *block* voxels drawn from the structures in
+    *ontology*, inside an ellipsoid of background 0. The template has a
+    different mean intensity in each structure plus noise. Volumes are
+    generated in slabs of at most *max_voxels*, so any resolution can be
+    written without holding it in memory.
+
+    Returns the (image, label, ontology) file names.
+    """
+    shape = ATLAS_SHAPES[resolution]
+    if not os.path.exists(path):
+        os.makedirs(path)
+    files = [os.path.join(path, name) for name in ('average_template_%d.nrrd' % resolution,
+                                                    'annotation_%d.nrrd' % resolution, 'ontology.json')]
+    write_ontology_json(ontology, files[2])
+
+    rng = np.random.RandomState(seed)
+    ids = ontology['id'][1:].astype('uint32')
+    blocks = rng.randint(0, len(ids), size=[(s + block - 1) // block for s in shape])
+    intensity = rng.randint(100, 400, size=len(ids))
+    x, y = [(np.arange(n) + 0.5) / n * 2 - 1 for n in shape[:2]]
+    r2 = x[:, None, None]**2 + y[None, :, None]**2
+    bx, by = [(np.arange(n) // block)[:, None, None] for n in shape[:2]]
+    by = by.transpose(1, 0, 2)
+
+    step = max(1, max_voxels // (shape[0] * shape[1]))
+    header = ("NRRD0004\ntype: {type}\ndimension: 3\nspace: left-posterior-superior\n"
+              "sizes: {0} {1} {2}\nspace directions: ({r},0,0) (0,{r},0) (0,0,{r})\n"
+              "kinds: domain domain domain\nendian: little\nencoding: gzip\nspace origin: (0,0,0)\n\n")
+    fhs = [open(filename, 'wb') for filename in files[:2]]
+    try:
+        comps = []
+        for fh, nrrd_type in zip(fhs, ('unsigned short', 'unsigned int')):
+            fh.write(header.format(*shape, type=nrrd_type, r=resolution).encode('ascii'))
+            comps.append(zlib.compressobj(1, zlib.DEFLATED, zlib.MAX_WBITS | 16))
+        for start in range(0, shape[2], step):
+            z = np.arange(start, min(start + step, shape[2]))
+            inside = r2 + (((z + 0.5) / shape[2] * 2 - 1)**2)[None, None, :] < 0.9
+            index = blocks[bx, by, (z // block)[None, None, :]]
+            label = np.where(inside, ids[index], 0).astype('uint32')
+            image = (np.where(inside, intensity[index], 20) + rng.randint(0, 60, size=label.shape)).astype('uint16')
+            for fh, comp, data in zip(fhs, comps, (image, label)):
+                # NRRD data is stored with the first axis varying fastest
+                fh.write(comp.compress(np.ascontiguousarray(data.transpose(2, 1, 0)).tobytes()))
+        for fh, comp in zip(fhs, comps):
+            fh.write(comp.flush())
+    finally:
+        for fh in fhs:
+            fh.close()
+    return files
+
+
+def _median_time(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return float(np.median(times))
+
+
+def benchmark_suite(resolutions=(100, 50, 25), repeat=5, workdir=None, hover_events=1000, seed=0):
+    """Time each stage of the data pipeline and viewer hot paths on synthetic
+    atlases at each of *resolutions* (um; see ATLAS_SHAPES):
+
+    =====================  =======================================================
+    convert_image          NRRD template -> image cache (convert_nrrd_atlas)
+    convert_labels         NRRD annotation -> label cache (convert_nrrd_labels)
+    remap_labels           Label remapping of one 2**24-voxel slab
+    load_cache             CCFAtlasData construction from the cache
+    update_image_data      AtlasSliceView.update_image_data at Downsample 1
+    update_image_data_ds2  update_image_data at Downsample 2 (no pyramid level)
+    ortho_plane            AtlasSliceView.update_ortho_image
+    ortho_slice            RulerROI.getArrayRegion, no rotation
+    oblique_slice          RulerROI.getArrayRegion, rotated 20 degrees
+    lookup_table_all       Check/uncheck the whole ontology and render labels
+    lookup_table_one       Recolor one structure and render labels
+    hover                  Label lookup and description per hover event
+    =====================  =======================================================
+
+    Conversion stages run once; all others report the median of *repeat*
+    runs. Qt runs on the offscreen platform unless QT_QPA_PLATFORM is set.
+
+    Returns a JSON-serializable dict {'meta': {...}, 'results': {'<res>um':
+    {stage: seconds}}}.
+    """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    import pyqtgraph as pg
+    from .data import CCFAtlasData, convert_nrrd_atlas, convert_nrrd_labels
+    from .ui import AtlasSliceView
+    app = pg.mkQApp()
+
+    workdir_created = workdir is None
+    workdir = tempfile.mkdtemp() if workdir is None else workdir
+    ontology = synthetic_ontology(seed=seed)
+    output = {
+        'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'repeat': repeat,
+                 'shapes': dict(('%dum' % res, ATLAS_SHAPES[res]) for res in resolutions)},
+        'results': OrderedDict(),
+    }
+    try:
+        for res in resolutions:
+            path = os.path.join(workdir, '%dum' % res)
+            t = OrderedDict()
+            output['results']['%dum' % res] = t
+            image_file, label_file, onto_file = write_synthetic_atlas(path, res, ontology, seed=seed)
+
+            start = time.time()
+            convert_nrrd_atlas(image_file, os.path.join(path, 'image.ma'))
+            t['convert_image'] = time.time() - start
+            start = time.time()
+            convert_nrrd_labels(label_file, onto_file, os.path.join(path, 'label.ma'))
+            t['convert_labels'] = time.time() - start
+
+            labels = next(nrrdstream.iter_slabs(label_file, max_bytes=2**26))[1].copy()
+            t['remap_labels'] = _median_time(lambda: remap_labels(labels, *label_remap_table(labels)), repeat)
+
+            t['load_cache'] = _median_time(lambda: CCFAtlasData(cache_path=workdir, resolution=res), repeat)
+            atlas_data = CCFAtlasData(cache_path=workdir, resolution=res)
+
+            view = AtlasSliceView()
+            view.background_slicing = False
+            view.set_data(atlas_data)
+            params = view.display_ctrl.params
+            t['update_image_data'] = _median_time(view.update_image_data, repeat)
+            params['Downsample'] = 2
+            t['update_image_data_ds2'] = _median_time(view.update_image_data, repeat)
+            params['Downsample'] = 1
+            t['ortho_plane'] = _median_time(view.update_ortho_image, repeat)
+
+            roi, img = view.line_roi, view.img1.atlas_img
+            t['ortho_slice'] = _median_time(lambda: roi.getArrayRegion(view.display_atlas, img, axes=(1, 2)), repeat)
+            t['oblique_slice'] = _median_time(lambda: roi.getArrayRegion(view.display_atlas, img, axes=(1, 2, 0),
+                                                                       rotation=20), repeat)
+
+            tree = view.label_tree
+            root = tree.ontology['id'][0]
+            leaf = tree.ontology['id'][np.argmax(tree.ontology['depth'])]
+            state = [False]
+            def toggle_all():
+                state[0] = not state[0]
+                tree.set_label_checked(root, state[0])
+                view.img1.label_img.render()
+            def recolor_one():
+                state[0] = not state[0]
+                tree.set_label_color(leaf, (255, 0, 0) if state[0] else (0, 0, 255), recursive=False)
+                view.img1.label_img.render()
+            t['lookup_table_all'] = _median_time(toggle_all, repeat)
+            tree.set_label_checked(root, True)
+            t['lookup_table_one'] = _median_time(recolor_one, repeat)
+
+            label = view.img1.label_data
+            rng = np.random.RandomState(seed)
+            points = list(zip(rng.randint(0, label.shape[0], hover_events), rng.randint(0, label.shape[1], hover_events)))
+            def hover():
+                for x, y in points:
+                    tree.describe(label[x, y])
+            t['hover'] = _median_time(hover, repeat) / hover_events
+
+            view.close()
+            for stage, dt in t.items():
+                print("%-6s %-24s %12.6f s" % ('%dum' % res, stage, dt))
+    finally:
+        if workdir_created:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return output
+
+
+def compare_results(results, baseline, threshold=1.2):
+    """Print each stage time in *results* next to the same stage in
+    *baseline* (both as returned by benchmark_suite). Return a list of
+    (resolution, stage, ratio) for stages that are slower than the baseline
+    by more than a factor of *threshold*.
+    """
+    regressions = []
+    print("%-6s %-24s %12s %12s %8s" % ('res', 'stage', 'baseline', 'current', 'ratio'))
+    for res, stages in results['results'].items():
+        base = baseline['results'].get(res, {})
+        for stage, dt in stages.items():
+            if stage not in base:
+                print("%-6s %-24s %12s %12.6f %8s" % (res, stage, '-', dt, '-'))
+                continue
+            ratio = dt / max(base[stage], 1e-9)
+            flag = ''
+            if ratio > threshold:
+                regressions.append((res, stage, ratio))
+                flag = '  SLOWER'
+            print("%-6s %-24s %12.6f %12.6f %7.2fx%s" % (res, stage, base[stage], dt, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(description="Benchmark atlas data conversion and storage.")
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('remap', help="label remapping (default)")
+    cache = sub.add_parser('cache', help="cache file chunking and compression")
+    cache.add_argument('--shape', type=int, nargs=3, default=(264, 160, 228), help="synthetic atlas shape")
+    cache.add_argument('--resolution', type=int, default=None, help="use the cached atlas at this resolution (um) instead")
+    cache.add_argument('--cache-path', default=None, help="atlas cache folder")
+    cache.add_argument('--planes', type=int, default=10, help="planes read per axis")
+    cache.add_argument('--tmpdir', default=None, help="folder for the test files")
+    suite = sub.add_parser('suite', help="all pipeline and viewer stages on synthetic atlases")
+    suite.add_argument('--resolutions', type=int, nargs='+', default=[100, 50, 25], choices=list(ATLAS_SHAPES),
+                       help="atlas resolutions (um) to simulate")
+    suite.add_argument('--repeat', type=int, default=5, help="runs per stage (the median is reported)")
+    suite.add_argument('--workdir', default=None, help="folder for the synthetic files (kept if given)")
+    suite.add_argument('-o', '--output', default=None, help="write results to this JSON file")
+    suite.add_argument('--baseline', default=None, help="compare against results in this JSON file")
+    suite.add_argument('--threshold', type=float, default=1.2,
+                       help="slowdown factor reported as a regression (exit status 1)")
+    args = parser.parse_args(argv if len(argv) > 0 else ['remap'])
+
+    if args.command == 'remap':
+        benchmark_remap()
+    elif args.command == 'cache':
+        if args.resolution is None:
+            image, label = synthetic_atlas(tuple(args.shape))
+        else:
+            from .data import CCFAtlasData
+            atlas_data = CCFAtlasData(cache_path=args.cache_path, resolution=args.resolution)
+            image, label = atlas_data.image, atlas_data.label
+        benchmark_cache(image, label, n_planes=args.planes, tmpdir=args.tmpdir)
+    elif args.command == 'suite':
+        results = benchmark_suite(args.resolutions, repeat=args.repeat, workdir=args.workdir)
+        if args.output is not None:
+            with open(args.output, 'w') as fh:
+                json.dump(results, fh, indent=2)
+        if args.baseline is not None:
+            with open(args.baseline, 'r') as fh:
+                baseline = json.load(fh)
+            if len(compare_results(results, baseline, args.threshold)) > 0:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
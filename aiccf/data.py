@@ -4,9 +4,21 @@ import numpy as np
 import pyqtgraph as pg
 from pyqtgraph import metaarray
 from pyqtgraph.Qt import QtGui, QtCore
-from .ui import AtlasResolutionDialog, download
+from .volume import LazyVolume, contiguous_copy
+from . import nrrdstream
+from .ontology import index_ontology, is_descendant, descendant_rows, row_lookup_table
+from .stats import structure_statistics
+from .mesh import extract_meshes, mesh_file, read_meshes, write_meshes
+from .projection import ProjectionCache, build_projections
 
 
+# Axis names of the (displayed plane, row, column) axes for each viewer orientation
+ORIENTATIONS = OrderedDict([
+    ('right', ('right', 'anterior', 'dorsal')),
+    ('anterior', ('anterior', 'right', 'dorsal')),
+    ('dorsal', ('dorsal', 'right', 'anterior')),
+])
+
 class CCFAtlasData(object):
     """Wrapper around CCF average image, annotation, and ontology to manage
     downloading, reformatting, and caching.
@@ -16,11 +28,38 @@ class CCFAtlasData(object):
     label_url = "http://download.alleninstitute.org/informatics-archive/current-release/mouse_ccf/annotation/ccf_2016/annotation_{resolution}.nrrd"
     ontology_url = "http://api.brain-map.org/api/v2/structure_graph_download/1.json"
     
-    def __init__(self, cache_path=None, resolution=None):
+    def __init__(self, cache_path=None, resolution=None, lazy=False):
         self.image = None
         self.label = None
         self.ontology = None
+        self.lazy = lazy
         self.available_resolutions = [10, 25, 50, 100]
+        self.pyramid_levels = [2, 4, 8]
+        # approximate memory limit (bytes) when converting downloaded files
+        self.conversion_budget = 1e9
+        # write_file options for image and label cache files (see chunk_shape)
+        self.cache_options = {
+            'image': {'chunks': 'auto', 'compression': None},
+            'label': {'chunks': 'auto', 'compression': None},
+        }
+        self._pyramid = {}
+        self._structure_stats = None
+        self._projections = None
+
+        # memoized structure masks (see structure_mask), limited to mask_budget bytes
+        self.mask_budget = 5e8
+        self._masks = OrderedDict()
+        self._bounds = {}
+
+        # levels of detail and smoothing of structure meshes (see structure_meshes)
+        self.mesh_levels = [1, 2, 4, 8]
+        self.mesh_smooth = 1.0
+        self._meshes = {}
+
+        # How volumes are laid out for each orientation (see set_layout_mode)
+        self.layout_modes = {}
+        self.layout_budget = 2e9
+        self._layouts = OrderedDict()
         
         # Decide on a default cache path
         if cache_path is None:
@@ -49,6 +88,7 @@ class CCFAtlasData(object):
         elif resolution not in self.cached_resolutions:
             resolution = self.download_and_cache(resolution)
             
+        self.resolution = resolution
         self._image_cache_file, self._label_cache_file = self.cached_resolutions[resolution]
         self.load_image_cache()
         self.load_label_cache()
@@ -57,6 +97,7 @@ class CCFAtlasData(object):
         """Download atlas data, convert to intermediate format, and store in cache
         folder.
         """
+        from .ui import AtlasResolutionDialog, download_all
         if resolution is None:
             dlg = AtlasResolutionDialog(self.available_resolutions, self.cached_resolutions.keys())
             dlg.exec_()
@@ -68,33 +109,42 @@ class CCFAtlasData(object):
         if not os.path.exists(cache_path):
             os.makedirs(cache_path)
         
-        with pg.ProgressDialog("Preparing %dum CCF data" % resolution, maximum=6, nested=True) as dlg: 
+        with pg.ProgressDialog("Preparing %dum CCF data" % resolution, maximum=4, nested=True) as dlg: 
             image_url = self.image_url.format(resolution=resolution)
             image_file = os.path.join(cache_path, image_url.split('/')[-1])
             image_cache = os.path.join(cache_path, "image.ma")
-            if not os.path.exists(image_file):
-                download(image_url, image_file)
-            dlg += 1
             
             label_url = self.label_url.format(resolution=resolution)
             label_file = os.path.join(cache_path, label_url.split('/')[-1])
             label_cache = os.path.join(cache_path, "label.ma")
-            if not os.path.exists(label_file):
-                download(label_url, label_file)
-            dlg += 1
             
             onto_file = os.path.join(cache_path, 'ontology.json')
-            if not os.path.exists(onto_file):
-                download(self.ontology_url, onto_file)
-            
-            self.load_image_data(image_file)
-            dlg += 1
-            write_file(self.image, image_cache)
+
+            # fetch whatever is missing concurrently; files are only moved into
+            # place once complete and verified, and interrupted downloads resume
+            jobs = [{'url': url, 'dest': filename} for url, filename in
+                    [(image_url, image_file), (label_url, label_file), (self.ontology_url, onto_file)]
+                    if not os.path.exists(filename)]
+            if len(jobs) > 0:
+                download_all(jobs)
             dlg += 1
             
-            self.load_label_data(label_file, onto_file)
+            # convert slab by slab so that memory use stays within conversion_budget
+            with pg.ProgressDialog("Converting atlas image...", 0, 1000, wait=0, nested=True) as dlg2:
+                convert_nrrd_atlas(image_file, image_cache, memory_budget=self.conversion_budget,
+                                   progress=conversion_progress(dlg2), **self.cache_options['image'])
             dlg += 1
-            write_file(self.label, label_cache)
+
+            with pg.ProgressDialog("Converting atlas labels...", 0, 1000, wait=0, nested=True) as dlg2:
+                convert_nrrd_labels(label_file, onto_file, label_cache, memory_budget=self.conversion_budget,
+                                    progress=conversion_progress(dlg2), **self.cache_options['label'])
+            dlg += 1
+
+            # build downsampled levels from the cache files without loading them
+            image = metaarray.MetaArray(file=image_cache, readAllData=False)
+            label = metaarray.MetaArray(file=label_cache, readAllData=False)
+            write_pyramid(image, label, cache_path, self.pyramid_levels,
+                          self.cache_options['image'], self.cache_options['label'])
             dlg += 1
 
         self.cached_resolutions[resolution] = (image_cache, label_cache)
@@ -103,6 +153,36 @@ class CCFAtlasData(object):
     def cache_path(self, resolution):
         return os.path.join(self._cache_path, '%dum'%resolution)
 
+    def build_pyramid(self, levels=None):
+        """Write downsampled image/label levels for the currently loaded
+        resolution into its cache folder (this is done automatically when
+        a resolution is first downloaded).
+        """
+        if levels is None:
+            levels = self.pyramid_levels
+        write_pyramid(self.image, self.label, self.cache_path(self.resolution), levels,
+                      self.cache_options['image'], self.cache_options['label'])
+        self._pyramid = {}
+
+    def downsample_levels(self):
+        """Return the sorted list of downsampling factors that are available
+        without recomputing (always includes 1).
+        """
+        levels = [1]
+        for ds in self.pyramid_levels:
+            image_file, label_file = pyramid_files(self.cache_path(self.resolution), ds)
+            if os.path.isfile(image_file) and os.path.isfile(label_file):
+                levels.append(ds)
+        return levels
+
+    def _pyramid_level(self, ds):
+        if ds not in self._pyramid:
+            image_file, label_file = pyramid_files(self.cache_path(self.resolution), ds)
+            image = metaarray.MetaArray(file=image_file, readAllData=not self.lazy)
+            label = metaarray.MetaArray(file=label_file, readAllData=not self.lazy)
+            self._pyramid[ds] = (image, label)
+        return self._pyramid[ds]
+
     @property
     def shape(self):
         return self.image.shape
@@ -113,31 +193,559 @@ class CCFAtlasData(object):
     def load_label_data(self, label_file, ontology_file):
         self.label = read_nrrd_labels(label_file, ontology_file)
         self.ontology = self.label._info[-1]['ontology']
+        self._load_id_maps()
+        self._load_hierarchy()
         
     def load_image_cache(self):
         """Load a MetaArray-format atlas image file.
+
+        In lazy mode the file is left open and image data is only read from
+        disk as it is requested.
         """
         filename = self._image_cache_file
-        self.image = metaarray.MetaArray(file=filename, readAllData=True)
+        self.image = metaarray.MetaArray(file=filename, readAllData=not self.lazy)
         
     def load_label_cache(self):
         """Load a MetaArray-format atlas label file.
+
+        In lazy mode the file is left open and label data is only read from
+        disk as it is requested.
         """
         filename = self._label_cache_file
-        self.label = metaarray.MetaArray(file=filename, readAllData=True)
+        self.label = metaarray.MetaArray(file=filename, readAllData=not self.lazy)
         self.ontology = self.label._info[-1]['ontology']
+        self._load_id_maps()
+        self._load_hierarchy()
+
+    def read_volumes(self):
+        """Read the image and label cache files into memory and return them
+        as (image, label) MetaArrays. Nothing else is changed, so this may be
+        called from a background thread; see load_volumes().
+        """
+        image = metaarray.MetaArray(file=self._image_cache_file)
+        label = metaarray.MetaArray(file=self._label_cache_file)
+        return image, label
+
+    def load_volumes(self, volumes=None):
+        """Replace lazily opened image and label volumes with copies held in
+        memory, and leave lazy mode. *volumes* is the result of read_volumes()
+        if that was already called (for example, in a background thread).
+
+        Volumes that were already returned by image_volume() etc. remain
+        usable.
+        """
+        if not self.lazy:
+            return
+        self.image, self.label = self.read_volumes() if volumes is None else volumes
+        self.lazy = False
+        # reopen pyramid levels and disk layouts in memory when next used
+        self._pyramid = {}
+        for key in [k for k, v in self._layouts.items() if v[2] == 0]:
+            del self._layouts[key]
+
+    def _load_id_maps(self):
+        info = self.label._info[-1]
+        if 'ai_id_lut' in info:
+            self._allen_lut = info['ai_id_lut']
+        else:
+            # caches written before the lookup table was stored
+            self._allen_lut = id_lookup_table(info['ai_ontology_map'])
+        mapping = np.asarray(info['ai_ontology_map'])
+        order = np.argsort(mapping[:, 0])
+        self._allen_ids = mapping[order, 0]
+        self._stored_ids = mapping[order, 1]
+
+    def _load_hierarchy(self):
+        info = self.label._info[-1]
+        if 'pre' in self.ontology.dtype.names and 'ontology_ancestors' in info:
+            self.ontology_ancestors = np.asarray(info['ontology_ancestors'])
+        else:
+            # caches written before the hierarchy index was stored
+            self.ontology, self.ontology_ancestors = index_ontology(self.ontology)
+        self._row_lut = row_lookup_table(self.ontology)
+
+    def structure_rows(self, ids):
+        """Return the ontology row indices of the structures with the given
+        (stored) label values, or -1 for values not in the ontology.
+        """
+        return self._row_lut[np.asarray(ids)]
+
+    def _structure_row(self, id):
+        row = self._row_lut[id]
+        if row < 0:
+            raise KeyError("Unknown structure ID: %d" % id)
+        return row
+
+    def descendants(self, id, include_self=True):
+        """Return an array of the (stored) IDs of all structures below
+        structure *id* in the ontology.
+        """
+        rows = descendant_rows(self.ontology, self._structure_row(id), include_self)
+        return self.ontology['id'][rows]
+
+    def is_descendant(self, ids, ancestor, include_self=True):
+        """Return a boolean array that is True where the stored label values
+        *ids* (any shape) belong to structure *ancestor* or one of its
+        descendants.
+        """
+        rows = self.structure_rows(ids)
+        mask = is_descendant(self.ontology, rows, self._structure_row(ancestor), include_self)
+        return mask & (rows >= 0)
+
+    def ancestors(self, id, include_self=True):
+        """Return an array of the (stored) IDs of the ancestors of structure
+        *id*, from the root of the ontology down.
+        """
+        row = self._structure_row(id)
+        depth = self.ontology['depth'][row]
+        rows = self.ontology_ancestors[row, :depth + (1 if include_self else 0)]
+        return self.ontology['id'][rows]
+
+    def structure_id(self, acronym):
+        """Return the (stored) ID of the structure with the given *acronym*.
+        """
+        if isinstance(acronym, bytes) and not isinstance(acronym, str):
+            acronym = acronym.decode('ascii')
+        # unicode acronyms (python 2) are compared as str
+        rows = np.argwhere(self.ontology['acronym'].astype(str) == str(acronym))[:, 0]
+        if len(rows) == 0:
+            raise KeyError("Unknown structure acronym: %s" % acronym)
+        return self.ontology['id'][rows[0]]
+
+    def structure_mask(self, structure, include_descendants=True, crop=False):
+        """Return a boolean mask of the voxels of the label volume that belong
+        to *structure* (a stored ID or an acronym) and, if
+        *include_descendants* is True, to any structure below it.
+
+        If *crop* is True, the mask only covers the bounding box of the
+        structure: it equals ``structure_mask(structure)[bounds]`` where
+        *bounds* is returned by structure_bounds().
+
+        Masks are computed with a single lookup-table pass over the label
+        volume (restricted to the bounding box when it is known from
+        structure_stats) and memoized, up to *mask_budget* bytes in total;
+        the least recently used masks are discarded first. Returned masks
+        are read-only.
+        """
+        id = self._mask_structure_id(structure)
+        key = ('mask', id, include_descendants, crop)
+        mask = self._cached_mask(key)
+        if mask is not None:
+            return mask
+
+        bounds, full = self._structure_bounds(id, include_descendants)
+        if full is None:
+            full = self._cached_mask(('mask', id, include_descendants, False))
+        if crop:
+            if bounds is None:
+                mask = np.zeros((0, 0, 0), dtype=bool)
+            elif full is not None:
+                mask = full[bounds].copy()
+            else:
+                mask = self._lut_mask(id, include_descendants, bounds)
+        elif full is not None:
+            mask = full
+        else:
+            mask = np.zeros(self.label.shape, dtype=bool)
+            if bounds is not None:
+                mask[bounds] = self._lut_mask(id, include_descendants, bounds)
+        self._cache_mask(key, mask)
+        return mask
+
+    def structure_bounds(self, structure, include_descendants=True):
+        """Return the bounding box of *structure* (see structure_mask) in the
+        label volume as a tuple of slices, or None if it has no voxels.
+        """
+        return self._structure_bounds(self._mask_structure_id(structure), include_descendants)[0]
+
+    def _structure_bounds(self, id, include_descendants):
+        # Return (bounds, mask): when the bounds are not known, they are found
+        # with a full lookup-table pass, whose mask is returned as well
+        # (otherwise None) so that callers don't repeat the pass.
+        key = (id, include_descendants)
+        if key in self._bounds:
+            return self._bounds[key], None
+        stats = self.structure_stats(compute=False)
+        mask = None
+        if stats is not None and include_descendants:
+            row = self._structure_row(id)
+            lo = [int(stats[row, 'min_%d' % ax]) for ax in range(3)]
+            hi = [int(stats[row, 'max_%d' % ax]) for ax in range(3)]
+            bounds = None if lo[0] < 0 else tuple(slice(a, b + 1) for a, b in zip(lo, hi))
+        else:
+            mask = self._lut_mask(id, include_descendants)
+            bounds = mask_bounds(mask)
+            # the full mask is likely to be requested next
+            self._cache_mask(('mask', id, include_descendants, False), mask)
+        self._bounds[key] = bounds
+        return bounds, mask
+
+    def structure_voxels(self, structure, include_descendants=True):
+        """Return an (N, 3) array of the indices of all voxels in *structure*
+        (see structure_mask). The result is memoized like masks.
+        """
+        id = self._mask_structure_id(structure)
+        key = ('voxels', id, include_descendants)
+        voxels = self._cached_mask(key)
+        if voxels is None:
+            bounds = self.structure_bounds(id, include_descendants)
+            if bounds is None:
+                voxels = np.zeros((0, 3), dtype=int)
+            else:
+                mask = self.structure_mask(id, include_descendants, crop=True)
+                voxels = np.argwhere(mask) + np.array([b.start for b in bounds])
+            self._cache_mask(key, voxels)
+        return voxels
+
+    def structure_meshes(self, structures, compute=True, processes=None, progress=None):
+        """Return the surface meshes of *structures* (stored IDs or acronyms),
+        each including all of its descendants, as a dict
+        {id: {level: (vertexes, faces)}} with one entry per level in
+        *mesh_levels* (see aiccf.mesh). Vertexes are voxel indices into the
+        label volume.
+
+        Meshes are cached on disk beside the label cache. Missing or out of
+        date meshes (including meshes extracted with a different
+        *mesh_smooth*) are extracted from the structures' bounding boxes in
+        parallel (*processes* and *progress* are passed to extract_meshes)
+        and saved, unless *compute* is False, in which case they are omitted
+        from the result.
+        """
+        cache_path = self.cache_path(self.resolution)
+        meshes = {}
+        missing = []
+        for structure in structures:
+            id = self._mask_structure_id(structure)
+            key = (id, self.mesh_smooth)
+            if key not in self._meshes:
+                filename = mesh_file(cache_path, id)
+                if os.path.isfile(filename) and os.path.getmtime(filename) >= os.path.getmtime(self._label_cache_file):
+                    stored, smooth = read_meshes(filename)
+                    if smooth == self.mesh_smooth and set(self.mesh_levels) <= set(stored):
+                        self._meshes[key] = stored
+            if key in self._meshes:
+                meshes[id] = self._meshes[key]
+            elif id not in missing:
+                missing.append(id)
+        if len(missing) == 0 or not compute:
+            return meshes
+
+        # bounding boxes of all structures come from a single statistics pass
+        self.structure_stats()
+        tasks = [(id, self.descendants(id), self.structure_bounds(id)) for id in missing]
+        extracted = extract_meshes(self.label_volume(), tasks, levels=self.mesh_levels, smooth=self.mesh_smooth,
+                                   processes=processes, progress=progress)
+        for id, stored in extracted.items():
+            write_meshes(mesh_file(cache_path, id), stored, smooth=self.mesh_smooth)
+            self._meshes[(id, self.mesh_smooth)] = meshes[id] = stored
+        return meshes
+
+    def structure_mesh(self, structure, level=1):
+        """Return the (vertexes, faces) surface mesh of a single structure at
+        the given level of detail (see structure_meshes).
+        """
+        id = self._mask_structure_id(structure)
+        return self.structure_meshes([id])[id][level]
+
+    def _mask_structure_id(self, structure):
+        if isinstance(structure, (str, bytes, type(u''))):
+            return self.structure_id(structure)
+        self._structure_row(structure)  # raises KeyError for unknown IDs
+        return int(structure)
+
+    def _lut_mask(self, id, include_descendants, bounds=None):
+        # Single lookup-table pass over the label volume (or the region *bounds*)
+        lut = np.zeros(2**16, dtype=bool)
+        lut[self.descendants(id) if include_descendants else id] = True
+        label = self.label_volume()
+        return lut[np.asarray(label if bounds is None else label[bounds])]
+
+    def _cached_mask(self, key):
+        mask = self._masks.pop(key, None)
+        if mask is not None:
+            # move to end of LRU order
+            self._masks[key] = mask
+        return mask
+
+    def _cache_mask(self, key, mask):
+        # Store *mask* in the memo, evicting least recently used masks to stay
+        # within mask_budget. Masks larger than the budget are not stored.
+        mask.setflags(write=False)
+        self._masks.pop(key, None)
+        if mask.nbytes > self.mask_budget:
+            return
+        while sum(m.nbytes for m in self._masks.values()) + mask.nbytes > self.mask_budget:
+            self._masks.popitem(last=False)
+        self._masks[key] = mask
+
+    def structure_stats(self, compute=True, progress=None):
+        """Return per-structure statistics as a MetaArray with one row per
+        ontology row and one column per statistic (see aiccf.stats.STAT_COLUMNS),
+        for example ``stats[:, 'volume_mm3']``. Statistics of each structure
+        include its descendants.
+
+        The table is stored beside the label cache. If it is missing or out of
+        date it is computed (one pass over the volumes; *progress* is passed
+        to structure_statistics) and saved, unless *compute* is False, in
+        which case None is returned.
+        """
+        if self._structure_stats is not None:
+            return self._structure_stats
+        filename = stats_file(self.cache_path(self.resolution))
+        if os.path.isfile(filename) and os.path.getmtime(filename) >= os.path.getmtime(self._label_cache_file):
+            stats = metaarray.MetaArray(file=filename)
+            if np.array_equal(stats.xvals(0), self.ontology['id']):
+                self._structure_stats = stats
+                return stats
+        if not compute:
+            return None
+
+        vxsize = self.label._info[-1]['vxsize']
+        stats = structure_statistics(self.label_volume(), self.ontology, self._row_lut, vxsize,
+                                     image=self.image_volume(), progress=progress)
+        info = [
+            {'name': 'structure', 'values': self.ontology['id']},
+            {'name': 'statistic', 'cols': [{'name': name} for name in stats]},
+            {'vxsize': vxsize},
+        ]
+        self._structure_stats = metaarray.MetaArray(np.column_stack(list(stats.values())).astype(float), info=info)
+        write_file(self._structure_stats, filename, chunks=None)
+        return self._structure_stats
+
+    def structure_projections(self, compute=True, progress=None):
+        """Return a ProjectionCache holding the projection of every structure
+        along each axis of the label volume (see aiccf.projection), indexed
+        by ontology row.
+
+        The cache is stored beside the label cache. If it is missing or out of
+        date it is built (one pass over the label volume; *progress* is
+        passed to build_projections) and saved, unless *compute* is False, in
+        which case None is returned.
+        """
+        if self._projections is not None:
+            return self._projections
+        filename = projection_file(self.cache_path(self.resolution))
+        if os.path.isfile(filename) and os.path.getmtime(filename) >= os.path.getmtime(self._label_cache_file):
+            projections, extra = ProjectionCache.read(filename)
+            if np.array_equal(extra['ids'], self.ontology['id']):
+                self._projections = projections
+                return projections
+        if not compute:
+            return None
+
+        self._projections = build_projections(self.label_volume(), self._row_lut, len(self.ontology), progress=progress)
+        self._projections.write(filename, ids=self.ontology['id'])
+        return self._projections
+
+    def structure_projection(self, structure, axis, include_descendants=True):
+        """Return the projection of *structure* (a stored ID or an acronym)
+        along *axis* of the label volume as a boolean image.
+        """
+        row = self._structure_row(self._mask_structure_id(structure))
+        rows = descendant_rows(self.ontology, row) if include_descendants else [row]
+        return self.structure_projections().mask(axis, rows)
+
+    def to_allen_ids(self, ids):
+        """Translate label values stored in the (16-bit) label volume to Allen
+        structure IDs. *ids* may be a single value or an array of any shape.
+        Values that do not correspond to a structure translate to -1.
+        """
+        return self._allen_lut[np.asarray(ids)]
+
+    def from_allen_ids(self, ids):
+        """Translate Allen structure IDs to the values stored in the label
+        volume. *ids* may be a single value or an array of any shape.
+
+        Raises KeyError if any ID does not appear in the label volume.
+        """
+        ids = np.asarray(ids)
+        idx = np.clip(np.searchsorted(self._allen_ids, ids), 0, len(self._allen_ids)-1)
+        found = self._allen_ids[idx] == ids
+        if not np.all(found):
+            raise KeyError("Unknown structure IDs: %s" % np.unique(ids[~found]).tolist())
+        return self._stored_ids[idx]
+
+    def orientation_order(self, orientation):
+        """Return the axis order that transposes atlas volumes into display
+        order for *orientation* (one of the keys in ORIENTATIONS).
+        """
+        return [self.image._interpretAxis(ax) for ax in ORIENTATIONS[orientation]]
+
+    def set_layout_mode(self, orientation, mode):
+        """Set how atlas volumes are laid out when displayed in *orientation*:
+
+        ========  ==============================================================
+        None      Transposed view of the source volume (default; no extra
+                  memory, but plane reads are strided)
+        'memory'  C-contiguous copy in display order, held in memory. The total
+                  size of these copies is limited by *layout_budget* bytes.
+        'disk'    C-contiguous copy in display order, written once to the
+                  cache folder and opened like the other cache files.
+        ========  ==============================================================
+        """
+        if mode not in (None, 'memory', 'disk'):
+            raise ValueError("Layout mode must be None, 'memory', or 'disk' (got %r)" % mode)
+        self.layout_modes[orientation] = mode
+        for key in list(self._layouts.keys()):
+            if key[0] == orientation:
+                del self._layouts[key]
+
+    def layout_usage(self):
+        """Return a dict {(orientation, ds): nbytes} describing the memory
+        held by in-memory volume layouts.
+        """
+        return OrderedDict([(k, v[2]) for k, v in self._layouts.items() if v[2] > 0])
+
+    def oriented_volumes(self, orientation, ds=1):
+        """Return (image, label) volumes for downsampling level *ds* (see
+        downsample_levels()) with axes in display order for *orientation*.
+
+        Depending on the layout mode of *orientation*, these are either
+        transposed views or C-contiguous copies (see set_layout_mode).
+        """
+        key = (orientation, ds)
+        if key in self._layouts:
+            # move to end of LRU order
+            layout = self._layouts.pop(key)
+            self._layouts[key] = layout
+            return layout[:2]
+
+        order = self.orientation_order(orientation)
+        image = self.image_volume(ds).transpose(order)
+        label = self.label_volume(ds).transpose(order)
+        mode = self.layout_modes.get(orientation)
+
+        if mode == 'memory':
+            nbytes = image.size * image.dtype.itemsize + label.size * label.dtype.itemsize
+            if not self._reserve_layout_memory(nbytes):
+                return image, label
+            layout = (contiguous_copy(image), contiguous_copy(label), nbytes)
+        elif mode == 'disk':
+            image_file, label_file = layout_files(self.cache_path(self.resolution), orientation, ds)
+            source = self.image if ds == 1 else self._pyramid_level(ds)[0]
+            info = [source._info[ax] for ax in order] + [{'vxsize': source._info[-1]['vxsize'], 'orientation': orientation}]
+            for vol, filename, opts in ((image, image_file, self.cache_options['image']), (label, label_file, self.cache_options['label'])):
+                if not os.path.isfile(filename):
+                    write_layout(vol, info, filename, compression=opts.get('compression'))
+            image = metaarray_volume(metaarray.MetaArray(file=image_file, readAllData=not self.lazy))
+            label = metaarray_volume(metaarray.MetaArray(file=label_file, readAllData=not self.lazy))
+            layout = (image, label, 0)
+        else:
+            return image, label
+
+        self._layouts[key] = layout
+        return layout[:2]
+
+    def _reserve_layout_memory(self, nbytes):
+        # Evict least-recently used in-memory layouts until *nbytes* fits in
+        # the layout budget. Return False if it cannot fit at all.
+        if nbytes > self.layout_budget:
+            return False
+        for key in list(self._layouts.keys()):
+            if sum(self.layout_usage().values()) + nbytes <= self.layout_budget:
+                break
+            if self._layouts[key][2] > 0:
+                del self._layouts[key]
+        return True
+
+    def image_volume(self, ds=1):
+        """Return the atlas image as a 3D array with axes (anterior, dorsal, right).
+
+        *ds* selects a cached downsampling level (see downsample_levels()).
+        In lazy mode this is a LazyVolume that reads from the cache file on
+        demand; otherwise it is an ndarray.
+        """
+        image = self.image if ds == 1 else self._pyramid_level(ds)[0]
+        return metaarray_volume(image)
+
+    def label_volume(self, ds=1):
+        """Return the atlas labels as a 3D array with axes (anterior, dorsal, right).
+
+        *ds* selects a cached downsampling level (see downsample_levels()).
+        In lazy mode this is a LazyVolume that reads from the cache file on
+        demand; otherwise it is an ndarray.
+        """
+        label = self.label if ds == 1 else self._pyramid_level(ds)[1]
+        return metaarray_volume(label)
+
         
     def ccf_transform(self):
         """Return a 3D transform that maps from atlas voxel coordinates to CCF
         coordinates (in unscaled meters).
+
+        The transform is returned as a 4x4 affine matrix. Atlas volumes are
+        stored with axes (anterior, dorsal, right), whereas CCF coordinates
+        are (posterior, inferior, right).
         """
-        
-    def stereotaxic_transform(self):
-        """Return a 3D transform that maps from atlas voxel coodrinates to 
-        stereotaxic coordinates.
-        """
+        vxsize = self.image._info[-1]['vxsize']
+        shape = self.image.shape
+        m = np.eye(4)
+        m[0, 0] = -vxsize
+        m[0, 3] = (shape[0] - 1) * vxsize
+        m[1, 1] = -vxsize
+        m[1, 3] = (shape[1] - 1) * vxsize
+        m[2, 2] = vxsize
+        return m
+
+
+def metaarray_volume(ma):
+    """Return the data in MetaArray *ma* as an ndarray, or as a LazyVolume if
+    the MetaArray was opened without reading its data.
+    """
+    if isinstance(ma._data, np.ndarray):
+        return ma.view(np.ndarray)
+    return LazyVolume(ma._data)
+
+
+def layout_files(cache_path, orientation, ds=1):
+    """Return the (image, label) cache file names for volumes stored in
+    display order for *orientation* at downsampling level *ds*.
+    """
+    return (os.path.join(cache_path, 'image_%s_ds%d.ma' % (orientation, ds)),
+            os.path.join(cache_path, 'label_%s_ds%d.ma' % (orientation, ds)))
+
+
+def mask_bounds(mask):
+    """Return the bounding box of the True values in the boolean array *mask*
+    as a tuple of slices, or None if *mask* has no True values.
+    """
+    bounds = []
+    for ax in range(mask.ndim):
+        present = np.argwhere(mask.any(axis=tuple(i for i in range(mask.ndim) if i != ax)))[:, 0]
+        if len(present) == 0:
+            return None
+        bounds.append(slice(present[0], present[-1] + 1))
+    return tuple(bounds)
+
+
+def projection_file(cache_path):
+    """Return the name of the per-structure projection file in *cache_path*.
+    """
+    return os.path.join(cache_path, 'structure_projections.npz')
+
+
+def stats_file(cache_path):
+    """Return the name of the per-structure statistics file in *cache_path*.
+    """
+    return os.path.join(cache_path, 'structure_stats.ma')
+
+
+def write_layout(volume, info, filename, compression=None):
+    """Write *volume* to *filename* as a C-contiguous MetaArray, chunked in
+    single planes along the first axis (the axis that is displayed). The copy
+    is staged through a temporary memory-mapped file so that it does not need
+    to fit in memory.
+    """
+    tmp = filename + '.mmap'
+    data = np.memmap(tmp, dtype=volume.dtype, mode='w+', shape=volume.shape)
+    try:
+        contiguous_copy(volume, out=data)
+        write_file(metaarray.MetaArray(data, info=info), filename, chunks=(1,) + data.shape[1:], compression=compression)
+    finally:
+        del data
+        os.remove(tmp)
+
 
-    
 def read_nrrd_atlas(nrrd_file):
     """
     Download atlas files from:
@@ -183,7 +791,7 @@ def read_nrrd_labels(nrrdFile, ontologyFile):
     This method compresses the annotation data down to a 16-bit array by remapping
     the larger annotations to smaller, unused values.
     """
-    global onto, ontology, data, mapping, inds, vxsize, info, ma
+    global ontology, ancestors, data, mapping, vxsize, info, ma
 
     import nrrd
 
@@ -191,11 +799,7 @@ def read_nrrd_labels(nrrdFile, ontologyFile):
         print "Loading annotation file..."
         pg.QtGui.QApplication.processEvents()
         # Read ontology and convert to flat table
-        onto = json.load(open(ontologyFile, 'rb'))
-        onto = parse_ontology(onto['msg'][0])
-        l1 = max([len(row[2]) for row in onto])
-        l2 = max([len(row[3]) for row in onto])
-        ontology = np.array(onto, dtype=[('id', 'int32'), ('parent', 'int32'), ('name', 'S%d'%l1), ('acronym', 'S%d'%l2), ('color', 'S6')])    
+        ontology = read_ontology(ontologyFile)
 
         if dlg.wasCanceled():
             return
@@ -218,33 +822,20 @@ def read_nrrd_labels(nrrdFile, ontologyFile):
 
     # compress down to uint16
     print "Compressing.."
-    u = np.unique(data)
-    
-    # decide on a 32-to-64-bit label mapping
-    mask = u <= 2**16-1
-    next_id = 2**16-1
-    mapping = OrderedDict()
-    inds = set()
-    for i in u[mask]:
-        mapping[i] = i
-        inds.add(i)
-   
-    with pg.ProgressDialog("Remapping annotations to 16-bit (please be patient with me; this can take several minutes) ...", 0, (~mask).sum(), wait=0, nested=True) as dlg:
+    old_ids, new_ids = label_remap_table(data)
+
+    with pg.ProgressDialog("Remapping annotations to 16-bit...", 0, data.shape[0], wait=0, nested=True) as dlg:
         pg.QtGui.QApplication.processEvents()
-        for i in u[~mask]:
-            while next_id in inds:
-                next_id -= 1
-            mapping[i] = next_id
-            inds.add(next_id)
-            data[data == i] = next_id
-            ontology['id'][ontology['id'] == i] = next_id
-            ontology['parent'][ontology['parent'] == i] = next_id
+        def progress(done, total):
+            dlg.setValue(done)
             if dlg.wasCanceled():
-                return
-            dlg += 1
-        
-    data = data.astype('uint16')
-    mapping = np.array(list(mapping.items()))    
+                raise Exception("User cancelled label conversion.")
+        data = remap_labels(data, old_ids, new_ids, progress=progress)
+
+    remap_ontology(ontology, old_ids, new_ids)
+    ontology, ancestors = index_ontology(ontology)
+    mapping = np.column_stack([old_ids, new_ids])
+    id_lut = id_lookup_table(mapping)    
  
     # voxel size in um
     vxsize = 1e-6 * float(header['space directions'][0][0])
@@ -253,28 +844,378 @@ def read_nrrd_labels(nrrdFile, ontologyFile):
         {'name': 'anterior', 'values': np.arange(data.shape[0]) * vxsize, 'units': 'm'},
         {'name': 'dorsal', 'values': np.arange(data.shape[1]) * vxsize, 'units': 'm'},
         {'name': 'right', 'values': np.arange(data.shape[2]) * vxsize, 'units': 'm'},
-        {'vxsize': vxsize, 'ai_ontology_map': mapping, 'ontology': ontology}
+        {'vxsize': vxsize, 'ai_ontology_map': mapping, 'ai_id_lut': id_lut, 'ontology': ontology,
+         'ontology_ancestors': ancestors}
     ]
     ma = metaarray.MetaArray(data, info=info)
     return ma
 
 
+def read_ontology(ontology_file):
+    """Read a structure graph JSON file and return it as a flat structured
+    array with fields id, parent, name, acronym, and color.
+    """
+    onto = json.load(open(ontology_file, 'rb'))
+    onto = parse_ontology(onto['msg'][0])
+    l1 = max([len(row[2]) for row in onto])
+    l2 = max([len(row[3]) for row in onto])
+    return np.array(onto, dtype=[('id', 'int32'), ('parent', 'int32'), ('name', 'S%d'%l1), ('acronym', 'S%d'%l2), ('color', 'S6')])
+
+
+def convert_nrrd_atlas(nrrd_file, filename, memory_budget=1e9, progress=None, chunks='auto', compression=None):
+    """Convert an atlas image NRRD file to a MetaArray cache file, with the
+    same result as writing read_nrrd_atlas(nrrd_file) to *filename*.
+
+    The volume is streamed from disk twice (once to find its maximum, once to
+    scale, flip, and write it) in slabs sized so that roughly
+    *memory_budget* bytes are used at most. If given, *progress(done, total)*
+    is called after each slab; it may raise an exception to cancel.
+    *chunks* and *compression* are the same as for write_file.
+    """
+    header = nrrdstream.read_header(nrrd_file)
+    sizes = header['sizes']
+    itemsize = nrrdstream.data_type(header).itemsize
+    # per voxel: the reader's buffer, the float64 scaled temporary, the ubyte
+    # result, and the contiguous copy of the flipped slab made when writing;
+    # about 4 MB are left for the reader's file and decompression buffers
+    step, chunks = slab_plan(sizes, itemsize + 8 + 1 + 1, memory_budget - 2**22, chunks)
+    total = 2 * sizes[2]
+
+    vmax = 0
+    for start, slab in nrrdstream.iter_slabs(nrrd_file, step=step):
+        vmax = max(vmax, slab.max())
+        if progress is not None:
+            progress(start + slab.shape[2], total)
+
+    vxsize = 1e-6 * header['space directions'][0][0]
+    info = [
+        {'name': 'anterior', 'values': np.arange(sizes[0]) * vxsize, 'units': 'm'},
+        {'name': 'dorsal', 'values': np.arange(sizes[1]) * vxsize, 'units': 'm'},
+        {'name': 'right', 'values': np.arange(sizes[2]) * vxsize, 'units': 'm'},
+        {'vxsize': vxsize}
+    ]
+
+    def slabs():
+        for start, slab in nrrdstream.iter_slabs(nrrd_file, step=step):
+            # convert to ubyte and flip to (anterior, dorsal, right) as in read_nrrd_atlas
+            yield start, np.multiply(slab, 255./vmax).astype('ubyte')[::-1, ::-1, :]
+            if progress is not None:
+                progress(sizes[2] + start + slab.shape[2], total)
+
+    write_slabs(filename, tuple(sizes), 'ubyte', info, slabs(), chunks=chunks, compression=compression)
+
+
+def convert_nrrd_labels(nrrd_file, ontology_file, filename, memory_budget=1e9, progress=None, chunks='auto', compression=None):
+    """Convert an annotation NRRD file and its ontology to a MetaArray cache
+    file, with the same result as writing read_nrrd_labels(nrrd_file,
+    ontology_file) to *filename*.
+
+    The volume is streamed from disk twice (once to collect the label values,
+    once to remap, flip, and write them) in slabs sized so that roughly
+    *memory_budget* bytes are used at most. If given, *progress(done, total)*
+    is called after each slab; it may raise an exception to cancel.
+    *chunks* and *compression* are the same as for write_file.
+    """
+    header = nrrdstream.read_header(nrrd_file)
+    sizes = header['sizes']
+    itemsize = nrrdstream.data_type(header).itemsize
+    step, chunks = slab_plan(sizes, 2 * (itemsize + 2), memory_budget, chunks)
+    total = 2 * sizes[2]
+
+    ids = np.empty(0, dtype=nrrdstream.data_type(header))
+    for start, slab in nrrdstream.iter_slabs(nrrd_file, step=step):
+        ids = np.union1d(ids, np.unique(slab))
+        if progress is not None:
+            progress(start + slab.shape[2], total)
+
+    old_ids, new_ids = label_remap_table(ids)
+    ontology = read_ontology(ontology_file)
+    remap_ontology(ontology, old_ids, new_ids)
+    ontology, ancestors = index_ontology(ontology)
+    mapping = np.column_stack([old_ids, new_ids])
+
+    vxsize = 1e-6 * header['space directions'][0][0]
+    info = [
+        {'name': 'anterior', 'values': np.arange(sizes[0]) * vxsize, 'units': 'm'},
+        {'name': 'dorsal', 'values': np.arange(sizes[1]) * vxsize, 'units': 'm'},
+        {'name': 'right', 'values': np.arange(sizes[2]) * vxsize, 'units': 'm'},
+        {'vxsize': vxsize, 'ai_ontology_map': mapping, 'ai_id_lut': id_lookup_table(mapping), 'ontology': ontology,
+         'ontology_ancestors': ancestors}
+    ]
+
+    def slabs():
+        for start, slab in nrrdstream.iter_slabs(nrrd_file, step=step):
+            # flip to (anterior, dorsal, right) as in read_nrrd_labels
+            yield start, remap_labels(slab[::-1, ::-1, :], old_ids, new_ids)
+            if progress is not None:
+                progress(sizes[2] + start + slab.shape[2], total)
+
+    write_slabs(filename, tuple(sizes), 'uint16', info, slabs(), chunks=chunks, compression=compression)
+
+
+def slab_plan(shape, bytes_per_voxel, memory_budget, chunks='auto'):
+    """Return (step, chunks) for converting a volume of *shape* in slabs along
+    axis 2 that use at most *memory_budget* bytes (estimated as
+    *bytes_per_voxel* per voxel in the slab).
+
+    *step* is the number of planes per slab. *chunks* is the HDF5 chunk shape
+    to write with (see chunk_shape). When possible, *step* is a multiple of
+    the chunk size along axis 2 so that every slab covers whole chunks; with
+    'auto' chunks that are too deep for the budget are made thinner.
+    """
+    step = max(1, int(memory_budget // (shape[0] * shape[1] * bytes_per_voxel)))
+    auto = chunks == 'auto'
+    chunks = chunk_shape(shape, chunks)
+    if chunks is not None:
+        if chunks[2] > step and auto:
+            chunks = chunks[:2] + (step,)
+        if step >= chunks[2]:
+            step -= step % chunks[2]
+    return min(step, shape[2]), chunks
+
+
+def chunk_shape(shape, chunks='auto', axes=('anterior', 'dorsal', 'right'), size=200):
+    """Return the HDF5 chunk shape for a volume of *shape* described by
+    *chunks*, or None for contiguous storage:
+
+    ===========  ================================================================
+    'auto'       Cubes of *size* (clipped to the volume shape), which
+                 slab_plan may make thinner along axis 2
+    'cube'       Cubes of *size* (clipped to the volume shape)
+    axis name    Single planes perpendicular to the named axis (one of *axes*),
+                 which suits reading planes in that orientation
+    tuple        Explicit chunk shape (clipped to the volume shape)
+    None         Contiguous
+    ===========  ================================================================
+    """
+    if chunks is None:
+        return None
+    if isinstance(chunks, (tuple, list)):
+        return tuple(min(int(c), n) for c, n in zip(chunks, shape))
+    if chunks in ('auto', 'cube'):
+        return tuple(min(size, n) for n in shape)
+    if chunks in axes:
+        plane = list(shape)
+        plane[list(axes).index(chunks)] = 1
+        return tuple(plane)
+    raise ValueError("Unknown chunk layout %r" % (chunks,))
+
+
+def conversion_progress(dlg):
+    """Return a progress(done, total) callback that updates the progress
+    dialog *dlg* and raises an exception if it was cancelled.
+    """
+    def progress(done, total):
+        dlg.setValue(int(dlg.maximum() * done / total))
+        pg.QtGui.QApplication.processEvents()
+        if dlg.wasCanceled():
+            raise Exception("User cancelled atlas conversion.")
+    return progress
+
+
+def write_slabs(filename, shape, dtype, info, slabs, chunks=None, compression=None):
+    """Write a MetaArray file with the given *shape*, *dtype*, and *info* from
+    *slabs*, an iterable of (start, data) pairs that each cover planes
+    start to start+data.shape[2] along axis 2. The complete volume is never
+    held in memory. *chunks* is an HDF5 chunk shape and *compression* an
+    HDF5 filter as for write_file.
+    """
+    import h5py
+    data_dir = os.path.dirname(filename)
+    if data_dir != '' and not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    tmp = filename + '.tmp'
+    fh = h5py.File(tmp, 'w')
+    try:
+        fh.attrs['MetaArray'] = metaarray.MetaArray.version
+        dset = fh.create_dataset('data', shape=shape, dtype=dtype, chunks=chunks, compression=compression)
+        for start, data in slabs:
+            dset[:, :, start:start + data.shape[2]] = data
+        metaarray.MetaArray(np.empty((0,))).writeHDF5Meta(fh, 'info', info)
+    finally:
+        fh.close()
+    os.rename(tmp, filename)
+
+
+def label_remap_table(ids, max_id=2**16-1):
+    """Return sorted arrays (old_ids, new_ids) describing how to compress the
+    label values found in *ids* into the range [0, max_id].
+
+    Labels that already fit are mapped to themselves; larger labels are
+    assigned the highest unused values, counting down from *max_id*.
+    """
+    old_ids = np.unique(ids)
+    new_ids = old_ids.copy()
+    large = old_ids > max_id
+    n_large = large.sum()
+    if n_large > 0:
+        free = np.setdiff1d(np.arange(max_id+1), old_ids[~large])[::-1]
+        if len(free) < n_large:
+            raise ValueError("Cannot fit %d unique labels into the range [0, %d]" % (len(old_ids), max_id))
+        new_ids[large] = free[:n_large]
+    return old_ids, new_ids
+
+
+def remap_labels(data, old_ids, new_ids, dtype='uint16', chunk_size=2**24, progress=None):
+    """Return a copy of *data* (as *dtype*) with every value from *old_ids*
+    replaced by the corresponding value in *new_ids*.
+
+    *old_ids* must be sorted and must contain every value present in *data*
+    (as returned by label_remap_table). The lookup is done in a single pass,
+    roughly *chunk_size* voxels (whole planes along axis 0) at a time, so
+    temporary index arrays stay small. If given, *progress(done, total)* is
+    called after each chunk.
+    """
+    lut = np.asarray(new_ids).astype(dtype)
+    out = np.empty(data.shape, dtype=dtype)
+    n = data.shape[0]
+    plane = int(np.prod(data.shape[1:]))
+    step = max(1, chunk_size // max(plane, 1))
+    for start in range(0, n, step):
+        stop = min(start + step, n)
+        out[start:stop] = lut[np.searchsorted(old_ids, data[start:stop])]
+        if progress is not None:
+            progress(stop, n)
+    return out
+
+
+def remap_ontology(ontology, old_ids, new_ids):
+    """Rewrite the 'id' and 'parent' columns of *ontology* in place using the
+    mapping from label_remap_table. IDs that do not appear in *old_ids* are
+    left unchanged.
+    """
+    for col in ('id', 'parent'):
+        ids = ontology[col]
+        idx = np.clip(np.searchsorted(old_ids, ids), 0, len(old_ids)-1)
+        found = old_ids[idx] == ids
+        ids[found] = new_ids[idx[found]]
+
+
+def downsample_image(data, ds, chunk_size=2**24):
+    """Return a copy of *data* downsampled by *ds* along all three axes by
+    averaging ds*ds*ds blocks. Partial blocks at the end of each axis are
+    discarded (as in pg.downsample). Integer data is rounded back to its
+    original dtype.
+
+    The volume is processed in slabs of roughly *chunk_size* input voxels.
+    """
+    shape = tuple(n // ds for n in data.shape)
+    out = np.empty(shape, dtype=data.dtype)
+    step = max(1, chunk_size // max(1, ds**3 * shape[1] * shape[2]))
+    for start in range(0, shape[0], step):
+        stop = min(start + step, shape[0])
+        slab = np.asarray(data[start*ds:stop*ds, :shape[1]*ds, :shape[2]*ds])
+        mean = slab.reshape(stop-start, ds, shape[1], ds, shape[2], ds).mean(axis=(1, 3, 5))
+        if np.issubdtype(out.dtype, np.integer):
+            mean = np.round(mean)
+        out[start:stop] = mean
+    return out
+
+
+def downsample_labels(data, ds, chunk_size=2**22):
+    """Return a copy of *data* downsampled by *ds* along all three axes by
+    taking the most common label in each ds*ds*ds block (ties go to the
+    smaller label). Partial blocks are discarded as in downsample_image.
+
+    The volume is processed in slabs of roughly *chunk_size* input voxels.
+    """
+    shape = tuple(n // ds for n in data.shape)
+    out = np.empty(shape, dtype=data.dtype)
+    step = max(1, chunk_size // max(1, ds**3 * shape[1] * shape[2]))
+    for start in range(0, shape[0], step):
+        stop = min(start + step, shape[0])
+        slab = np.asarray(data[start*ds:stop*ds, :shape[1]*ds, :shape[2]*ds])
+        blocks = slab.reshape(stop-start, ds, shape[1], ds, shape[2], ds).transpose(0, 2, 4, 1, 3, 5)
+        out[start:stop] = block_mode(blocks.reshape(-1, ds**3)).reshape(stop-start, shape[1], shape[2])
+    return out
+
+
+def block_mode(blocks):
+    """Return the most common value in each row of the 2D array *blocks*.
+    Ties are resolved in favor of the smallest value.
+    """
+    s = np.sort(blocks, axis=1)
+    idx = np.arange(s.shape[1])
+    starts = np.ones(s.shape, dtype=bool)
+    starts[:, 1:] = s[:, 1:] != s[:, :-1]
+    # length of the run of equal values ending at each position
+    run_start = np.maximum.accumulate(np.where(starts, idx, 0), axis=1)
+    best = np.argmax(idx - run_start, axis=1)
+    return s[np.arange(s.shape[0]), best]
+
+
+def pyramid_files(cache_path, ds):
+    """Return the (image, label) cache file names for downsampling level *ds*.
+    """
+    return (os.path.join(cache_path, 'image_ds%d.ma' % ds),
+            os.path.join(cache_path, 'label_ds%d.ma' % ds))
+
+
+def write_pyramid(image, label, cache_path, levels, image_options=None, label_options=None):
+    """Write downsampled copies of the *image* and *label* MetaArrays to
+    *cache_path*, one pair of files per downsampling factor in *levels*.
+    Images are block-averaged; labels use the most common label per block.
+    *image_options* and *label_options* are dicts of keyword arguments for
+    write_file.
+    """
+    vxsize = image._info[-1]['vxsize']
+    with pg.ProgressDialog("Building downsampled atlas levels...", 0, len(levels), wait=0, nested=True) as dlg:
+        for ds in levels:
+            image_file, label_file = pyramid_files(cache_path, ds)
+            for ma, filename, downsample, opts in ((image, image_file, downsample_image, image_options),
+                                                   (label, label_file, downsample_labels, label_options)):
+                data = downsample(metaarray_volume(ma), ds)
+                info = [
+                    {'name': 'anterior', 'values': np.arange(data.shape[0]) * vxsize * ds, 'units': 'm'},
+                    {'name': 'dorsal', 'values': np.arange(data.shape[1]) * vxsize * ds, 'units': 'm'},
+                    {'name': 'right', 'values': np.arange(data.shape[2]) * vxsize * ds, 'units': 'm'},
+                    {'vxsize': vxsize * ds, 'downsample': ds}
+                ]
+                write_file(metaarray.MetaArray(data, info=info), filename, **(opts or {}))
+            if dlg.wasCanceled():
+                raise Exception("User cancelled atlas conversion.")
+            dlg += 1
+
+
+def id_lookup_table(mapping, size=2**16):
+    """Return a dense array that maps stored (16-bit) label values to Allen
+    structure IDs, given *mapping* as an (N, 2) array of (allen_id,
+    stored_id) pairs. Unused entries are -1.
+    """
+    mapping = np.asarray(mapping)
+    lut = np.empty(size, dtype='int64')
+    lut[:] = -1
+    lut[mapping[:, 1]] = mapping[:, 0]
+    return lut
+
+
 def parse_ontology(root, parent=-1):
-    ont = [(root['id'], parent, root['name'], root['acronym'], root['color_hex_triplet'])]
-    for child in root['children']:
-        ont += parse_ontology(child, root['id'])
+    """Flatten the nested structure graph below *root* into a list of
+    (id, parent, name, acronym, color) tuples in depth-first order.
+    """
+    ont = []
+    stack = [(root, parent)]
+    while len(stack) > 0:
+        node, parent = stack.pop()
+        ont.append((node['id'], parent, node['name'], node['acronym'], node['color_hex_triplet']))
+        stack.extend((child, node['id']) for child in reversed(node['children']))
     return ont
 
 
-def write_file(data, filename):
+def write_file(data, filename, chunks='auto', compression=None):
+    """Write the MetaArray *data* to *filename*.
+
+    *chunks* selects the HDF5 chunk shape (see chunk_shape; axis names are
+    taken from the MetaArray). *compression* is an HDF5 filter: None, 'lzf'
+    (fast), 'gzip', or a gzip level from 0 to 9.
+    """
     data_dir = os.path.dirname(filename)
     if data_dir != '' and not os.path.exists(data_dir):
         os.makedirs(data_dir)
 
     tmp = filename + '.tmp'
-    if max(data.shape) > 200 and min(data.shape) > 200:
-        data.write(tmp, chunks=(200, 200, 200))
-    else:
-        data.write(tmp)
+    axes = [data._info[i].get('name') for i in range(data.ndim)]
+    data.write(tmp, chunks=chunk_shape(data.shape, chunks, axes), compression=compression)
         
     os.rename(tmp, filename)
@@ -0,0 +1,197 @@
+"""Resumable, verified downloads of atlas files.
+
+Files are downloaded to ``<dest>.partial`` and only renamed to *dest* once
+they are complete and verified. An interrupted download leaves the partial
+file in place; the next attempt asks the server for the remaining bytes only
+(HTTP Range request), and starts over if the server does not support that.
+
+This module does not depend on Qt; see aiccf.ui.download for a version that
+displays a progress dialog.
+"""
+import os, time, hashlib, threading
+
+try:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, Request, HTTPError
+
+
+def fetch(url, dest, chunk_size=2**20, size=None, checksum=None, progress=None, cancel=None, timeout=60):
+    """Download *url* to the file *dest*, resuming a previous partial download
+    if there is one.
+
+    The downloaded file is verified against the size reported by the server,
+    and against *size* (in bytes) and *checksum* if they are given.
+    *checksum* is a tuple (algorithm, hexdigest), for example
+    ('md5', 'd41d8cd98f00b204e9800998ecf8427e'). A file that fails
+    verification is deleted and IOError is raised.
+
+    *progress* is called as progress(done, total) before the first chunk and
+    after every chunk, where *done* counts all bytes in the file so far and
+    *total* is None if the server did not report a size. If the
+    threading.Event *cancel* is set, the download stops (keeping the partial
+    file) and an exception is raised.
+
+    Returns a dict with keys 'url', 'dest', 'size' (final file size),
+    'bytes' (bytes transferred by this call), 'resumed_from', and 'seconds'.
+    """
+    tmp = dest + '.partial'
+    offset = os.path.getsize(tmp) if os.path.isfile(tmp) else 0
+    if size is not None and offset > size:
+        offset = 0
+    headers = {}
+    if offset > 0:
+        headers['Range'] = 'bytes=%d-' % offset
+
+    start = time.time()
+    received = 0
+    try:
+        req = urlopen(Request(url, headers=headers), timeout=timeout)
+    except HTTPError as exc:
+        # a range starting at the end of the file means there is nothing left
+        if exc.code != 416 or offset == 0:
+            raise
+        req = None
+        total = _content_total(exc.info(), None)
+
+    if req is not None:
+        try:
+            if offset > 0 and req.getcode() != 206:
+                # server ignored the range request; start over
+                offset = 0
+            total = _content_total(req.info(), offset)
+            if progress is not None:
+                progress(offset, total)
+            with open(tmp, 'ab' if offset > 0 else 'wb') as fh:
+                while True:
+                    if cancel is not None and cancel.is_set():
+                        raise Exception("Download cancelled.")
+                    chunk = req.read(chunk_size)
+                    if not chunk:
+                        break
+                    fh.write(chunk)
+                    received += len(chunk)
+                    if progress is not None:
+                        progress(offset + received, total)
+        finally:
+            req.close()
+
+    if total is not None and os.path.getsize(tmp) < total:
+        # keep what we have; the next attempt resumes from here
+        raise IOError("Download of %s incomplete (%d of %d bytes)." % (url, os.path.getsize(tmp), total))
+    try:
+        verify(tmp, size=size if size is not None else total, checksum=checksum)
+    except IOError:
+        os.remove(tmp)
+        raise
+
+    if os.path.exists(dest):
+        os.remove(dest)
+    os.rename(tmp, dest)
+    return {'url': url, 'dest': dest, 'size': os.path.getsize(dest), 'bytes': received,
+            'resumed_from': offset, 'seconds': time.time() - start}
+
+
+def _content_total(headers, offset):
+    # Return the full size of the resource from response headers, or None
+    crange = headers.get('content-range')
+    if crange is not None and '/' in crange:
+        total = crange.split('/')[-1].strip()
+        if total != '*':
+            return int(total)
+    length = headers.get('content-length')
+    if length is None or offset is None:
+        return None
+    return offset + int(length)
+
+
+def verify(filename, size=None, checksum=None, chunk_size=2**24):
+    """Raise IOError if *filename* does not have the expected *size* (in bytes)
+    or *checksum* (an (algorithm, hexdigest) tuple as accepted by fetch()).
+    """
+    actual = os.path.getsize(filename)
+    if size is not None and actual != size:
+        raise IOError("%s has size %d; expected %d." % (filename, actual, size))
+    if checksum is not None:
+        algorithm, expected = checksum
+        h = hashlib.new(algorithm)
+        with open(filename, 'rb') as fh:
+            while True:
+                chunk = fh.read(chunk_size)
+                if not chunk:
+                    break
+                h.update(chunk)
+        if h.hexdigest().lower() != expected.lower():
+            raise IOError("%s has %s checksum %s; expected %s." % (filename, algorithm, h.hexdigest(), expected))
+
+
+def fetch_all(jobs, threads=3, progress=None, interval=0.2):
+    """Download several files concurrently.
+
+    *jobs* is a list of dicts of keyword arguments for fetch() (at least 'url'
+    and 'dest'). Up to *threads* files are downloaded at the same time.
+
+    *progress* is called from the calling thread about every *interval*
+    seconds as progress(done, total, rate), where *done* is the number of
+    bytes in all files so far, *total* is their combined size (None while any
+    size is unknown), and *rate* is the current throughput in bytes/s. It may
+    raise an exception to cancel all downloads; partial files are kept.
+
+    Returns the list of fetch() results in the same order as *jobs*. If any
+    download fails, the others are cancelled and the first error is raised.
+    """
+    cancel = threading.Event()
+    lock = threading.Lock()
+    pending = list(range(len(jobs)))
+    state = [[None, None, 0] for job in jobs]   # bytes in file, total size, bytes received
+    results = [None] * len(jobs)
+    errors = []
+
+    def run():
+        while True:
+            with lock:
+                if len(pending) == 0 or cancel.is_set():
+                    return
+                i = pending.pop(0)
+            def job_progress(done, total, i=i):
+                prev = state[i][0]
+                state[i] = [done, total, state[i][2] + (0 if prev is None else done - prev)]
+            try:
+                results[i] = fetch(progress=job_progress, cancel=cancel, **jobs[i])
+                state[i][:2] = [results[i]['size'], results[i]['size']]
+            except Exception as exc:
+                errors.append(exc)
+                cancel.set()
+                return
+
+    workers = [threading.Thread(target=run) for i in range(max(1, min(threads, len(jobs))))]
+    for w in workers:
+        w.daemon = True
+        w.start()
+
+    last_time = time.time()
+    last_received = 0
+    try:
+        for w in workers:
+            while w.is_alive():
+                w.join(interval)
+                if progress is None:
+                    continue
+                now = time.time()
+                done = sum(s[0] or 0 for s in state)
+                totals = [s[1] for s in state]
+                total = None if None in totals else sum(totals)
+                received = sum(s[2] for s in state)
+                rate = (received - last_received) / max(now - last_time, 1e-6)
+                last_time, last_received = now, received
+                progress(done, total, rate)
+    except BaseException:
+        cancel.set()
+        for w in workers:
+            w.join()
+        raise
+
+    if len(errors) > 0:
+        raise errors[0]
+    return results
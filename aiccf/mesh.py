@@ -0,0 +1,166 @@
+"""Surface meshes of atlas structures.
+
+Meshes are extracted from the label volume one structure at a time, reading
+only the structure's bounding box, and at several levels of detail: at level
+*n* the structure mask is averaged over blocks of n**3 voxels before the
+surface is extracted, so the number of faces falls roughly by n**2.
+extract_meshes() processes many structures in parallel using a pool of
+worker processes.
+
+Mesh vertices are voxel indices (possibly fractional) along the axes of the
+label volume. This module does not depend on Qt; surfaces are extracted with
+pyqtgraph's isosurface function.
+"""
+import os, multiprocessing
+import numpy as np
+import scipy.ndimage
+
+from .volume import LazyVolume
+
+
+def structure_mesh(mask, level=1, smooth=1.0, offset=(0, 0, 0)):
+    """Return the surface of the True voxels in the 3D boolean array *mask*
+    as (vertexes, faces) arrays, with float32 vertexes of shape (N, 3) and
+    int32 faces of shape (M, 3).
+
+    *level* is the level of detail (1 is full resolution; see module
+    docstring), and *smooth* the width (in voxels at that level) of the
+    Gaussian filter applied to the mask before extracting the surface.
+    *offset* is added to all vertexes; pass the start of the bounding box when
+    *mask* is cropped from a larger volume.
+    """
+    from pyqtgraph.functions import isosurface
+
+    data = _block_mean(mask, level) if level > 1 else mask.astype('float32')
+    # pad so that surfaces are closed at the edges of the mask
+    data = np.pad(data, 1, mode='constant')
+    if smooth > 0:
+        data = scipy.ndimage.gaussian_filter(data, smooth)
+    peak = data.max()
+    if peak == 0:
+        return np.zeros((0, 3), dtype='float32'), np.zeros((0, 3), dtype='int32')
+    # small structures may not reach 0.5 after smoothing
+    verts, faces = isosurface(data, min(0.5, peak * 0.5))
+    verts = (np.asarray(verts, dtype='float32') - 1) * level + (level - 1) * 0.5
+    verts += np.asarray(offset, dtype='float32')
+    return verts, np.asarray(faces, dtype='int32')
+
+
+def _block_mean(mask, level):
+    # Average *mask* over blocks of level**3 voxels (padding the edges with 0)
+    shape = [int(np.ceil(n / float(level))) for n in mask.shape]
+    data = np.zeros([n * level for n in shape], dtype='float32')
+    data[tuple(slice(0, n) for n in mask.shape)] = mask
+    return data.reshape(shape[0], level, shape[1], level, shape[2], level).mean(axis=(1, 3, 5))
+
+
+def extract_meshes(label, tasks, levels=(1,), smooth=1.0, processes=None, progress=None):
+    """Extract the meshes of many structures from the 3D *label* volume (an
+    ndarray or LazyVolume) using a pool of worker processes.
+
+    *tasks* is a sequence of (key, ids, bounds) tuples: the mask of each
+    structure is True where *label* has any of the values in *ids*, and is
+    read only from *bounds* (a tuple of slices, or None for an empty
+    structure). *processes* is the number of
+    worker processes (default is the number of CPUs); use 1 to extract in the
+    calling process. *progress(done, total)* is called as structures are
+    finished, and may raise an exception to cancel.
+
+    Returns a dict {key: {level: (vertexes, faces)}} (see structure_mesh).
+    """
+    tasks = [(key, np.asarray(ids), bounds, levels, smooth) for key, ids, bounds in tasks]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    meshes = {}
+    if processes <= 1 or len(tasks) <= 1:
+        _init_worker(label)
+        try:
+            for task in tasks:
+                key, result = _mesh_worker(task)
+                meshes[key] = result
+                if progress is not None:
+                    progress(len(meshes), len(tasks))
+        finally:
+            _init_worker(None)
+        return meshes
+
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(label,))
+    try:
+        for key, result in pool.imap_unordered(_mesh_worker, tasks):
+            meshes[key] = result
+            if progress is not None:
+                progress(len(meshes), len(tasks))
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+    return meshes
+
+
+_worker_label = None
+
+
+def _init_worker(label):
+    # Each worker needs its own handle on a disk-backed volume
+    global _worker_label
+    if isinstance(label, LazyVolume):
+        label = label.reopen()
+    _worker_label = label
+
+
+def _mesh_worker(task):
+    key, ids, bounds, levels, smooth = task
+    lut = np.zeros(2**16, dtype=bool)
+    if bounds is None:
+        # empty structure
+        mask, offset = np.zeros((0, 0, 0), dtype=bool), (0, 0, 0)
+    else:
+        lut[ids] = True
+        mask = lut[np.asarray(_worker_label[bounds])]
+        offset = [b.start for b in bounds]
+    return key, dict((level, structure_mesh(mask, level, smooth, offset)) for level in levels)
+
+
+def mesh_file(cache_path, id):
+    """Return the name of the file storing the meshes of structure *id* in
+    the atlas cache directory *cache_path*.
+    """
+    return os.path.join(cache_path, 'meshes', '%d.npz' % id)
+
+
+def write_meshes(filename, meshes, smooth=None):
+    """Write a {level: (vertexes, faces)} dict to *filename* (.npz), along
+    with the *smooth* width the meshes were extracted with, if given.
+    """
+    data_dir = os.path.dirname(filename)
+    if data_dir != '' and not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    arrays = {}
+    if smooth is not None:
+        arrays['smooth'] = np.array(smooth, dtype='float64')
+    for level, (verts, faces) in meshes.items():
+        arrays['vertexes_%d' % level] = verts
+        arrays['faces_%d' % level] = faces
+    # write to a temporary file first so that readers never see a partial file
+    tmp = filename + '.tmp.npz'
+    np.savez(tmp, **arrays)
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp, filename)
+
+
+def read_meshes(filename):
+    """Return (meshes, smooth) read from a file written by write_meshes(),
+    where *meshes* is a {level: (vertexes, faces)} dict and *smooth* is None
+    if the file does not record it.
+    """
+    meshes = {}
+    with np.load(filename) as data:
+        smooth = float(data['smooth']) if 'smooth' in data.files else None
+        for name in data.files:
+            if name.startswith('vertexes_'):
+                level = int(name.split('_')[1])
+                meshes[level] = (data[name], data['faces_%d' % level])
+    return meshes, smooth
@@ -0,0 +1,77 @@
+"""3D view of structure surface meshes (requires PyOpenGL).
+"""
+import numpy as np
+import pyqtgraph as pg
+import pyqtgraph.opengl as pgl
+
+
+class MeshView(pgl.GLViewWidget):
+    """Displays the surface meshes of atlas structures (see
+    CCFAtlasData.structure_meshes), switching each mesh to the level of detail
+    that matches the current zoom: the coarsest level whose voxel blocks
+    still span at most *lod_pixels* pixels on screen.
+    """
+    def __init__(self, lod_pixels=2.0, parent=None):
+        pgl.GLViewWidget.__init__(self, parent)
+        self.setWindowTitle('CCF structures')
+        self.lod_pixels = lod_pixels
+        self.level = None
+        self._structures = {}  # id: [item, {level: (vertexes, faces)}, {level: MeshData}]
+        self._centered = False
+
+    def set_structures(self, meshes, colors):
+        """Show the structures in *meshes*, a dict {id: {level: (vertexes,
+        faces)}}, with the given {id: color} and remove all others.
+        """
+        for id in list(self._structures):
+            if id not in meshes:
+                self.removeItem(self._structures.pop(id)[0])
+        for id, levels in meshes.items():
+            if len(levels[min(levels)][1]) == 0:
+                # structure has no voxels
+                continue
+            color = pg.mkColor(colors[id]).getRgbF()[:3] + (0.5,)
+            if id in self._structures:
+                self._structures[id][0].setColor(color)
+                continue
+            item = pgl.GLMeshItem(smooth=True, color=color, shader='shaded', glOptions='translucent')
+            self._structures[id] = [item, levels, {}]
+            self._set_level(id, self.level or min(levels))
+            self.addItem(item)
+        if not self._centered and len(meshes) > 0:
+            self.center_view()
+
+    def center_view(self):
+        """Point the camera at the center of all displayed structures.
+        """
+        verts = [levels[max(levels)][0] for item, levels, data in self._structures.values()]
+        verts = np.concatenate([v for v in verts if len(v) > 0] or [np.zeros((1, 3))])
+        lo, hi = verts.min(axis=0), verts.max(axis=0)
+        self.setCameraPosition(pos=pg.Vector(*((lo + hi) / 2.)), distance=2 * np.linalg.norm(hi - lo) + 10)
+        self._centered = True
+
+    def level_of_detail(self):
+        """Return the level of detail that matches the current zoom.
+        """
+        # size of one voxel (in pixels) at the camera's point of interest
+        px = self.height() / (2 * self.opts['distance'] * np.tan(np.radians(self.opts['fov']) / 2.))
+        levels = sorted(set(l for item, meshes, data in self._structures.values() for l in meshes))
+        coarse = [l for l in levels if l * px <= self.lod_pixels]
+        return coarse[-1] if len(coarse) > 0 else levels[0]
+
+    def _set_level(self, id, level):
+        item, meshes, data = self._structures[id]
+        if level not in data:
+            verts, faces = meshes[level]
+            data[level] = pgl.MeshData(vertexes=verts, faces=faces)
+        item.setMeshData(meshdata=data[level])
+
+    def paintGL(self, *args, **kwds):
+        # switch levels of detail before drawing if the zoom has changed
+        if len(self._structures) > 0:
+            level = self.level_of_detail()
+            if level != self.level:
+                self.level = level
+                for id in self._structures:
+                    self._set_level(id, level)
+        return pgl.GLViewWidget.paintGL(self, *args, **kwds)
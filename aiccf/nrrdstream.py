@@ -0,0 +1,134 @@
+"""Streaming access to large NRRD volumes.
+
+pynrrd reads (and decompresses) an entire volume at once. The functions here
+parse the header directly and then decode the payload one slab at a time, so
+that volumes larger than memory can be converted. Only 3D volumes stored in
+a single file with raw or gzip encoding are supported, which covers the
+files distributed by the Allen Institute.
+
+This module does not depend on Qt.
+"""
+import zlib
+import numpy as np
+
+
+NRRD_TYPES = {
+    'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+    'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+    'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+    'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+    'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+    'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+    'longlong': 'i8', 'long long': 'i8', 'long long int': 'i8', 'signed long long': 'i8',
+    'signed long long int': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+    'ulonglong': 'u8', 'unsigned long long': 'u8', 'unsigned long long int': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+    'float': 'f4', 'double': 'f8',
+}
+
+
+def read_header(filename):
+    """Return the header fields of the NRRD file *filename* as a dict.
+
+    Field names are lower case. 'sizes' is parsed to a list of ints and
+    'space directions' (if present) to a list of float vectors, with None
+    for 'none' entries; all other values are left as strings.
+    """
+    with open(filename, 'rb') as fh:
+        return _read_header(fh)
+
+
+def _read_header(fh):
+    # Parse the header and leave *fh* positioned at the start of the data
+    magic = fh.readline()
+    if not magic.startswith(b'NRRD'):
+        raise ValueError("%s is not a NRRD file." % getattr(fh, 'name', fh))
+    header = {}
+    while True:
+        line = fh.readline()
+        if len(line) == 0:
+            raise ValueError("Unexpected end of NRRD header.")
+        line = line.decode('ascii', 'replace').rstrip('\r\n')
+        if line == '':
+            break
+        if line.startswith('#') or ':=' in line:
+            # comments and key/value pairs
+            continue
+        key, sep, value = line.partition(':')
+        header[key.strip().lower()] = value.strip()
+
+    header['sizes'] = [int(x) for x in header['sizes'].split()]
+    if 'space directions' in header:
+        header['space directions'] = [None if v == 'none' else [float(x) for x in v.strip('()').split(',')]
+                                      for v in header['space directions'].split()]
+    return header
+
+
+def data_type(header):
+    """Return the numpy dtype of the data described by *header*.
+    """
+    dtype = np.dtype(NRRD_TYPES[header['type']])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder('>' if header.get('endian', 'little') == 'big' else '<')
+    return dtype
+
+
+def iter_slabs(filename, max_bytes=2**28, step=None, read_size=2**20):
+    """Iterate over the data of a 3D NRRD file in slabs along its last
+    (slowest varying) axis.
+
+    Yields (start, slab) pairs, where *slab* has shape (sizes[0], sizes[1], n)
+    and covers planes start to start+n (axes are in the same order as
+    returned by pynrrd). Each slab holds at most *max_bytes* of data (but at
+    least one plane), unless *step* sets the number of planes explicitly.
+
+    Slabs are views of a single buffer that is reused for the next slab, so
+    memory use does not depend on the size of the volume; copy a slab if it
+    must be kept.
+    """
+    with open(filename, 'rb') as fh:
+        header = _read_header(fh)
+        sizes = header['sizes']
+        if len(sizes) != 3:
+            raise ValueError("Expected a 3D volume; %s has sizes %s." % (filename, sizes))
+        if 'data file' in header or 'datafile' in header:
+            raise ValueError("NRRD files with detached data are not supported.")
+        if int(header.get('line skip', 0)) != 0 or int(header.get('byte skip', 0)) != 0:
+            raise ValueError("NRRD files with line skip or byte skip are not supported.")
+
+        encoding = header['encoding'].lower()
+        if encoding == 'raw':
+            decomp = None
+        elif encoding in ('gzip', 'gz'):
+            decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        else:
+            raise ValueError("Unsupported NRRD encoding '%s'." % encoding)
+
+        dtype = data_type(header)
+        plane = sizes[0] * sizes[1] * dtype.itemsize
+        if step is None:
+            step = max(1, int(max_bytes // plane))
+        step = min(step, sizes[2])
+        buf = np.empty(step * plane, dtype=np.ubyte)
+        for start in range(0, sizes[2], step):
+            n = min(step, sizes[2] - start)
+            out = buf[:n * plane]
+            _read_payload(fh, decomp, out, read_size)
+            yield start, out.view(dtype).reshape(n, sizes[1], sizes[0]).transpose(2, 1, 0)
+
+
+def _read_payload(fh, decomp, out, read_size):
+    # Fill the ubyte array *out* with the next len(out) bytes of decoded data
+    pos = 0
+    while pos < len(out):
+        if decomp is None:
+            chunk = fh.read(min(read_size, len(out) - pos))
+        else:
+            data = decomp.unconsumed_tail or fh.read(read_size)
+            if len(data) == 0:
+                raise IOError("Unexpected end of NRRD data.")
+            # limit the decoded chunk so that it does not double the slab's memory
+            chunk = decomp.decompress(data, min(read_size, len(out) - pos))
+        if decomp is None and len(chunk) == 0:
+            raise IOError("Unexpected end of NRRD data.")
+        out[pos:pos + len(chunk)] = np.frombuffer(chunk, dtype=np.ubyte)
+        pos += len(chunk)
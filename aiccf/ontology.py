@@ -0,0 +1,145 @@
+"""Hierarchy indexing and queries for the flat ontology table.
+
+The ontology is stored as a structured array with one row per structure and
+'id' / 'parent' columns. index_ontology() adds nested-set intervals so that
+subtree and ancestor queries become vectorized array operations instead of
+tree walks. Nothing in this module depends on Qt.
+"""
+import numpy as np
+
+
+def index_ontology(ontology):
+    """Return (ontology, ancestors) for a flat *ontology* table.
+
+    The returned ontology is a copy of the input with three extra int32
+    fields:
+
+    =====  =====================================================================
+    depth  Number of ancestors (0 for the root)
+    pre    Time at which a depth-first traversal enters the structure
+    post   Time at which the traversal leaves the structure
+    =====  =====================================================================
+
+    A structure is a descendant of (or equal to) X exactly when its
+    [pre, post] interval lies within X's. *ancestors* is an int array of
+    shape (len(ontology), max_depth+1) whose row i lists the row indices of
+    the ancestors of structure i from the root down, ending with i itself
+    and padded with -1.
+    """
+    n = len(ontology)
+    row_of = dict(zip(ontology['id'].tolist(), range(n)))
+    parent_rows = np.array([row_of.get(p, -1) for p in ontology['parent'].tolist()], dtype=int)
+
+    children = [[] for i in range(n)]
+    roots = []
+    for i, p in enumerate(parent_rows):
+        if p < 0:
+            roots.append(i)
+        else:
+            children[p].append(i)
+
+    depth = np.zeros(n, dtype='int32')
+    pre = np.zeros(n, dtype='int32')
+    post = np.zeros(n, dtype='int32')
+    clock = 0
+    stack = [(r, False) for r in reversed(roots)]
+    while len(stack) > 0:
+        i, leaving = stack.pop()
+        if leaving:
+            post[i] = clock
+        else:
+            pre[i] = clock
+            stack.append((i, True))
+            for c in reversed(children[i]):
+                depth[c] = depth[i] + 1
+                stack.append((c, False))
+        clock += 1
+
+    # fill the ancestor table one depth level at a time
+    max_depth = depth.max() if n > 0 else 0
+    ancestors = -np.ones((n, max_depth + 1), dtype=int)
+    for d in range(max_depth + 1):
+        rows = np.argwhere(depth == d)[:, 0]
+        if d > 0:
+            ancestors[rows, :d] = ancestors[parent_rows[rows], :d]
+        ancestors[rows, d] = rows
+
+    names = [name for name in ontology.dtype.names if name not in ('depth', 'pre', 'post')]
+    dtype = [(name, ontology.dtype[name]) for name in names] + [('depth', 'int32'), ('pre', 'int32'), ('post', 'int32')]
+    indexed = np.empty(n, dtype=dtype)
+    for name in names:
+        indexed[name] = ontology[name]
+    indexed['depth'] = depth
+    indexed['pre'] = pre
+    indexed['post'] = post
+    return indexed, ancestors
+
+
+def is_descendant(ontology, rows, ancestor_row, include_self=True):
+    """Return a boolean mask that is True where the structures at *rows* (an
+    array of row indices) are descendants of the structure at *ancestor_row*.
+    """
+    rows = np.asarray(rows)
+    pre = ontology['pre'][rows]
+    post = ontology['post'][rows]
+    a = ontology[ancestor_row]
+    if include_self:
+        return (pre >= a['pre']) & (post <= a['post'])
+    return (pre > a['pre']) & (post < a['post'])
+
+
+def descendant_rows(ontology, row, include_self=True):
+    """Return the row indices of all descendants of the structure at *row*.
+    """
+    return np.argwhere(is_descendant(ontology, np.arange(len(ontology)), row, include_self))[:, 0]
+
+
+def subtree_sums(ontology, values):
+    """Return a copy of *values* (an array with one entry or row per ontology
+    row) in which the entry of each structure is summed with the entries of
+    all of its descendants.
+    """
+    values = np.asarray(values)
+    n = len(ontology)
+    # in pre-order, every subtree is a contiguous run of rows
+    order = np.argsort(ontology['pre'])
+    pos = np.empty(n, dtype=int)
+    pos[order] = np.arange(n)
+    size = (ontology['post'] - ontology['pre'] + 1) // 2
+    csum = np.zeros((n + 1,) + values.shape[1:], dtype=np.result_type(values.dtype, np.int64))
+    np.cumsum(values[order], axis=0, out=csum[1:])
+    return csum[pos + size] - csum[pos]
+
+
+def row_lookup_table(ontology, size=2**16):
+    """Return a dense array mapping stored label values to ontology row
+    indices (-1 for values that are not in the ontology).
+    """
+    lut = -np.ones(size, dtype=int)
+    ids = ontology['id']
+    valid = (ids >= 0) & (ids < size)
+    lut[ids[valid]] = np.arange(len(ontology))[valid]
+    return lut
+
+
+def structure_paths(ontology, ancestors, field='acronym', sep='/', skip=0):
+    """Return an array holding, for each structure, the *field* values of its
+    ancestors from the root down (skipping the first *skip* levels) joined
+    by *sep*.
+    """
+    values = ontology[field].astype(str)
+    depth = ontology['depth']
+    return np.array([sep.join(values[ancestors[i, skip:depth[i]+1]]) for i in range(len(ontology))])
+
+
+def hex_colors(colors):
+    """Convert an array of 'rrggbb' color strings (such as the ontology
+    'color' field) to an (N, 4) ubyte array of opaque RGBA colors.
+    """
+    rgb = np.array([int(c, 16) for c in np.asarray(colors).astype(str)], dtype='uint32').reshape(-1)
+    out = np.empty((len(rgb), 4), dtype=np.ubyte)
+    out[:, 0] = (rgb >> 16) & 0xff
+    out[:, 1] = (rgb >> 8) & 0xff
+    out[:, 2] = rgb & 0xff
+    out[:, 3] = 255
+    return out
@@ -163,3 +163,91 @@ def aff_to_origin_and_vectors(M):
 # 
 # if __name__ == "__main__": main()
 
+
+# Batched versions of the functions above. These operate on stacks of N
+# planes / transforms at once and always use full (N,4,4) matrices.
+
+TVR_KEYS = ['tvr_%02d' % i for i in range(12)]
+TRV_KEYS = ['trv_%02d' % i for i in range(12)]
+
+def points_to_aff_batch(a, ab, ac):
+    """ 
+    Compute N 4x4 3D affine transforms (and their inverses) from N points and 2N vectors defining N planes.
+    *a*, *ab* and *ac* are (N,3) arrays; each plane is handled as in points_to_aff.
+
+    Returns
+    -------
+    M, M_inverse  (each with shape (N,4,4))
+    """
+    a = np.atleast_2d(np.asarray(a, dtype=float))
+    ab = np.atleast_2d(np.asarray(ab, dtype=float))
+    ac = np.atleast_2d(np.asarray(ac, dtype=float))
+    n = len(a)
+
+    # T * R * S, written out: scaled unit vectors are just ab and ac
+    uv0 = ab / np.linalg.norm(ab, axis=1)[:, None]
+    uv1 = ac / np.linalg.norm(ac, axis=1)[:, None]
+    M = np.zeros((n, 4, 4))
+    M[:, :3, 0] = ab
+    M[:, :3, 1] = ac
+    M[:, :3, 2] = np.cross(uv0, uv1)
+    M[:, :3, 3] = a
+    M[:, 3, 3] = 1
+
+    return np.linalg.inv(M), M
+
+def aff_to_lims_flat_batch(M):
+    """ flatten (N,4,4) or (N,3,4) arrays into an (N,12) array in the order expected by lims """
+    M = np.asarray(M)
+    return np.concatenate([M[:, :3, :3].reshape(len(M), 9), M[:, :3, 3]], axis=1)
+
+def lims_flat_to_aff_batch(F):
+    """ take an (N,12) array of vectors in the order expected by lims and convert it into (N,4,4) matrices """
+    F = np.asarray(F, dtype=float)
+    M = np.zeros((len(F), 4, 4))
+    M[:, :3, :3] = F[:, :9].reshape(len(F), 3, 3)
+    M[:, :3, 3] = F[:, 9:12]
+    M[:, 3, 3] = 1
+    return M
+
+def aff_to_lims_objs(M, Mi):
+    """ take (N,4,4) matrices and their inverses and produce a list of N dictionaries with fields named as lims expects them """
+    Mf = aff_to_lims_flat_batch(M).tolist()
+    Mif = aff_to_lims_flat_batch(Mi).tolist()
+    return [dict(list(zip(TVR_KEYS, mif)) + list(zip(TRV_KEYS, mf)))
+            for mf, mif in zip(Mf, Mif)]
+
+def lims_objs_to_aff(obs):
+    """ 
+    take N lims records and output (N,4,4) affine transform matrices and their inverses.
+
+    *obs* is either a sequence of dictionaries (as accepted by lims_obj_to_aff) or a single dictionary
+    mapping each lims field name to an array of N values (for example, columns from a database query).
+    """
+    if isinstance(obs, dict):
+        trv = np.column_stack([obs[k] for k in TRV_KEYS])
+        tvr = np.column_stack([obs[k] for k in TVR_KEYS])
+    else:
+        trv = np.array([[ob[k] for k in TRV_KEYS] for ob in obs], dtype=float).reshape(-1, 12)
+        tvr = np.array([[ob[k] for k in TVR_KEYS] for ob in obs], dtype=float).reshape(-1, 12)
+    return lims_flat_to_aff_batch(trv), lims_flat_to_aff_batch(tvr)
+
+def aff_to_origin_and_vectors_batch(M):
+    """ use (N,4,4) transforms to compute the origins and vectors describing N planes; returns three (N,3) arrays """
+    M = np.asarray(M)
+    a = M[:, :3, 3]
+    return a, M[:, :3, 0], M[:, :3, 1]
+
+def transform_points(M, points):
+    """ 
+    map points through stacked affine transforms.
+
+    *M* has shape (N,4,4) (or (N,3,4)) and *points* has shape (N,P,3): transform M[i] is applied to the P
+    points in points[i]. *points* may also have shape (N,3) (one point per transform). Returns transformed
+    points with the same shape as *points*.
+    """
+    M = np.asarray(M, dtype=float)
+    points = np.asarray(points, dtype=float)
+    if points.ndim == 2:
+        return np.einsum('nij,nj->ni', M[:, :3, :3], points) + M[:, :3, 3]
+    return np.einsum('nij,npj->npi', M[:, :3, :3], points) + M[:, None, :3, 3]
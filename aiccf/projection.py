@@ -0,0 +1,167 @@
+"""Per-structure projections of the atlas label volume.
+
+A projection of a structure along an axis is the 2D mask of all pixels where
+the structure appears anywhere along that axis. build_projections() computes
+the projections of every structure along all three axes in a single pass
+over the label volume, and ProjectionCache stores each of them as a
+bit-packed crop of its bounding box, so that an overview of any selection of
+structures is composited from a few small arrays instead of scanning the
+volume.
+
+Projections are made of the voxels labeled with each structure itself;
+composite a structure with its descendants to include them. This module does
+not depend on Qt.
+"""
+import numpy as np
+
+
+class ProjectionCache(object):
+    """Bit-packed projections of each ontology row along each axis of the
+    label volume (see build_projections).
+
+    *shape* is the shape of the label volume. For each axis, *bounds* is an
+    (n, 4) int array of (row_start, row_stop, col_start, col_stop) crops of
+    the projected image (all 0 if the structure is empty), *offsets* an
+    (n+1,) array of positions in *bits*, and *bits* the concatenated crops as
+    packed by numpy.packbits.
+    """
+    def __init__(self, shape, bounds, offsets, bits):
+        self.shape = tuple(shape)
+        self.bounds = bounds
+        self.offsets = offsets
+        self.bits = bits
+
+    def image_shape(self, axis):
+        """Return the shape of projections along *axis*.
+        """
+        return tuple(n for i, n in enumerate(self.shape) if i != axis)
+
+    def crop(self, axis, row):
+        """Return (bounds, mask) for the projection of ontology *row* along
+        *axis*, where *mask* is the boolean crop of the projected image
+        given by *bounds* (a tuple of two slices).
+        """
+        r0, r1, c0, c1 = self.bounds[axis][row]
+        offsets = self.offsets[axis]
+        n = (r1 - r0) * (c1 - c0)
+        mask = np.unpackbits(self.bits[axis][offsets[row]:offsets[row + 1]])[:n]
+        return (slice(r0, r1), slice(c0, c1)), mask.reshape(r1 - r0, c1 - c0).view(bool)
+
+    def mask(self, axis, rows):
+        """Return the union of the projections of ontology *rows* along *axis*
+        as a boolean image.
+        """
+        image = np.zeros(self.image_shape(axis), dtype=bool)
+        for row in rows:
+            bounds, mask = self.crop(axis, row)
+            image[bounds] |= mask
+        return image
+
+    def composite(self, axis, rows, colors, background=(0, 0, 0, 0)):
+        """Return an RGBA ubyte image of the projections of ontology *rows*
+        along *axis*, each painted with its color from *colors* (an (n, 4)
+        array indexed by row). Rows are painted in the given order, so later
+        rows cover earlier ones.
+        """
+        # paint row indices first, then look up all colors at once
+        n = len(self.bounds[axis])
+        top = np.empty(self.image_shape(axis), dtype='int32')
+        top[:] = n
+        for row in rows:
+            bounds, mask = self.crop(axis, row)
+            np.copyto(top[bounds], row, where=mask)
+        lut = np.empty((n + 1, 4), dtype=np.ubyte)
+        lut[:n] = colors
+        lut[n] = background
+        return lut[top]
+
+    def write(self, filename, **extra):
+        """Write the cache to *filename* (.npz). Any *extra* arrays are stored
+        as well.
+        """
+        arrays = dict(extra, shape=np.array(self.shape))
+        for ax in range(3):
+            arrays['bounds_%d' % ax] = self.bounds[ax]
+            arrays['offsets_%d' % ax] = self.offsets[ax]
+            arrays['bits_%d' % ax] = self.bits[ax]
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def read(cls, filename):
+        """Return (cache, extra) read from a file written by write(), where
+        *extra* is a dict of any extra arrays.
+        """
+        with np.load(filename) as data:
+            arrays = dict((name, data[name]) for name in data.files)
+        names = ['bounds', 'offsets', 'bits']
+        fields = [[arrays.pop('%s_%d' % (name, ax)) for ax in range(3)] for name in names]
+        cache = cls(arrays.pop('shape'), *fields)
+        return cache, arrays
+
+
+def build_projections(label, row_lut, n, max_voxels=2**22, merge_size=2**24, progress=None):
+    """Return a ProjectionCache with the projections of the *n* ontology rows
+    along each axis of the 3D *label* volume (an ndarray or LazyVolume).
+
+    *row_lut* maps label values to ontology rows (-1 for values that are not
+    structures; see row_lookup_table). The volume is read once, in slabs of
+    about *max_voxels* along the first axis. For each axis, the distinct
+    (row, pixel) pairs found in each slab are collected and merged once more
+    than *merge_size* of them are pending. *progress(done, total)* is called
+    after each slab if given; it may raise an exception to cancel.
+    """
+    shape = label.shape
+    image_shapes = [tuple(s for i, s in enumerate(shape) if i != ax) for ax in range(3)]
+    sizes = [a * b for a, b in image_shapes]
+    found = [np.zeros(0, dtype='int64') for ax in range(3)]
+    pending = [[] for ax in range(3)]
+
+    step = max(1, max_voxels // (shape[1] * shape[2]))
+    for start in range(0, shape[0], step):
+        stop = min(start + step, shape[0])
+        rows = row_lut[np.asarray(label[start:stop])].astype('int64')
+        i, j, k = np.ogrid[start:stop, 0:shape[1], 0:shape[2]]
+        # pixel index of each voxel in the projection along each axis
+        pixels = [j * shape[2] + k, i * shape[2] + k, i * shape[1] + j]
+        valid = rows >= 0
+        for ax in range(3):
+            codes = (rows * sizes[ax] + pixels[ax])[valid]
+            pending[ax].append(np.unique(codes))
+            if sum(len(p) for p in pending[ax]) > merge_size:
+                found[ax] = np.unique(np.concatenate([found[ax]] + pending[ax]))
+                pending[ax] = []
+        if progress is not None:
+            progress(stop, shape[0])
+
+    bounds, offsets, bits = [], [], []
+    for ax in range(3):
+        codes = np.unique(np.concatenate([found[ax]] + pending[ax]))
+        b, o, p = _pack_projections(codes, n, image_shapes[ax])
+        bounds.append(b)
+        offsets.append(o)
+        bits.append(p)
+    return ProjectionCache(shape, bounds, offsets, bits)
+
+
+def _pack_projections(codes, n, image_shape):
+    # Convert sorted row * size + pixel codes to cropped, bit-packed masks
+    size = image_shape[0] * image_shape[1]
+    rows = codes // size
+    starts = np.searchsorted(rows, np.arange(n + 1))
+    bounds = np.zeros((n, 4), dtype='int32')
+    offsets = np.zeros(n + 1, dtype='int64')
+    packed = []
+    for row in range(n):
+        pixels = codes[starts[row]:starts[row + 1]] - row * size
+        if len(pixels) > 0:
+            r, c = pixels // image_shape[1], pixels % image_shape[1]
+            r0, c0 = r.min(), c.min()
+            crop = np.zeros((r.max() + 1 - r0, c.max() + 1 - c0), dtype=bool)
+            crop[r - r0, c - c0] = True
+            bounds[row] = r0, r0 + crop.shape[0], c0, c0 + crop.shape[1]
+            packed.append(np.packbits(crop.ravel()))
+            offsets[row + 1] = offsets[row] + len(packed[-1])
+        else:
+            offsets[row + 1] = offsets[row]
+    bits = np.concatenate(packed) if len(packed) > 0 else np.zeros(0, dtype=np.ubyte)
+    return bounds, offsets, bits
@@ -1,35 +1,470 @@
+"""Extraction of 2D/3D slices from atlas volumes.
+
+This module does not depend on Qt, so slices can be extracted from scripts
+and worker processes without a running user interface.
+"""
+import os, json, multiprocessing
+from collections import OrderedDict
+import numpy as np
+import scipy.ndimage
+
+from .volume import LazyVolume
+from .points_to_aff import points_to_aff_batch, aff_to_lims_objs, lims_objs_to_aff, aff_to_origin_and_vectors_batch
+
+
+def affine_slice(data, shape, origin, vectors, axes, order=1, **kwds):
+    """Take a slice of any orientation through *data*.
+
+    Arguments and result are the same as for pyqtgraph.affineSlice: *shape*
+    gives the number of samples along each slice axis, *origin* is the
+    location of the first sample, and *vectors* are the steps between samples
+    along each slice axis, all expressed in the coordinates of the data
+    *axes*. Extra keyword arguments are passed to
+    scipy.ndimage.map_coordinates.
+
+    When *data* is not an ndarray (for example a LazyVolume backed by a file
+    on disk), only the bounding box of the sampled region is read.
+    """
+    shape = tuple(int(np.ceil(n)) for n in shape)
+    origin = np.array(origin, dtype=float).reshape(len(axes))
+    vectors = np.array(vectors, dtype=float).reshape(len(shape), len(axes))
+
+    if not isinstance(data, np.ndarray):
+        data, origin = _read_bounding_box(data, shape, origin, vectors, axes, order)
+
+    # transpose data so slice axes come first
+    other = [ax for ax in range(data.ndim) if ax not in axes]
+    tr1 = tuple(axes) + tuple(other)
+    data = data.transpose(tr1)
+    extra = data.shape[len(axes):]
+
+    # sample locations along the slice axes
+    grid = np.indices(shape, dtype=float)
+    x = np.tensordot(vectors.T, grid, axes=1) + origin.reshape((len(axes),) + (1,) * len(shape))
+
+    # add integer coordinates for the remaining axes so that the entire
+    # region is sampled in a single call
+    coords = np.empty((data.ndim,) + shape + extra)
+    coords[:len(axes)] = x.reshape(x.shape + (1,) * len(extra))
+    for i, n in enumerate(extra):
+        ind_shape = [1] * (len(shape) + len(extra))
+        ind_shape[len(shape) + i] = n
+        coords[len(axes) + i] = np.arange(n).reshape(ind_shape)
+
+    output = scipy.ndimage.map_coordinates(data, coords, order=order, **kwds)
+
+    # move any axes that preceded the first slice axis back to the front
+    tr = list(range(output.ndim))
+    trb = []
+    for i in range(min(axes)):
+        ind = tr1.index(i) + (len(shape) - len(axes))
+        tr.remove(ind)
+        trb.append(ind)
+    return output.transpose(trb + tr)
+
+
+def _read_bounding_box(data, shape, origin, vectors, axes, order):
+    # Read the region of *data* needed to sample a slice (plus a margin for
+    # interpolation) and return it with the origin shifted to match.
+    corners = []
+    for corner in np.ndindex(*([2] * len(shape))):
+        corners.append(origin + np.dot(np.array(corner) * (np.array(shape) - 1), vectors))
+    corners = np.array(corners)
+
+    index = [slice(None)] * data.ndim
+    offset = np.zeros(len(axes))
+    for i, ax in enumerate(axes):
+        lo = int(np.floor(corners[:, i].min())) - order
+        hi = int(np.ceil(corners[:, i].max())) + order + 1
+        lo = min(max(lo, 0), data.shape[ax])
+        hi = min(max(hi, lo), data.shape[ax])
+        index[ax] = slice(lo, hi)
+        offset[i] = lo
+    return np.asarray(data[tuple(index)]), origin - offset
 
 
 class CCFAtlasSlice(object):
     """Represents a 2D or 3D slice through volumetric atlas data.
-    
+
     The slice specifies the position and orientation of a plane or rectangular
     slice, and manages extracting data from the volume as well as generating
-    the relevant coordinate transforms. 
+    the relevant coordinate transforms.
+
+    Slices are given in atlas voxel coordinates, with axes (anterior, dorsal,
+    right): *shape* is the number of samples along each slice axis, *origin*
+    is the position of the first sample, and *vectors* are the steps (in
+    voxels) between samples along each slice axis.
     """
-    def __init__(self, atlas_data):
+    def __init__(self, atlas_data=None, shape=None, origin=None, vectors=None):
         self.atlas_data = atlas_data
-        self.shape = shape
-        self.origin = origin
-        self.vectors = vectors
-    
+        self.shape = None
+        self.origin = None
+        self.vectors = None
+        if shape is not None:
+            self.set_slice(shape, origin, vectors)
+
     def set_atlas_data(self, atlas):
         self.atlas_data = atlas
-    
+
     def set_slice(self, shape, origin, vectors):
+        shape = tuple(int(n) for n in shape)
+        origin = np.array(origin, dtype=float)
+        vectors = np.array(vectors, dtype=float).reshape(len(shape), 3)
+        if origin.shape != (3,):
+            raise ValueError("Slice origin must be a 3D point (got %r)" % (origin,))
         self.shape = shape
         self.origin = origin
         self.vectors = vectors
-    
+
+    def get_image(self, order=1):
+        """Return the atlas image sampled on this slice, using spline
+        interpolation of the given *order*.
+        """
+        return extract_slice(self.atlas_data.image_volume(), self.shape, self.origin, self.vectors, order=order)
+
+    def get_label(self):
+        """Return the atlas labels sampled on this slice (nearest neighbor).
+        """
+        return extract_slice(self.atlas_data.label_volume(), self.shape, self.origin, self.vectors, order=0)
+
     def atlas_transform(self):
         """Return a transform that maps from the 2D/3D coordinates of the slice
         to the 3D voxel coordinates of the atlas.
+
+        The transform is returned as a 4x4 affine matrix.
         """
+        m = np.eye(4)
+        m[:3, :len(self.shape)] = self.vectors.T
+        m[:3, 3] = self.origin
+        return m
 
     def ccf_transform(self):
-        return self.atlas_transform() * self.atlas_data.ccf_transform()
+        return np.dot(self.atlas_data.ccf_transform(), self.atlas_transform())
+
+
+def extract_slice(volume, shape, origin, vectors, order=1):
+    """Sample the 3D *volume* on the slice described by *shape*, *origin*, and
+    *vectors* (see CCFAtlasSlice). The result has the given *shape*.
+    """
+    return affine_slice(volume, shape=shape, origin=origin, vectors=vectors, axes=(0, 1, 2), order=order)
+
+
+def extract_slices(atlas_data, slices, order=1, labels=True, processes=None, chunksize=4):
+    """Extract many slices from *atlas_data* using a pool of worker processes.
+
+    *slices* is a sequence of CCFAtlasSlice instances or (shape, origin,
+    vectors) tuples. Images are interpolated with spline *order*; labels (if
+    requested) use nearest-neighbor sampling. *processes* is the number of
+    worker processes (default is the number of CPUs); use 1 to extract in the
+    calling process.
+
+    Returns a list with one (image, label) tuple per slice; label is None if
+    *labels* is False.
+    """
+    tasks = []
+    for s in slices:
+        if isinstance(s, CCFAtlasSlice):
+            s = (s.shape, s.origin, s.vectors)
+        tasks.append(tuple(s) + (order, labels))
+
+    image = atlas_data.image_volume()
+    label = atlas_data.label_volume() if labels else None
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes <= 1 or len(tasks) <= 1:
+        _init_worker(image, label)
+        try:
+            return [_extract_worker(task) for task in tasks]
+        finally:
+            _init_worker(None, None)
+
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(image, label))
+    try:
+        return pool.map(_extract_worker, tasks, chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+_worker_volumes = (None, None)
+
 
-    def stereotaxic_transform(self):
-        return self.atlas_transform() * self.atlas_data.stereotaxic_transform()
+def _init_worker(image, label):
+    # Each worker needs its own handle on disk-backed volumes
+    global _worker_volumes
+    if isinstance(image, LazyVolume):
+        image = image.reopen()
+    if isinstance(label, LazyVolume):
+        label = label.reopen()
+    _worker_volumes = (image, label)
 
 
+def _extract_worker(task):
+    shape, origin, vectors, order, labels = task
+    image, label = _worker_volumes
+    img = extract_slice(image, shape, origin, vectors, order=order)
+    lbl = extract_slice(label, shape, origin, vectors, order=0) if labels else None
+    return img, lbl
+
+
+def parallel_sections(shape, origin, vectors, count, spacing):
+    """Return (origins, vectors) for a stack of *count* 2D sections parallel to
+    the section described by *shape*, *origin*, and *vectors* (see
+    CCFAtlasSlice), *spacing* voxels apart along its normal and centered on
+    it. *origins* has shape (count, 3) and *vectors* shape (count, 2, 3).
+    """
+    origin = np.asarray(origin, dtype=float)
+    vectors = np.asarray(vectors, dtype=float).reshape(2, 3)
+    normal = np.cross(vectors[0], vectors[1])
+    normal /= np.linalg.norm(normal)
+    offsets = (np.arange(count) - (count - 1) / 2.) * spacing
+    origins = origin[None, :] + offsets[:, None] * normal[None, :]
+    return origins, np.repeat(vectors[None], count, axis=0)
+
+
+def fan_sections(shape, origin, vectors, angles, axis=0):
+    """Return (origins, vectors) for a fan of 2D sections obtained by rotating
+    the section described by *shape*, *origin*, and *vectors* by each of
+    *angles* (degrees) about the line through its center along
+    vectors[*axis*]. See parallel_sections for the shape of the result.
+    """
+    origin = np.asarray(origin, dtype=float)
+    vectors = np.asarray(vectors, dtype=float).reshape(2, 3)
+    extent = (np.array(shape, dtype=float) - 1)[:, None] * vectors
+    center = origin + 0.5 * extent.sum(axis=0)
+    k = vectors[axis] / np.linalg.norm(vectors[axis])
+    origins, rotated = [], []
+    for angle in np.radians(angles):
+        # Rodrigues' rotation of both vectors about k
+        v = vectors * np.cos(angle) + np.cross(k, vectors) * np.sin(angle) + \
+            np.dot(vectors, k)[:, None] * k[None, :] * (1 - np.cos(angle))
+        rotated.append(v)
+        origins.append(center - 0.5 * ((np.array(shape, dtype=float) - 1)[:, None] * v).sum(axis=0))
+    return np.array(origins).reshape(-1, 3), np.array(rotated).reshape(-1, 2, 3)
+
+
+def iter_sections(volume, shape, origins, vectors, order=1, max_bytes=2**27):
+    """Sample the 3D *volume* on a stack of 2D sections that share the same
+    *shape*, with per-section *origins* (N, 3) and *vectors* (N, 2, 3) (see
+    parallel_sections).
+
+    Yields (start, sections) pairs, where *sections* has shape
+    (n,) + shape and holds sections start to start+n. Each block of sections
+    is sampled with a single scipy.ndimage.map_coordinates call, and holds at
+    most about *max_bytes* of coordinates and data. When *volume* is not an
+    ndarray (for example a LazyVolume), only the bounding box of each block
+    is read.
+    """
+    shape = tuple(int(n) for n in shape)
+    origins = np.asarray(origins, dtype=float).reshape(-1, 3)
+    vectors = np.asarray(vectors, dtype=float).reshape(-1, 2, 3)
+    # 3 float64 coordinates plus the output value per sample
+    step = max(1, int(max_bytes // (shape[0] * shape[1] * 32)))
+    grid = np.indices(shape, dtype=float)
+    for start in range(0, len(origins), step):
+        stop = min(start + step, len(origins))
+        o, v = origins[start:stop], vectors[start:stop]
+        # coords[axis, section, i, j] = origin + i * v0 + j * v1
+        coords = (o.T[:, :, None, None] + v[:, 0].T[:, :, None, None] * grid[0] +
+                  v[:, 1].T[:, :, None, None] * grid[1])
+        data = volume
+        if not isinstance(volume, np.ndarray):
+            index = []
+            for ax in range(3):
+                lo = min(max(int(np.floor(coords[ax].min())) - order, 0), volume.shape[ax])
+                hi = min(max(int(np.ceil(coords[ax].max())) + order + 1, lo), volume.shape[ax])
+                index.append(slice(lo, hi))
+                coords[ax] -= lo
+            data = np.asarray(volume[tuple(index)])
+        if min(data.shape) == 0:
+            # block lies entirely outside the volume
+            yield start, np.zeros((stop - start,) + shape, dtype=data.dtype)
+            continue
+        yield start, scipy.ndimage.map_coordinates(data, coords, order=order)
+
+
+def section_transforms(ccf_transform, shape, origins, vectors):
+    """Return a list of LIMS transform dicts (see points_to_aff.aff_to_lims_obj)
+    for a stack of sections, mapping each section to CCF coordinates (um).
+
+    *ccf_transform* maps atlas voxel coordinates to CCF coordinates in
+    meters (see CCFAtlasData.ccf_transform). As in the viewer, [1, 0, 0] in
+    section coordinates is the far end of the second section axis (along
+    the slicing line) and [0, 1, 0] that of the first. section_geometry()
+    reverses this mapping; the viewer uses both for the transforms it copies
+    to and reads from the clipboard.
+    """
+    m = np.asarray(ccf_transform, dtype=float) * 1e6
+    origins = np.asarray(origins, dtype=float).reshape(-1, 3)
+    vectors = np.asarray(vectors, dtype=float).reshape(-1, 2, 3)
+    a = np.dot(origins, m[:3, :3].T) + m[:3, 3]
+    ab = np.dot(vectors[:, 1] * shape[1], m[:3, :3].T)
+    ac = np.dot(vectors[:, 0] * shape[0], m[:3, :3].T)
+    return aff_to_lims_objs(*points_to_aff_batch(a, ab, ac))
+
+
+def section_geometry(ccf_transform, transforms):
+    """Return (origins, axes) in atlas voxel coordinates for a list of LIMS
+    transform dicts, as made by section_transforms().
+
+    *origins* has shape (N, 3) and *axes* (N, 2, 3), where axes[i] are the
+    full-length axes of section i (the *vectors* given to
+    section_transforms, each multiplied by the section shape along it).
+    """
+    m = np.array(ccf_transform, dtype=float)
+    m[:3] *= 1e6
+    mi = np.linalg.inv(m)
+    a, ab, ac = aff_to_origin_and_vectors_batch(lims_objs_to_aff(transforms)[1])
+    origins = np.dot(a, mi[:3, :3].T) + mi[:3, 3]
+    axes = np.stack([np.dot(ac, mi[:3, :3].T), np.dot(ab, mi[:3, :3].T)], axis=1)
+    return origins, axes
+
+
+def write_section_stack(filename, volume, shape, origins, vectors, order=1, ccf_transform=None,
+                        max_bytes=2**27, progress=None):
+    """Sample *volume* on a stack of sections (see iter_sections) and write
+    it to *filename* one block at a time, as a (N,) + shape array (.npy) or a
+    multi-page TIFF (.tif or .tiff; requires tifffile).
+
+    The geometry of each section (origin and vectors in atlas voxels, plus
+    its LIMS transform if *ccf_transform* is given; see section_transforms)
+    is written to *filename* + '.json'. *progress(done, total)* is called
+    after each block and may raise an exception to cancel. Returns the list
+    of section records.
+    """
+    origins = np.asarray(origins, dtype=float).reshape(-1, 3)
+    vectors = np.asarray(vectors, dtype=float).reshape(-1, 2, 3)
+    count = len(origins)
+    shape = tuple(int(n) for n in shape)
+    dtype = np.dtype(volume.dtype)
+    blocks = iter_sections(volume, shape, origins, vectors, order=order, max_bytes=max_bytes)
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.npy':
+        out = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(count,) + shape)
+        for start, sections in blocks:
+            out[start:start + len(sections)] = sections
+            if progress is not None:
+                progress(start + len(sections), count)
+        out.flush()
+        del out
+    elif ext in ('.tif', '.tiff'):
+        import tifffile
+        with tifffile.TiffWriter(filename, bigtiff=True) as tif:
+            # TiffWriter.save was renamed to write in newer versions of tifffile
+            write = getattr(tif, 'write', None) or tif.save
+            for start, sections in blocks:
+                for section in sections:
+                    write(section)
+                if progress is not None:
+                    progress(start + len(sections), count)
+    else:
+        raise ValueError("Section stacks can be written to .npy or .tif files (got %s)." % filename)
+
+    records = [{'index': i, 'origin': origins[i].tolist(), 'vectors': vectors[i].tolist()} for i in range(count)]
+    if ccf_transform is not None:
+        for record, lims in zip(records, section_transforms(ccf_transform, shape, origins, vectors)):
+            record['lims'] = lims
+    with open(filename + '.json', 'w') as fh:
+        json.dump({'shape': list(shape), 'sections': records}, fh, indent=1)
+    return records
+
+
+def extract_section_stack(atlas_data, filename, shape, origins, vectors, order=1, labels=False,
+                          max_bytes=2**27, progress=None):
+    """Write the atlas image sampled on a stack of sections (see
+    parallel_sections and fan_sections) to *filename* with the LIMS
+    transform of each section (see write_section_stack). If *labels* is True,
+    the atlas labels (nearest neighbor) are written as well, to the same
+    file name with '_label' added before the extension.
+
+    Returns the list of section records.
+    """
+    ccf = atlas_data.ccf_transform()
+    total = len(origins) * (2 if labels else 1)
+    def image_progress(done, count):
+        if progress is not None:
+            progress(done, total)
+    records = write_section_stack(filename, atlas_data.image_volume(), shape, origins, vectors, order=order,
+                                  ccf_transform=ccf, max_bytes=max_bytes, progress=image_progress)
+    if labels:
+        def label_progress(done, count):
+            if progress is not None:
+                progress(count + done, total)
+        base, ext = os.path.splitext(filename)
+        write_section_stack(base + '_label' + ext, atlas_data.label_volume(), shape, origins, vectors, order=0,
+                            ccf_transform=ccf, max_bytes=max_bytes, progress=label_progress)
+    return records
+
+
+class SliceCache(object):
+    """Bounded LRU cache of extracted slices, keyed by slice geometry.
+
+    Keys are built with key(), which rounds floating point values to
+    *precision* so that nearly identical geometries share an entry. Values
+    are tuples of arrays; the least recently used entries are evicted once
+    the total size of cached arrays exceeds *max_bytes*.
+    """
+    def __init__(self, max_bytes=256e6, precision=1e-3):
+        self.max_bytes = max_bytes
+        self.precision = precision
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *args):
+        """Return a hashable key built from *args*, which may contain nested
+        sequences and arrays of numbers.
+        """
+        return self._quantize(args)
+
+    def _quantize(self, obj):
+        if isinstance(obj, (str, bytes, type(u''))):
+            return obj
+        if isinstance(obj, (float, np.floating)):
+            return int(np.round(obj / self.precision))
+        if isinstance(obj, (int, np.integer, bool)):
+            return int(obj)
+        if isinstance(obj, dict):
+            return tuple((k, self._quantize(obj[k])) for k in sorted(obj))
+        if hasattr(obj, '__len__'):
+            return tuple(self._quantize(x) for x in obj)
+        return obj
+
+    def get(self, key):
+        """Return the cached value for *key*, or None if it is not cached.
+        """
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value, nbytes = self._entries.pop(key)
+        self._entries[key] = (value, nbytes)
+        return value
+
+    def put(self, key, value):
+        """Store a tuple of arrays under *key*, evicting old entries as needed.
+        Values larger than max_bytes are not cached.
+        """
+        nbytes = sum(getattr(v, 'nbytes', 0) for v in value)
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        if nbytes > self.max_bytes:
+            return
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            k, (v, n) = self._entries.popitem(last=False)
+            self.nbytes -= n
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Return a dict with hit/miss counts and current memory usage.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
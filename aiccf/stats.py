@@ -0,0 +1,90 @@
+"""Per-structure statistics of the atlas label volume.
+
+structure_statistics() makes a single pass over the label volume (and,
+optionally, the template image), one slab at a time. For each axis it
+accumulates a histogram of voxel coordinates per structure with a single
+bincount; voxel counts, centroids, and bounding boxes all follow from these
+histograms, and because histograms add up, the statistics of each structure
+can include its descendants by summing over the ontology hierarchy.
+
+This module does not depend on Qt.
+"""
+from collections import OrderedDict
+import numpy as np
+
+from .ontology import subtree_sums
+
+
+# Columns returned by structure_statistics. Coordinates are voxel indices
+# along the (anterior, dorsal, right) axes of the atlas volumes.
+STAT_COLUMNS = [
+    'count',            # voxels in the structure and its descendants
+    'own_count',        # voxels labeled with the structure itself
+    'volume_mm3',       # count in cubic millimeters
+    'centroid_0', 'centroid_1', 'centroid_2',
+    'min_0', 'min_1', 'min_2',     # bounding box (inclusive); -1 if empty
+    'max_0', 'max_1', 'max_2',
+    'mean_intensity',   # mean template intensity; NaN if empty or no image
+]
+
+
+def structure_statistics(label, ontology, row_lut, vxsize, image=None, max_voxels=2**22, progress=None):
+    """Return an OrderedDict {column: array} of statistics (see STAT_COLUMNS)
+    with one entry per row of *ontology* (which must be indexed; see
+    index_ontology). Statistics of each structure include all of its
+    descendants, except for 'own_count'.
+
+    *label* is the 3D label volume (an ndarray or LazyVolume), *row_lut* maps
+    label values to ontology rows (-1 for values that are not structures;
+    see row_lookup_table), and *vxsize* is the voxel size in meters. If the
+    template *image* (same shape as *label*) is given, the mean intensity of
+    each structure is computed as well.
+
+    The volumes are read in slabs of about *max_voxels* along the first axis.
+    *progress(done, total)* is called after each slab if given; it may raise
+    an exception to cancel.
+    """
+    n = len(ontology)
+    shape = label.shape
+    # coordinate histograms per axis, flattened as row * length + coordinate;
+    # row n collects background and unknown labels
+    hists = [np.zeros((n + 1) * length, dtype='int64') for length in shape]
+    intensity = np.zeros(n + 1)
+    coords = [None, np.arange(shape[1])[None, :, None], np.arange(shape[2])[None, None, :]]
+
+    step = max(1, max_voxels // (shape[1] * shape[2]))
+    for start in range(0, shape[0], step):
+        stop = min(start + step, shape[0])
+        rows = row_lut[np.asarray(label[start:stop])]
+        rows[rows < 0] = n
+        coords[0] = np.arange(start, stop)[:, None, None]
+        for ax, length in enumerate(shape):
+            hists[ax] += np.bincount((rows * length + coords[ax]).ravel(), minlength=(n + 1) * length)
+        if image is not None:
+            weights = np.asarray(image[start:stop], dtype=float).ravel()
+            intensity += np.bincount(rows.ravel(), weights=weights, minlength=n + 1)
+        if progress is not None:
+            progress(stop, shape[0])
+
+    hists = [h.reshape(n + 1, length)[:n] for h, length in zip(hists, shape)]
+    stats = OrderedDict()
+    stats['own_count'] = hists[0].sum(axis=1)
+    hists = [subtree_sums(ontology, h) for h in hists]
+    count = hists[0].sum(axis=1)
+    empty = count == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroids = [np.dot(h, np.arange(h.shape[1])) / count for h in hists]
+        mean_intensity = subtree_sums(ontology, intensity[:n]) / count
+    if image is None:
+        mean_intensity[:] = np.nan
+
+    stats['count'] = count
+    stats['volume_mm3'] = count * (vxsize * 1e3)**3
+    for ax in range(3):
+        stats['centroid_%d' % ax] = centroids[ax]
+    for ax, h in enumerate(hists):
+        present = h > 0
+        stats['min_%d' % ax] = np.where(empty, -1, np.argmax(present, axis=1))
+        stats['max_%d' % ax] = np.where(empty, -1, h.shape[1] - 1 - np.argmax(present[:, ::-1], axis=1))
+    stats['mean_intensity'] = mean_intensity
+    return OrderedDict((name, stats[name]) for name in STAT_COLUMNS)
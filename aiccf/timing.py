@@ -0,0 +1,171 @@
+"""Lightweight timing instrumentation for interactive hot paths.
+
+An EventTimer collects the duration of named events (for example, each call
+to AtlasSliceView.update_slice_image). While it is disabled, timing an
+event costs one method call, so instrumentation can stay in place
+permanently. When enabled, it keeps rolling statistics per event, a log of
+individual records that can be exported as JSON or as a Chrome trace
+(chrome://tracing, Perfetto), and calls any registered callbacks.
+
+This module does not depend on Qt.
+"""
+import os, json, threading
+from collections import deque, OrderedDict
+from timeit import default_timer
+import numpy as np
+
+
+class EventTimer(object):
+    """Collects timing records for named events.
+
+    Usage::
+
+        timer = EventTimer()
+        timer.enabled = True
+        with timer.time('update_slice_image'):
+            ...
+
+    *window* is the number of recent durations per event used for the rolling
+    statistics, and *max_records* the number of records kept for export.
+    """
+    def __init__(self, window=200, max_records=100000):
+        self.enabled = False
+        self.window = window
+        self.records = deque(maxlen=max_records)
+        self.callbacks = []
+        self._durations = OrderedDict()
+        self._last_frame = {}
+        self._lock = threading.Lock()
+
+    def time(self, name):
+        """Return a context manager that records the time spent in its block
+        as an event called *name* (nothing is recorded while disabled).
+        """
+        if not self.enabled:
+            return _null_span
+        return _Span(self, name)
+
+    def record(self, name, start, duration):
+        """Record an event called *name* that started at *start* (a
+        timeit.default_timer value) and took *duration* seconds.
+
+        Registered callbacks are called as callback(name, start, duration), in
+        the thread that recorded the event.
+        """
+        with self._lock:
+            durations = self._durations.get(name)
+            if durations is None:
+                durations = self._durations[name] = deque(maxlen=self.window)
+            durations.append(duration)
+            self.records.append((name, start, duration, threading.current_thread().ident))
+        for callback in self.callbacks:
+            callback(name, start, duration)
+
+    def frame(self, name='frame', max_interval=1.0):
+        """Mark the end of a frame. The interval since the previous frame
+        with the same *name* is recorded as an event, unless it is longer
+        than *max_interval* seconds (the display was idle in between).
+        """
+        if not self.enabled:
+            return
+        now = default_timer()
+        last = self._last_frame.get(name)
+        self._last_frame[name] = now
+        if last is not None and now - last <= max_interval:
+            self.record(name, last, now - last)
+
+    def add_callback(self, callback):
+        """Call *callback(name, start, duration)* for every recorded event.
+        """
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def clear(self):
+        """Discard all records and statistics.
+        """
+        with self._lock:
+            self.records.clear()
+            self._durations.clear()
+            self._last_frame.clear()
+
+    def stats(self):
+        """Return an OrderedDict {name: {'count', 'mean', 'median', 'p95',
+        'max'}} of durations (in seconds) over the last *window* events of
+        each name. 'count' is the number of events in the window.
+        """
+        with self._lock:
+            durations = [(name, np.array(d)) for name, d in self._durations.items()]
+        stats = OrderedDict()
+        for name, d in durations:
+            if len(d) == 0:
+                continue
+            stats[name] = {'count': len(d), 'mean': float(d.mean()), 'median': float(np.median(d)),
+                           'p95': float(np.percentile(d, 95)), 'max': float(d.max())}
+        return stats
+
+    def summary(self):
+        """Return the rolling statistics as a text table in milliseconds.
+        Frame events (see frame()) are also shown as frames per second.
+        """
+        lines = ["%-26s %5s %8s %8s %8s" % ('event (ms)', 'n', 'mean', 'p95', 'max')]
+        for name, s in self.stats().items():
+            line = "%-26s %5d %8.2f %8.2f %8.2f" % (name, s['count'], s['mean'] * 1e3, s['p95'] * 1e3, s['max'] * 1e3)
+            if name in self._last_frame:
+                line += "  (%0.1f fps)" % (1.0 / max(s['mean'], 1e-6))
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def write_json(self, filename):
+        """Write all records and the current statistics to *filename* as JSON:
+        {'records': [{'name', 'start', 'duration', 'thread'}, ...], 'stats': {...}}.
+        """
+        with self._lock:
+            records = list(self.records)
+        data = {
+            'records': [{'name': name, 'start': start, 'duration': duration, 'thread': tid}
+                        for name, start, duration, tid in records],
+            'stats': self.stats(),
+        }
+        with open(filename, 'w') as fh:
+            json.dump(data, fh, indent=1)
+
+    def write_chrome_trace(self, filename):
+        """Write all records to *filename* in the Chrome trace event format,
+        which can be loaded in chrome://tracing or https://ui.perfetto.dev.
+        """
+        with self._lock:
+            records = list(self.records)
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6, 'pid': pid, 'tid': tid}
+                  for name, start, duration, tid in records]
+        with open(filename, 'w') as fh:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh)
+
+
+class _Span(object):
+    # Times one event for EventTimer.time()
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, self.start, default_timer() - self.start)
+        return False
+
+
+class _NullSpan(object):
+    # Returned by EventTimer.time() while the timer is disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_span = _NullSpan()
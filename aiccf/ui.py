@@ -1,14 +1,11 @@
-import os, sys
+import os, sys, threading
 import numpy as np
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
 import pyqtgraph.functions as fn
-from .signal import SignalBlock
-
-if sys.version[0] > '2':
-    from urllib.request import urlopen
-else:
-    from urllib import urlopen
+from .slice import affine_slice, SliceCache
+from .ontology import index_ontology, descendant_rows, hex_colors, structure_paths
+from .timing import EventTimer
 
 
 class AtlasSliceView(QtCore.QObject):
@@ -21,6 +18,8 @@ class AtlasSliceView(QtCore.QObject):
     * A HistogramLUTItem used to control color/contrast in both images
     * An AtlasDisplayCtrl that sets options for how all elements are drawn
     * A LabelTree that is used to selectively color specific brain regions
+    * A TimingOverlay that shows timing statistics from *timer* (an
+      EventTimer; see set_timing)
     
     These are stored as attributes of this object and are not inserted into
     any top-level layout. 
@@ -36,15 +35,31 @@ class AtlasSliceView(QtCore.QObject):
 
         self.scale = None
         self.interpolate = True
+
+        # timing instrumentation of the hot paths; disabled by default
+        self.timer = EventTimer()
+        self.timing_overlay = TimingOverlay(self.timer)
         
-        self.img1 = AtlasImageItem()
-        self.img2 = AtlasImageItem()
+        self.img1 = AtlasImageItem(timer=self.timer, name='ortho')
+        self.img2 = AtlasImageItem(timer=self.timer, name='slice')
         self.img1.mouseHovered.connect(self.mouseHovered)
         self.img2.mouseHovered.connect(self.mouseHovered)
         
         self.line_roi = RulerROI([.005, 0], [.008, 0], angle=90, pen=(0, 9), movable=False)
         self.line_roi.sigRegionChanged.connect(self.update_slice_image)
 
+        # slices are extracted in a background thread unless this is False
+        self.background_slicing = True
+        self.slice_worker = SliceWorker(self.timer)
+        self.slice_worker.sig_slice_ready.connect(self.slice_ready)
+        self._last_slice_request = 0
+        self._last_slice_shown = 0
+        self._slice_params = None
+
+        # recently extracted slices and (disk-backed) ortho planes
+        self.slice_cache = SliceCache()
+        self._slice_keys = {}
+
         self.zslider = QtGui.QSlider(QtCore.Qt.Horizontal)
         self.zslider.valueChanged.connect(self.update_ortho_image)
 
@@ -62,12 +77,16 @@ class AtlasSliceView(QtCore.QObject):
 
         self.label_tree = LabelTree()
         self.label_tree.labels_changed.connect(self.labels_changed)
+        self.label_tree.statistics_requested.connect(self.compute_statistics)
 
     def set_data(self, atlas_data):
         self.atlas_data = atlas_data
         self.display_atlas = None
         self.display_label = None
-        self.label_tree.set_ontology(atlas_data.ontology)
+        self.slice_cache.clear()
+        self.label_tree.set_ontology(atlas_data.ontology, atlas_data.ontology_ancestors)
+        # show statistics only if they were already computed
+        self.label_tree.set_statistics(atlas_data.structure_stats(compute=False))
         self.update_image_data()
         self.labels_changed()
 
@@ -75,20 +94,24 @@ class AtlasSliceView(QtCore.QObject):
         if self.atlas_data.image is None or self.atlas_data.label is None:
             return
         axis = self.display_ctrl.params['Orientation']
-        axes = {
-            'right': ('right', 'anterior', 'dorsal'),
-            'dorsal': ('dorsal', 'right', 'anterior'),
-            'anterior': ('anterior', 'right', 'dorsal')
-        }[axis]
-        order = [self.atlas_data.image._interpretAxis(ax) for ax in axes]
+        order = self.atlas_data.orientation_order(axis)
 
         # transpose, flip, downsample images
         ds = self.display_ctrl.params['Downsample']
-        self.display_atlas = self.atlas_data.image.view(np.ndarray).transpose(order)
-        with pg.BusyCursor():
-            for ax in (0, 1, 2):
-                self.display_atlas = pg.downsample(self.display_atlas, ds, axis=ax)
-        self.display_label = self.atlas_data.label.view(np.ndarray).transpose(order)[::ds, ::ds, ::ds]
+        if ds in self.atlas_data.downsample_levels():
+            # precomputed level; no need to downsample here
+            with pg.BusyCursor():
+                self.display_atlas, self.display_label = self.atlas_data.oriented_volumes(axis, ds)
+        else:
+            self.display_atlas = self.atlas_data.image_volume().transpose(order)
+            if isinstance(self.display_atlas, np.ndarray):
+                with pg.BusyCursor():
+                    for ax in (0, 1, 2):
+                        self.display_atlas = pg.downsample(self.display_atlas, ds, axis=ax)
+            else:
+                # lazy volume: avoid reading the whole atlas just to downsample it
+                self.display_atlas = self.display_atlas[::ds, ::ds, ::ds]
+            self.display_label = self.atlas_data.label_volume().transpose(order)[::ds, ::ds, ::ds]
 
         # make sure atlas/label have the same size after downsampling
 
@@ -100,12 +123,50 @@ class AtlasSliceView(QtCore.QObject):
         self.angle_slider.setValue(0)
         self.update_ortho_image()
         self.update_slice_image()
-        self.lut.setLevels(self.display_atlas.min(), self.display_atlas.max())
+        if isinstance(self.display_atlas, np.ndarray):
+            levels = self.display_atlas
+        else:
+            # lazy volume: estimate levels from the displayed plane only
+            levels = self.img1.atlas_data
+        self.lut.setLevels(levels.min(), levels.max())
+
+    def reload_volumes(self):
+        """Redisplay after the atlas volumes have been replaced (for example,
+        read into memory after starting from lazily opened cache files),
+        keeping the current plane and slice angle.
+        """
+        z = self.zslider.value()
+        angle = self.angle_slider.value()
+        self.slice_cache.clear()
+        self.update_image_data()
+        self.zslider.setValue(z)
+        self.angle_slider.setValue(angle)
 
     def labels_changed(self):
         # reapply label colors
-        lut = self.label_tree.lookup_table()
-        self.set_label_lut(lut)        
+        with self.timer.time('labels_changed'):
+            lut = self.label_tree.lookup_table()
+            self.set_label_lut(lut)
+
+    def compute_statistics(self):
+        """Compute (or load) per-structure statistics and show them in the
+        label tree.
+        """
+        with pg.ProgressDialog("Computing structure statistics...", 0, 1000, wait=0) as dlg:
+            def progress(done, total):
+                dlg.setValue(int(1000 * done / total))
+                QtGui.QApplication.processEvents()
+                if dlg.wasCanceled():
+                    raise Exception("User cancelled structure statistics.")
+            stats = self.atlas_data.structure_stats(progress=progress)
+        self.label_tree.set_statistics(stats)
+
+    def set_timing(self, enabled):
+        """Enable or disable timing instrumentation and the timing overlay.
+        Records can be exported or collected with the methods of *timer*.
+        """
+        self.timer.enabled = enabled
+        self.timing_overlay.set_active(enabled)
         
     def display_ctrl_changed(self, param, changes):
         update = False
@@ -122,28 +183,59 @@ class AtlasSliceView(QtCore.QObject):
             self.update_image_data()
 
     def update_ortho_image(self):
+        with self.timer.time('update_ortho_image'):
+            self._update_ortho_image()
+
+    def _update_ortho_image(self):
         z = self.zslider.value()
-        self.img1.set_data(self.display_atlas[z], self.display_label[z], scale=self.scale)
+        if isinstance(self.display_atlas, np.ndarray):
+            # planes are just views; nothing to cache
+            atlas, label = self.display_atlas[z], self.display_label[z]
+        else:
+            key = self.slice_cache.key('ortho', self.display_ctrl.params['Orientation'], self.display_ctrl.params['Downsample'], z)
+            planes = self.slice_cache.get(key)
+            if planes is None:
+                planes = (self.display_atlas[z], self.display_label[z])
+                self.slice_cache.put(key, planes)
+            atlas, label = planes
+        self.img1.set_data(atlas, label, scale=self.scale)
         self.sig_image_changed.emit()
 
     def update_slice_image(self):
+        with self.timer.time('update_slice_image'):
+            self._update_slice_image()
+
+    def _update_slice_image(self):
         rotation = self.angle_slider.value()
 
         if self.display_atlas is None:
             return
 
         if rotation == 0:
-            atlas = self.line_roi.getArrayRegion(self.display_atlas, self.img1.atlas_img, axes=(1, 2), order=int(self.interpolate))
-            label = self.line_roi.getArrayRegion(self.display_label, self.img1.atlas_img, axes=(1, 2), order=0)
+            params = self.line_roi.get_slice_params(self.display_atlas, self.img1.atlas_img, axes=(1, 2))
         else:
-            atlas = self.line_roi.getArrayRegion(self.display_atlas, self.img1.atlas_img, rotation=rotation, axes=(1, 2, 0), order=int(self.interpolate))
-            label = self.line_roi.getArrayRegion(self.display_label, self.img1.atlas_img, rotation=rotation, axes=(1, 2, 0), order=0)
+            params = self.line_roi.get_slice_params(self.display_atlas, self.img1.atlas_img, rotation=rotation, axes=(1, 2, 0))
+        self._slice_params = params
+
+        self._last_slice_request += 1
+        key = self.slice_cache.key('slice', self.display_ctrl.params['Orientation'], self.display_ctrl.params['Downsample'],
+                                   rotation, int(self.interpolate), params)
+        cached = self.slice_cache.get(key)
+        if cached is not None:
+            self.slice_ready(self._last_slice_request, *cached)
+            return
+        self._slice_keys[self._last_slice_request] = key
 
-        if atlas.size == 0:
+        if self.background_slicing:
+            # the worker only processes the most recent request
+            if not self.slice_worker.isRunning():
+                self.slice_worker.start()
+            self.slice_worker.request(self._last_slice_request, self.display_atlas, self.display_label, params, int(self.interpolate))
             return
-        
-        self.img2.set_data(atlas, label, scale=self.scale)
-        self.sig_slice_changed.emit()
+
+        atlas = affine_slice(self.display_atlas, order=int(self.interpolate), **params)
+        label = affine_slice(self.display_label, order=0, **params)
+        self.slice_ready(self._last_slice_request, atlas, label)
         
         scene = self.img2.atlas_img.scene()
         if scene is not None:
@@ -152,6 +244,52 @@ class AtlasSliceView(QtCore.QObject):
                 # repaint immediately to avoid processing more mouse events before next repaint
                 w[0].viewport().repaint()
                 #w[0].viewport().repaint()
+
+    def current_section(self):
+        """Return (shape, origin, vectors) describing the displayed slice in
+        atlas voxel coordinates (see CCFAtlasSlice), or None if no slice is
+        displayed.
+        """
+        params = self._slice_params
+        if params is None or self.display_atlas is None:
+            return None
+        shape = tuple(params['shape'])
+        origin = np.zeros(3)
+        origin[list(params['axes'])] = params['origin']
+        vectors = np.zeros((len(shape), 3))
+        vectors[:, list(params['axes'])] = params['vectors']
+        if len(shape) == 1:
+            # unrotated slices span the whole first display axis
+            shape = (self.display_atlas.shape[0],) + shape
+            vectors = np.vstack([[1, 0, 0], vectors])
+
+        # display axes and downsampling to atlas voxels
+        order = self.atlas_data.orientation_order(self.display_ctrl.params['Orientation'])
+        ds = self.display_ctrl.params['Downsample']
+        atlas_origin = np.zeros(3)
+        atlas_origin[order] = origin * ds
+        atlas_vectors = np.zeros((2, 3))
+        atlas_vectors[:, order] = vectors * ds
+        return shape, atlas_origin, atlas_vectors
+
+    def slice_ready(self, request_id, atlas, label):
+        key = self._slice_keys.pop(request_id, None)
+        if key is not None:
+            self.slice_cache.put(key, (atlas, label))
+        # forget requests that were dropped by the worker
+        for rid in [rid for rid in self._slice_keys if rid < request_id]:
+            del self._slice_keys[rid]
+
+        # Results may arrive after newer requests were made; show anything
+        # newer than what is currently displayed.
+        if request_id <= self._last_slice_shown:
+            return
+        self._last_slice_shown = request_id
+        if atlas.size == 0:
+            return
+
+        self.img2.set_data(atlas, label, scale=self.scale)
+        self.sig_slice_changed.emit()
         
     def angle_slider_changed(self):
         rotation = self.angle_slider.value()
@@ -159,6 +297,7 @@ class AtlasSliceView(QtCore.QObject):
         self.update_slice_image()
 
     def close(self):
+        self.slice_worker.stop()
         self.data = None
 
     def set_overlay(self, o):
@@ -232,6 +371,63 @@ class AtlasSliceView(QtCore.QObject):
         return abs(offset)
 
 
+class SliceWorker(QtCore.QThread):
+    """Thread that extracts slices from atlas volumes in the background.
+
+    Only the most recent request is kept: requests that arrive while a slice
+    is being extracted replace any request that is still waiting, so a burst
+    of ROI changes results in at most one extra extraction. Extraction times
+    are recorded as 'slice_worker' events in *timer* (an EventTimer).
+    """
+    sig_slice_ready = QtCore.Signal(object, object, object)  # request id, atlas, label
+
+    def __init__(self, timer=None):
+        QtCore.QThread.__init__(self)
+        self.timer = EventTimer() if timer is None else timer
+        self._cond = threading.Condition()
+        self._request = None
+        self._stop = False
+
+    def request(self, request_id, atlas, label, params, order):
+        """Ask the thread to extract slices of *atlas* and *label* using the
+        affine_slice arguments in *params*. The result is delivered via
+        sig_slice_ready.
+        """
+        with self._cond:
+            self._request = (request_id, atlas, label, params, order)
+            self._cond.notify()
+
+    def start(self, *args):
+        # a worker that was stopped can be started again
+        with self._cond:
+            self._stop = False
+        QtCore.QThread.start(self, *args)
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._request is None and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+                request_id, atlas, label, params, order = self._request
+                self._request = None
+            try:
+                with self.timer.time('slice_worker'):
+                    atlas = affine_slice(atlas, order=order, **params)
+                    label = affine_slice(label, order=0, **params)
+            except Exception:
+                sys.excepthook(*sys.exc_info())
+                continue
+            self.sig_slice_ready.emit(request_id, atlas, label)
+
+
 class AtlasDisplayCtrl(pg.parametertree.ParameterTree):
     """UI for controlling how the atlas is displayed. 
     """
@@ -251,25 +447,31 @@ class AtlasDisplayCtrl(pg.parametertree.ParameterTree):
 
 class LabelTree(QtGui.QWidget):
     labels_changed = QtCore.Signal()
+    statistics_requested = QtCore.Signal()  # the 'Compute statistics' button was clicked
+
+    # statistics shown as extra columns by set_statistics: (name, header, format)
+    stat_columns = [
+        ('count', 'voxels', '%d'),
+        ('volume_mm3', 'mm3', '%0.3f'),
+        ('mean_intensity', 'intensity', '%0.1f'),
+    ]
 
     def __init__(self, parent=None):
-        self._block_signals = False
         QtGui.QWidget.__init__(self, parent)
         self.layout = QtGui.QGridLayout()
         self.setLayout(self.layout)
         self.layout.setSpacing(0)
         self.layout.setContentsMargins(0,0,0,0)
 
-        self.tree = QtGui.QTreeWidget(self)
+        self.ontology = None
+        self.model = LabelTreeModel(self)
+        self.tree = QtGui.QTreeView(self)
+        self.tree.setModel(self.model)
+        self.tree.setUniformRowHeights(True)
+        self.color_delegate = ColorSwatchDelegate(self.tree)
+        self.tree.setItemDelegateForColumn(2, self.color_delegate)
         self.layout.addWidget(self.tree, 0, 0)
         self.tree.header().setResizeMode(QtGui.QHeaderView.ResizeToContents)
-        self.tree.headerItem().setText(0, "id")
-        self.tree.headerItem().setText(1, "name")
-        self.tree.headerItem().setText(2, "color")
-        self.labels_by_id = {}
-        self.labels_by_acronym = {}
-        self.checked = set()
-        self.tree.itemChanged.connect(self.item_change)
 
         self.layer_btn = QtGui.QPushButton('Color by cortical layer')
         self.layout.addWidget(self.layer_btn, 1, 0)
@@ -279,124 +481,368 @@ class LabelTree(QtGui.QWidget):
         self.layout.addWidget(self.reset_btn, 2, 0)
         self.reset_btn.clicked.connect(self.reset_colors)
 
-    def set_ontology(self, ontology):
-        # prevent emission of multiple signals during update
-        self._block_signals = True
-        try:
-            for rec in ontology:
-                self.add_label(*rec)
-        finally:
-            self._block_signals = False
-        
-        self.labels_changed.emit()
+        self.stats_btn = QtGui.QPushButton('Compute structure statistics')
+        self.layout.addWidget(self.stats_btn, 3, 0)
+        self.stats_btn.clicked.connect(self.statistics_requested)
+        self.statistics = None
 
-    def add_label(self, id, parent, name, acronym, color):
-        item = QtGui.QTreeWidgetItem([acronym, name, ''])
-        item.setFlags(item.flags() | QtCore.Qt.ItemIsUserCheckable)
-        item.setCheckState(0, QtCore.Qt.Unchecked)
+    def set_ontology(self, ontology, ancestors=None):
+        """Show the structures in a flat *ontology* table. If the table does
+        not carry a hierarchy index (see aiccf.ontology.index_ontology), one
+        is computed here.
+        """
+        if ancestors is None or 'pre' not in ontology.dtype.names:
+            ontology, ancestors = index_ontology(ontology)
+        self.ontology = ontology
+        self.ontology_ancestors = ancestors
+        self._rows = dict(zip(ontology['id'].tolist(), range(len(ontology))))
+        self._names = ontology['name'].astype(str)
+        self._acronyms = ontology['acronym'].astype(str)
+        # descriptions shown while hovering over labels (see describe)
+        paths = structure_paths(ontology, ancestors, sep=' > ', skip=1)
+        self._descriptions = dict((id, '[%d]%s  :  %s' % (id, path, name))
+                                  for id, path, name in zip(ontology['id'].tolist(), paths, self._names))
+
+        # Per-structure colors and visibility, and the label lookup table
+        # built from them. Edits patch the affected entries in place.
+        self.default_colors = hex_colors(ontology['color'])
+        self.colors = self.default_colors.copy()
+        self.visible = np.zeros(len(ontology), dtype=bool)
+        self.lut = np.zeros((2**16, 4), dtype=np.ubyte)
+
+        self.model.set_ontology(ontology, ancestors)
+        self.labels_changed.emit()
 
-        if parent in self.labels_by_id:
-            root = self.labels_by_id[parent]['item']
+    def set_statistics(self, stats):
+        """Show per-structure statistics as extra columns (see stat_columns).
+        *stats* is a MetaArray as returned by CCFAtlasData.structure_stats(),
+        with rows in the same order as the ontology, or None to hide the
+        columns.
+        """
+        if stats is None:
+            self.statistics = None
         else:
-            root = self.tree.invisibleRootItem()
-
-        root.addChild(item)
+            self.statistics = dict((name, np.asarray(stats[:, name])) for name, header, fmt in self.stat_columns)
+        self.stats_btn.setVisible(stats is None)
+        self.model.set_statistics(None if stats is None else self.stat_columns)
 
-        btn = pg.ColorButton(color=pg.mkColor(color))
-        btn.defaultColor = color
-        btn.id = id
-        self.tree.setItemWidget(item, 2, btn)
-
-        self.labels_by_id[id] = {'item': item, 'btn': btn}
-        item.id = id
-        self.labels_by_acronym[acronym] = self.labels_by_id[id]
+    def subtree_ids(self, label_id, include_self=True):
+        """Return an array of the IDs of *label_id* and all labels below it.
+        """
+        rows = descendant_rows(self.ontology, self._rows[label_id], include_self)
+        return self.ontology['id'][rows]
 
-        btn.sigColorChanged.connect(self.item_color_changed)
+    @property
+    def checked(self):
+        """The set of label IDs that are currently checked.
+        """
+        return set(self.ontology['id'][self.visible].tolist())
 
-    def item_change(self, item, col):
-        checked = item.checkState(0) == QtCore.Qt.Checked
-        with SignalBlock(self.tree.itemChanged, self.item_change):
-            self.check_recursive(item, checked)
-            
-        if not self._block_signals:
+    def checked_roots(self):
+        """Return an array of the IDs of checked labels whose parent is not
+        checked (the top of each checked subtree).
+        """
+        rows = np.argwhere(self.visible)[:, 0]
+        depth = self.ontology['depth'][rows]
+        parents = self.ontology_ancestors[rows, np.maximum(depth - 1, 0)]
+        return self.ontology['id'][rows[(depth == 0) | ~self.visible[parents]]]
+
+    def set_label_checked(self, label_id, checked, emit=True):
+        """Check or uncheck *label_id* and all labels below it. Return True if
+        the lookup table changed.
+        """
+        rows = descendant_rows(self.ontology, self._rows[label_id])
+        self.visible[rows] = checked
+        self.model.rows_changed(rows)
+        changed = self._update_lut(rows)
+        if emit and changed:
             self.labels_changed.emit()
+        return changed
 
-    def check_recursive(self, item, checked):
-        if checked:
-            self.checked.add(item.id)
-            item.setCheckState(0, QtCore.Qt.Checked)
-        else:
-            if item.id in self.checked:
-                self.checked.remove(item.id)
-            item.setCheckState(0, QtCore.Qt.Unchecked)
-
-        for i in range(item.childCount()):
-            self.check_recursive(item.child(i), checked)
-
-    def item_color_changed(self, btn):
-        color = btn.color()
-        self.set_label_color(btn.id, btn.color())
-        
     def set_label_color(self, label_id, color, recursive=True, emit=True):
-        item = self.labels_by_id[label_id]['item']
-        btn = self.labels_by_id[label_id]['btn']
-        with SignalBlock(btn.sigColorChanged, self.item_color_changed):
-            btn.setColor(color)
         if recursive:
-            for i in range(item.childCount()):
-                ch = item.child(i)
-                self.set_label_color(ch.id, color, recursive=recursive, emit=False)
-        if emit:
+            rows = descendant_rows(self.ontology, self._rows[label_id])
+        else:
+            rows = np.array([self._rows[label_id]])
+        changed = self._set_row_colors(rows, pg.mkColor(color).getRgb())
+        if emit and changed:
             self.labels_changed.emit()
+        return changed
+
+    def label_color(self, label_id):
+        return pg.mkColor(self.colors[self._rows[label_id]].tolist())
+
+    def _set_row_colors(self, rows, colors):
+        # Update the colors of ontology *rows* and patch the lookup table.
+        # Return True if the lookup table changed.
+        self.colors[rows] = colors
+        self.model.rows_changed(rows)
+        return self._update_lut(rows)
+
+    def _update_lut(self, rows):
+        # Rewrite the lookup table entries for ontology *rows* from the current
+        # colors and visibility. Return True if any entry changed.
+        ids = self.ontology['id'][rows]
+        valid = (ids >= 0) & (ids < len(self.lut))
+        ids = ids[valid]
+        rows = rows[valid]
+        entries = np.where(self.visible[rows, None], self.colors[rows], 0).astype(np.ubyte)
+        if np.array_equal(self.lut[ids], entries):
+            return False
+        self.lut[ids] = entries
+        return True
 
     def lookup_table(self):
-        lut = np.zeros((2**16, 4), dtype=np.ubyte)
-        for id in self.checked:
-            if id >= lut.shape[0]:
-                continue
-            lut[id] = self.labels_by_id[id]['btn'].color(mode='byte')
-        return lut
+        """Return the (2**16, 4) label color table. This array is updated in
+        place as labels are checked and recolored.
+        """
+        return self.lut
 
     def color_by_layer(self, root=None):
-        try:
-            unblock = False
-            if not isinstance(root, pg.QtGui.QTreeWidgetItem):
-                self.blockSignals(True)
-                unblock = True
-                root = self.labels_by_acronym['Isocortex']['item']
-
-            name = str(root.text(1))
-            if ', layer' in name.lower():
-                layer = name.split(' ')[-1]
-                layer = {'1': 0, '2': 1, '2/3': 2, '4': 3, '5': 4, '6a': 5, '6b': 6}[layer]
-                self.set_label_color(root.id, pg.intColor(layer, 10), recursive=False, emit=False)
-
-            for i in range(root.childCount()):
-                self.color_by_layer(root.child(i))
-        finally:
-            if unblock:
-                self.blockSignals(False)
-                self.labels_changed.emit()
+        if root is None or isinstance(root, bool):
+            # called from the button
+            root = self.ontology['id'][np.argwhere(self._acronyms == 'Isocortex')[0, 0]]
+        layers = {'1': 0, '2': 1, '2/3': 2, '4': 3, '5': 4, '6a': 5, '6b': 6}
+        rows = descendant_rows(self.ontology, self._rows[root])
+        rows = rows[np.char.find(np.char.lower(self._names[rows]), ', layer') >= 0]
+        colors = [pg.intColor(layers[name.split(' ')[-1]], 10).getRgb() for name in self._names[rows]]
+        if len(rows) > 0 and self._set_row_colors(rows, colors):
+            self.labels_changed.emit()
 
     def reset_colors(self):
-        try:
-            self.blockSignals(True)
-            for k,v in self.labels_by_id.items():
-                self.set_label_color(k, v['btn'].defaultColor, recursive=False, emit=False)
-        finally:
-            self.blockSignals(False)
+        if self._set_row_colors(np.arange(len(self.ontology)), self.default_colors):
             self.labels_changed.emit()
 
     def describe(self, id):
-        if id not in self.labels_by_id:
+        """Return a description of label *id* with the acronyms of its
+        ancestors and its name.
+        """
+        description = self._descriptions.get(id)
+        if description is None:
             return "Unknown label: %d" % id
-        descr = []
-        item = self.labels_by_id[id]['item']
-        name = str(item.text(1))
-        while item is not self.labels_by_acronym['root']['item']:
-            descr.insert(0, str(item.text(0)))
-            item = item.parent()
-        return '[%d]' % id + ' > '.join(descr) + "  :  " + name
+        return description
+
+
+class LabelTreeModel(QtCore.QAbstractItemModel):
+    """Item model that presents the ontology of a LabelTree.
+
+    Data is read directly from the ontology table and the LabelTree's color
+    and visibility arrays; no per-structure items are created. The children
+    of a node are looked up the first time a view asks for them, which
+    normally happens when the node is expanded. The internal ID of each model
+    index is the ontology row it refers to.
+    """
+    ColorRole = QtCore.Qt.UserRole + 1
+    columns = ['id', 'name', 'color']
+
+    def __init__(self, label_tree):
+        QtCore.QAbstractItemModel.__init__(self)
+        self.label_tree = label_tree
+        self._stat_columns = []
+        self._roots = []
+        self._children = {}
+        self._position = {}
+
+    def set_ontology(self, ontology, ancestors):
+        self.beginResetModel()
+        n = len(ontology)
+        depth = ontology['depth']
+        self._parent_rows = np.where(depth > 0, ancestors[np.arange(n), np.maximum(depth - 1, 0)], -1)
+        self._child_counts = np.bincount(self._parent_rows[self._parent_rows >= 0], minlength=n)
+        self._roots = np.argwhere(self._parent_rows < 0)[:, 0].tolist()
+        self._children = {}   # row: child rows, filled on demand
+        self._position = dict((row, i) for i, row in enumerate(self._roots))   # row: index among siblings
+        self.endResetModel()
+
+    def set_statistics(self, stat_columns):
+        """Show one extra column for each (name, header, format) in
+        *stat_columns*, with values from the LabelTree's statistics.
+        """
+        self.beginResetModel()
+        self._stat_columns = [] if stat_columns is None else list(stat_columns)
+        self.endResetModel()
+
+    def _child_rows(self, row):
+        if row not in self._children:
+            children = np.argwhere(self._parent_rows == row)[:, 0].tolist()
+            for i, child in enumerate(children):
+                self._position[child] = i
+            self._children[row] = children
+        return self._children[row]
+
+    def rows_changed(self, rows):
+        """Notify views that data for ontology *rows* has changed. Rows that
+        have never been shown are skipped.
+        """
+        for row in rows.tolist():
+            if row in self._position:
+                pos = self._position[row]
+                self.dataChanged.emit(self.createIndex(pos, 0, row), self.createIndex(pos, 2, row))
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QtCore.QModelIndex()
+        if parent.isValid():
+            children = self._child_rows(parent.internalId())
+        else:
+            children = self._roots
+        return self.createIndex(row, column, children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        row = int(self._parent_rows[index.internalId()])
+        if row < 0:
+            return QtCore.QModelIndex()
+        return self.createIndex(self._position[row], 0, row)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        if not parent.isValid():
+            return len(self._roots)
+        return len(self._child_rows(parent.internalId()))
+
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        # answered without populating the node's children
+        if parent.column() > 0:
+            return False
+        if not parent.isValid():
+            return len(self._roots) > 0
+        return bool(self._child_counts[parent.internalId()] > 0)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self.columns) + len(self._stat_columns)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            if section < len(self.columns):
+                return self.columns[section]
+            return self._stat_columns[section - len(self.columns)][1]
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return QtCore.Qt.NoItemFlags
+        flags = QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+        if index.column() == 0:
+            flags |= QtCore.Qt.ItemIsUserCheckable
+        return flags
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.internalId()
+        col = index.column()
+        tree = self.label_tree
+        if role == QtCore.Qt.DisplayRole:
+            if col == 0:
+                return str(tree._acronyms[row])
+            if col == 1:
+                return str(tree._names[row])
+            if col >= len(self.columns):
+                name, header, fmt = self._stat_columns[col - len(self.columns)]
+                value = tree.statistics[name][row]
+                return '' if np.isnan(value) else fmt % value
+        elif role == QtCore.Qt.TextAlignmentRole and col >= len(self.columns):
+            return QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter
+        elif role == QtCore.Qt.CheckStateRole and col == 0:
+            return QtCore.Qt.Checked if tree.visible[row] else QtCore.Qt.Unchecked
+        elif role == self.ColorRole and col == 2:
+            return pg.mkColor(tree.colors[row].tolist())
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        if not index.isValid():
+            return False
+        label_id = self.label_tree.ontology['id'][index.internalId()]
+        if role == QtCore.Qt.CheckStateRole and index.column() == 0:
+            self.label_tree.set_label_checked(label_id, value == QtCore.Qt.Checked)
+            return True
+        if role == self.ColorRole and index.column() == 2:
+            self.label_tree.set_label_color(label_id, value)
+            return True
+        return False
+
+
+class ColorSwatchDelegate(QtGui.QStyledItemDelegate):
+    """Paints label colors as swatches. Clicking a swatch opens a color dialog.
+    """
+    def paint(self, painter, option, index):
+        QtGui.QStyledItemDelegate.paint(self, painter, option, index)
+        color = index.data(LabelTreeModel.ColorRole)
+        if color is None:
+            return
+        rect = option.rect.adjusted(2, 2, -2, -2)
+        painter.save()
+        painter.fillRect(rect, color)
+        painter.setPen(pg.mkPen('k'))
+        painter.drawRect(rect)
+        painter.restore()
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() != QtCore.QEvent.MouseButtonRelease or event.button() != QtCore.Qt.LeftButton:
+            return False
+        color = QtGui.QColorDialog.getColor(index.data(LabelTreeModel.ColorRole), option.widget)
+        if color.isValid():
+            model.setData(index, color, LabelTreeModel.ColorRole)
+        return True
+
+
+class ProjectionOverview(pg.GraphicsLayoutWidget):
+    """Shows the structures checked in a LabelTree projected along each axis
+    of the atlas, composited from precomputed per-structure projections (see
+    CCFAtlasData.structure_projections) over a gray silhouette of the brain.
+    """
+    # (title, transpose) of the projections along the anterior, dorsal, right axes
+    views = [('coronal', True), ('horizontal', True), ('sagittal', False)]
+
+    def __init__(self, parent=None):
+        pg.GraphicsLayoutWidget.__init__(self, parent)
+        self.projections = None
+        self.silhouettes = []
+        self.images = []
+        for title, transpose in self.views:
+            view = self.addViewBox(row=len(self.images), col=0)
+            view.setAspectLocked()
+            view.invertY(True)
+            view.setMenuEnabled(False)
+            silhouette = pg.ImageItem()
+            image = pg.ImageItem()
+            view.addItem(silhouette)
+            view.addItem(image)
+            self.silhouettes.append(silhouette)
+            self.images.append(image)
+
+    def set_projections(self, projections):
+        """Set the ProjectionCache to display (or None to clear the view).
+        """
+        self.projections = projections
+        for ax, (title, transpose) in enumerate(self.views):
+            if projections is None:
+                self.silhouettes[ax].clear()
+                self.images[ax].clear()
+                continue
+            mask = projections.mask(ax, range(len(projections.bounds[ax])))
+            self.silhouettes[ax].setImage(self._orient(ax, mask * 60), levels=(0, 255))
+
+    def update_images(self, label_tree):
+        """Redraw the checked structures of *label_tree* in their colors.
+        """
+        if self.projections is None:
+            return
+        rows = np.argwhere(label_tree.visible)[:, 0]
+        # paint descendants over their ancestors
+        rows = rows[np.argsort(label_tree.ontology['pre'][rows])]
+        for ax in range(len(self.views)):
+            image = self.projections.composite(ax, rows, label_tree.colors)
+            self.images[ax].setImage(self._orient(ax, image), levels=(0, 255))
+
+    def _orient(self, ax, image):
+        # ImageItem uses the first axis as x; put dorsal and anterior up
+        if self.views[ax][1]:
+            image = image.swapaxes(0, 1)
+        return image
 
 
 class AtlasImageItem(QtGui.QGraphicsItemGroup):
@@ -404,14 +850,19 @@ class AtlasImageItem(QtGui.QGraphicsItemGroup):
         mouseHovered = QtCore.Signal(object)  # id
         mouseClicked = QtCore.Signal(object)  # id
 
-    def __init__(self):
+    def __init__(self, timer=None, name='image'):
         self._sigprox = AtlasImageItem.SignalProxy()
         self.mouseHovered = self._sigprox.mouseHovered
         self.mouseClicked = self._sigprox.mouseClicked
 
+        # set_data, render, and paint times are recorded in *timer* as
+        # events prefixed by *name*; the label image marks frames
+        self.timer = EventTimer() if timer is None else timer
+        self.name = name
+
         QtGui.QGraphicsItemGroup.__init__(self)
-        self.atlas_img = pg.ImageItem(levels=[0,1])
-        self.label_img = pg.ImageItem()
+        self.atlas_img = TimedImageItem(self.timer, name + '.atlas', levels=[0,1])
+        self.label_img = TimedImageItem(self.timer, name + '.label', frame=name + '.frame')
         self.atlas_img.setParentItem(self)
         self.label_img.setParentItem(self)
         self.label_img.setZValue(10)
@@ -421,16 +872,29 @@ class AtlasImageItem(QtGui.QGraphicsItemGroup):
         self.label_colors = {}
         self.setAcceptHoverEvents(True)
 
+        # mouseHovered is emitted only when the label under the mouse changes,
+        # and at most once per *hover_interval* ms (about one display frame)
+        self.hover_interval = 16
+        self._hover_id = None
+        self._hover_emitted = None
+        self._hover_timer = QtCore.QTimer()
+        self._hover_timer.setSingleShot(True)
+        self._hover_timer.timeout.connect(self._emit_hover)
+
     def set_data(self, atlas, label, scale=None):
-        self.label_data = label
-        self.atlas_data = atlas
-        if scale is not None:
-            self.resetTransform()
-            self.scale(*scale)
-        self.atlas_img.setImage(self.atlas_data, autoLevels=False)
-        self.label_img.setImage(self.label_data, autoLevels=False)  
+        with self.timer.time(self.name + '.set_data'):
+            self.label_data = label
+            self.atlas_data = atlas
+            if scale is not None:
+                self.resetTransform()
+                self.scale(*scale)
+            self.atlas_img.setImage(self.atlas_data, autoLevels=False)
+            self.label_img.setImage(self.label_data, autoLevels=False)
 
     def set_lut(self, lut):
+        if lut is self.label_img.lut:
+            # the table was modified in place; make sure it is re-rendered
+            self.label_img.lut = None
         self.label_img.setLookupTable(lut)
 
     def set_overlay(self, overlay):
@@ -445,13 +909,27 @@ class AtlasImageItem(QtGui.QGraphicsItemGroup):
 
     def hoverEvent(self, event):
         if event.isExit():
+            self._hover_id = self._hover_emitted = None
             return
 
+        x, y = event.pos().x(), event.pos().y()
+        if x < 0 or y < 0:
+            return
         try:
-            id = self.label_data[int(event.pos().x()), int(event.pos().y())]
-        except IndexError, AttributeError:
+            id = int(self.label_data[int(x), int(y)])
+        except (IndexError, TypeError, AttributeError):
             return
-        self.mouseHovered.emit(id)
+        if id == self._hover_id:
+            return
+        self._hover_id = id
+        if not self._hover_timer.isActive():
+            self._hover_timer.start(self.hover_interval)
+
+    def _emit_hover(self):
+        # emit the most recent label under the mouse
+        if self._hover_id is not None and self._hover_id != self._hover_emitted:
+            self._hover_emitted = self._hover_id
+            self.mouseHovered.emit(self._hover_id)
 
     def mouseClickEvent(self, event):
         id = self.label_data[int(event.pos().x()), int(event.pos().y())]
@@ -464,6 +942,61 @@ class AtlasImageItem(QtGui.QGraphicsItemGroup):
         return self.label_img.shape()
 
 
+class TimedImageItem(pg.ImageItem):
+    """ImageItem that records the time spent rendering (converting data to
+    a QImage) and painting as '<name>.render' and '<name>.paint' events in
+    *timer*. If *frame* is given, each paint also marks a frame of that name
+    (see EventTimer.frame).
+    """
+    def __init__(self, timer, name, frame=None, **kwds):
+        self.timer = timer
+        self.name = name
+        self.frame_name = frame
+        pg.ImageItem.__init__(self, **kwds)
+
+    def render(self, *args, **kwds):
+        with self.timer.time(self.name + '.render'):
+            return pg.ImageItem.render(self, *args, **kwds)
+
+    def paint(self, *args):
+        with self.timer.time(self.name + '.paint'):
+            pg.ImageItem.paint(self, *args)
+        if self.frame_name is not None:
+            self.timer.frame(self.frame_name)
+
+
+class TimingOverlay(QtGui.QGraphicsTextItem):
+    """Text item showing the rolling statistics of an EventTimer. Add it to
+    the scene of a GraphicsView; while active it is refreshed every
+    *interval* ms.
+    """
+    def __init__(self, timer, interval=500):
+        QtGui.QGraphicsTextItem.__init__(self)
+        self.timer = timer
+        self.setZValue(10000)
+        self.setDefaultTextColor(QtGui.QColor(255, 255, 0))
+        font = QtGui.QFont('monospace')
+        font.setStyleHint(QtGui.QFont.TypeWriter)
+        font.setPointSize(8)
+        self.setFont(font)
+        self.setVisible(False)
+
+        self.refresh_timer = QtCore.QTimer()
+        self.refresh_timer.setInterval(interval)
+        self.refresh_timer.timeout.connect(self.refresh)
+
+    def set_active(self, active):
+        self.setVisible(active)
+        if active:
+            self.refresh()
+            self.refresh_timer.start()
+        else:
+            self.refresh_timer.stop()
+
+    def refresh(self):
+        self.setPlainText(self.timer.summary())
+
+
 class RulerROI(pg.ROI):
     """
     ROI subclass with one rotate handle, one scale-rotate handle and one translate handle. Rotate handles handles define a line. 
@@ -536,7 +1069,15 @@ class RulerROI(pg.ROI):
         return r.adjusted(-50, -50, 50, 50)
 
     def getArrayRegion(self, data, img, axes=(0, 1), order=1, rotation=0, **kwds):
+        params = self.get_slice_params(data, img, axes=axes, rotation=rotation)
+        params.update(kwds)
+        return affine_slice(data, order=order, **params)
 
+    def get_slice_params(self, data, img, axes=(0, 1), rotation=0):
+        """
+        Return a dict of affine_slice arguments (shape, origin, vectors, axes) that extract the region
+        of *data* selected by this ROI, and update the saved origin and vectors to match.
+        """
         imgPts = [self.mapToItem(img, h.pos()) for h in self.getHandles()]
 
         d = pg.Point(imgPts[1] - imgPts[0]) # This is the xy direction vector
@@ -544,14 +1085,14 @@ class RulerROI(pg.ROI):
        
         if rotation != 0:
             ac_vector, ac_vector_length, origin = self.get_affine_slice_params(data, img, rotation)
-            rgn = fn.affineSlice(data, shape=(int(ac_vector_length), int(d.length())), vectors=[ac_vector, (d.norm().x(), d.norm().y(), 0)],
-                                 origin=origin, axes=axes, order=order, **kwds) 
+            params = {'shape': (int(ac_vector_length), int(d.length())), 'vectors': [tuple(ac_vector), (d.norm().x(), d.norm().y(), 0)],
+                      'origin': origin}
             
             # Save vector and origin
             self.origin = origin
             self.ac_vector = ac_vector * ac_vector_length
         else:
-            rgn = fn.affineSlice(data, shape=(int(d.length()),), vectors=[pg.Point(d.norm())], origin=o, axes=axes, order=order, **kwds)
+            params = {'shape': (int(d.length()),), 'vectors': [(d.norm().x(), d.norm().y())], 'origin': (o.x(), o.y())}
             # Save vector and origin
             self.ac_vector = (0, 0, data.shape[0])
             self.origin = (o.x(), o.y(), 0.0) 
@@ -559,8 +1100,9 @@ class RulerROI(pg.ROI):
         # save this as well
         self.ab_vector = (d.x(), d.y(), 0)
         self.ac_angle = rotation
+        params['axes'] = axes
         
-        return rgn
+        return params
 
     def get_affine_slice_params(self, data, img, rotation):
         """
@@ -622,6 +1164,42 @@ class RulerROI(pg.ROI):
             return self.ac_angle
 
 
+class SectionStackDialog(QtGui.QDialog):
+    """Asks for the parameters of a stack of sections around the current
+    slice (see AtlasViewer.extract_section_stack).
+    """
+    def __init__(self, parent=None):
+        QtGui.QDialog.__init__(self, parent)
+        self.setWindowTitle("Extract section stack")
+        self.layout = QtGui.QFormLayout()
+        self.setLayout(self.layout)
+
+        self.mode = QtGui.QComboBox()
+        self.mode.addItems(['parallel', 'fan'])
+        self.layout.addRow("Sections", self.mode)
+        self.count = QtGui.QSpinBox()
+        self.count.setRange(1, 10000)
+        self.count.setValue(20)
+        self.layout.addRow("Number of sections", self.count)
+        self.spacing = QtGui.QDoubleSpinBox()
+        self.spacing.setRange(0.1, 10000)
+        self.spacing.setValue(100)
+        self.spacing.setSuffix(" um")
+        self.layout.addRow("Spacing (parallel)", self.spacing)
+        self.angle = QtGui.QDoubleSpinBox()
+        self.angle.setRange(0.01, 90)
+        self.angle.setValue(2)
+        self.angle.setSuffix(" deg")
+        self.layout.addRow("Angle step (fan)", self.angle)
+        self.labels = QtGui.QCheckBox("Also extract labels")
+        self.layout.addRow(self.labels)
+
+        buttons = QtGui.QDialogButtonBox(QtGui.QDialogButtonBox.Ok | QtGui.QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        self.layout.addRow(buttons)
+
+
 class AtlasResolutionDialog(QtGui.QDialog):
     def __init__(self, resolutions, cached):
         QtGui.QDialog.__init__(self)
@@ -667,26 +1245,31 @@ class AtlasResolutionDialog(QtGui.QDialog):
 
 def download(url, dest, chunksize=1000000):
     """Download a file from *url* and save it to *dest*, while displaying a
-    progress bar.
+    progress bar. Interrupted downloads are resumed where they stopped (see
+    aiccf.download.fetch).
     """
-    req = urlopen(url)
-    size = req.info().get('content-length')
-    size = 0 if size is None else int(size)
-    tmpdst = dest+'.partial'
-    with pg.ProgressDialog("Downloading\n%s" % url, maximum=size, nested=True) as dlg:
-        try:
-            with open(tmpdst, 'wb') as fh:
-                tot = 0
-                while True:
-                    chunk = req.read(chunksize)
-                    if chunk == '':
-                        break
-                    fh.write(chunk)
-                    tot += len(chunk)
-                    dlg.setValue(tot)
-                    if dlg.wasCanceled():
-                        raise Exception("User cancelled download.")
-            os.rename(tmpdst, dest)
-        finally:
-            if os.path.isfile(tmpdst):
-                os.remove(tmpdst)
+    return download_all([{'url': url, 'dest': dest, 'chunk_size': chunksize}])[0]
+
+
+def download_all(jobs, threads=3):
+    """Download several files concurrently while displaying a progress bar
+    with the combined throughput. *jobs* is a list of dicts of keyword
+    arguments for aiccf.download.fetch (at least 'url' and 'dest').
+    """
+    from .download import fetch_all
+    names = ', '.join(os.path.basename(job['dest']) for job in jobs)
+    with pg.ProgressDialog("Downloading %s" % names, maximum=1000, nested=True) as dlg:
+        def progress(done, total, rate):
+            size = '?' if total is None else '%0.1f' % (total * 1e-6)
+            dlg.setLabelText("Downloading %s\n%0.1f / %s MB  (%0.2f MB/s)" % (names, done * 1e-6, size, rate * 1e-6))
+            if total:
+                dlg.setValue(int(1000 * done / total))
+            pg.QtGui.QApplication.processEvents()
+            if dlg.wasCanceled():
+                raise Exception("User cancelled download.")
+        results = fetch_all(jobs, threads=threads, progress=progress)
+
+    for result in results:
+        rate = result['bytes'] / max(result['seconds'], 1e-6)
+        print("Downloaded %s: %0.1f MB in %0.1f s (%0.2f MB/s)" % (result['url'], result['bytes'] * 1e-6, result['seconds'], rate * 1e-6))
+    return results
@@ -1,12 +1,11 @@
 from ast import literal_eval
-import json
-from collections import OrderedDict
+import sys
 import numpy as np
 import pyqtgraph as pg
-import pyqtgraph.metaarray as metaarray
 from pyqtgraph.Qt import QtGui, QtCore
 
-from aiccf.ui import AtlasDisplayCtrl, LabelTree, AtlasSliceView
+from aiccf.ui import AtlasDisplayCtrl, LabelTree, AtlasSliceView, ProjectionOverview, SectionStackDialog
+from aiccf.slice import parallel_sections, fan_sections, extract_section_stack, section_transforms, section_geometry
 from aiccf import points_to_aff
 
 
@@ -15,9 +14,14 @@ class AtlasViewer(QtGui.QWidget):
     """Class that assembles all of the available UI elements into
     one widget.
     """
+    sig_volumes_loaded = QtCore.Signal()  # load_volumes() finished
+
     def __init__(self, parent=None):
         self.atlas = None
         self.label = None
+        self.mesh_view = None
+        self._mesh_loader = None
+        self._meshes_pending = False
 
         QtGui.QWidget.__init__(self, parent)
         self.layout = QtGui.QGridLayout()
@@ -59,11 +63,22 @@ class AtlasViewer(QtGui.QWidget):
         self.view2.addItem(self.target)
         self.target.setVisible(False)
 
+        # timing overlay in the top left corner of the slice view (see toggle_timing)
+        self.w2.scene().addItem(self.atlas_view.timing_overlay)
+
         self.view1.addItem(self.atlas_view.line_roi, ignoreBounds=True)
         self.view_layout.addWidget(self.atlas_view.zslider, 2, 0)
         self.view_layout.addWidget(self.atlas_view.angle_slider, 3, 0)
         self.view_layout.addWidget(self.atlas_view.lut, 0, 1, 3, 1)
 
+        # projections of the checked structures, shown next to the ortho view
+        # once they have been computed (see show_projections)
+        self.projection_view = ProjectionOverview()
+        self.projection_view.setFixedWidth(200)
+        self.projection_view.setVisible(False)
+        self.view_layout.addWidget(self.projection_view, 0, 2)
+        self.atlas_view.label_tree.labels_changed.connect(self.update_projections)
+
         self.clipboard = QtGui.QApplication.clipboard()
         
         QtGui.QShortcut(QtGui.QKeySequence("Alt+Up"), self, self.slider_up)
@@ -72,6 +87,7 @@ class AtlasViewer(QtGui.QWidget):
         QtGui.QShortcut(QtGui.QKeySequence("Alt+Right"), self, self.tilt_right)
         QtGui.QShortcut(QtGui.QKeySequence("Alt+1"), self, self.move_left)
         QtGui.QShortcut(QtGui.QKeySequence("Alt+2"), self, self.move_right)
+        QtGui.QShortcut(QtGui.QKeySequence("Ctrl+Shift+T"), self, self.toggle_timing)
 
         self.atlas_view.mouseHovered.connect(self.mouseHovered)
         self.atlas_view.mouseClicked.connect(self.mouseClicked)
@@ -96,37 +112,156 @@ class AtlasViewer(QtGui.QWidget):
         self.coordinateCtrl.coordinateSubmitted.connect(self.coordinateSubmitted)
         self.ctrl_layout.addWidget(self.coordinateCtrl)
 
+        self.projection_btn = QtGui.QPushButton('Show projection overview')
+        self.projection_btn.clicked.connect(self.show_projections)
+        self.ctrl_layout.addWidget(self.projection_btn)
+
+        self.stack_btn = QtGui.QPushButton('Extract section stack...')
+        self.stack_btn.clicked.connect(self.extract_section_stack)
+        self.ctrl_layout.addWidget(self.stack_btn)
+
+        self.mesh_btn = QtGui.QPushButton('Show 3D view')
+        self.mesh_btn.clicked.connect(self.renderVolume)
+        self.ctrl_layout.addWidget(self.mesh_btn)
+
     def set_data(self, atlas_data):
         self.atlas_view.set_data(atlas_data)
         self.view1.autoRange(items=[self.img1.atlas_img])
         self.coordinateCtrl.atlas_shape = atlas_data.shape
+        self.coordinateCtrl.vxsize = atlas_data.image._info[-1]['vxsize'] * 1e6
+        # show projections only if they were already computed
+        projections = atlas_data.structure_projections(compute=False)
+        self.projection_view.set_projections(projections)
+        self.projection_view.setVisible(projections is not None)
+        self.update_projections()
+
+    def load_volumes(self):
+        """Read lazily opened atlas volumes into memory in a background
+        thread, then redisplay. Until then, the view keeps reading from the
+        cache files so the window stays usable.
+        """
+        self.statusLabel.setText("Loading atlas volumes...")
+        self._volume_loader = VolumeLoader(self.atlas_view.atlas_data)
+        self._volume_loader.finished.connect(self._volumes_loaded)
+        self._volume_loader.start()
+
+    def _volumes_loaded(self):
+        self.statusLabel.setText("")
+        if self._volume_loader.error is not None:
+            sys.excepthook(*self._volume_loader.error)
+        else:
+            self.atlas_view.atlas_data.load_volumes(self._volume_loader.volumes)
+            self.atlas_view.reload_volumes()
+        self._volume_loader = None
+        self.sig_volumes_loaded.emit()
         
     def mouseHovered(self, id):
         self.statusLabel.setText(self.atlas_view.label_tree.describe(id))
         
+    def show_projections(self):
+        """Compute (or load) per-structure projections and show the checked
+        structures of the label tree projected along each axis.
+        """
+        with pg.ProgressDialog("Computing structure projections...", 0, 1000, wait=0) as dlg:
+            def progress(done, total):
+                dlg.setValue(int(1000 * done / total))
+                QtGui.QApplication.processEvents()
+                if dlg.wasCanceled():
+                    raise Exception("User cancelled structure projections.")
+            projections = self.atlas_view.atlas_data.structure_projections(progress=progress)
+        self.projection_view.set_projections(projections)
+        self.projection_view.setVisible(True)
+        self.update_projections()
+
+    def update_projections(self):
+        if not self.projection_view.isHidden():
+            self.projection_view.update_images(self.atlas_view.label_tree)
+
+    def extract_section_stack(self):
+        """Ask for stack parameters and a file name, then write a stack of
+        sections parallel to (or fanned around) the current slice, with the
+        LIMS transform of each section in a .json file beside it.
+        """
+        section = self.atlas_view.current_section()
+        if section is None:
+            return
+        dlg = SectionStackDialog(self)
+        if dlg.exec_() != QtGui.QDialog.Accepted:
+            return
+        filename = QtGui.QFileDialog.getSaveFileName(self, "Save section stack", "sections.npy",
+                                                     "NumPy array (*.npy);;TIFF stack (*.tif)")
+        if isinstance(filename, tuple):
+            # PyQt5 also returns the selected filter
+            filename = filename[0]
+        if not filename:
+            return
+
+        atlas_data = self.atlas_view.atlas_data
+        shape, origin, vectors = section
+        count = dlg.count.value()
+        if dlg.mode.currentText() == 'fan':
+            angles = (np.arange(count) - (count - 1) / 2.) * dlg.angle.value()
+            origins, vectors = fan_sections(shape, origin, vectors, angles)
+        else:
+            vxsize = atlas_data.image._info[-1]['vxsize'] * 1e6
+            origins, vectors = parallel_sections(shape, origin, vectors, count, dlg.spacing.value() / vxsize)
+
+        with pg.ProgressDialog("Extracting sections...", 0, 1000, wait=0) as progress_dlg:
+            def progress(done, total):
+                progress_dlg.setValue(int(1000 * done / total))
+                QtGui.QApplication.processEvents()
+                if progress_dlg.wasCanceled():
+                    raise Exception("User cancelled section extraction.")
+            extract_section_stack(atlas_data, str(filename), shape, origins, vectors,
+                                  order=int(self.atlas_view.interpolate), labels=dlg.labels.isChecked(),
+                                  progress=progress)
+        self.statusLabel.setText("Wrote %d sections to %s" % (count, filename))
+
     def renderVolume(self):
-        import pyqtgraph.opengl as pgl
-        import scipy.ndimage as ndi
-        self.glView = pgl.GLViewWidget()
-        img = np.ascontiguousarray(self.displayAtlas[::8,::8,::8])
-        
-        # render volume
-        #vol = np.empty(img.shape + (4,), dtype='ubyte')
-        #vol[:] = img[..., None]
-        #vol = np.ascontiguousarray(vol.transpose(1, 2, 0, 3))
-        #vi = pgl.GLVolumeItem(vol)
-        #self.glView.addItem(vi)
-        #vi.translate(-vol.shape[0]/2., -vol.shape[1]/2., -vol.shape[2]/2.)
-        
-        verts, faces = pg.isosurface(ndi.gaussian_filter(img.astype('float32'), (2, 2, 2)), 5.0)
-        md = pgl.MeshData(vertexes=verts, faces=faces)
-        mesh = pgl.GLMeshItem(meshdata=md, smooth=True, color=[0.5, 0.5, 0.5, 0.2], shader='balloon')
-        mesh.setGLOptions('additive')
-        mesh.translate(-img.shape[0]/2., -img.shape[1]/2., -img.shape[2]/2.)
-        self.glView.addItem(mesh)
-
-        self.glView.show()
-     
+        """Show the structures checked in the label tree as surface meshes in
+        a 3D view, which follows further changes to the label tree.
+        """
+        from aiccf.meshview import MeshView
+        if self.mesh_view is None:
+            self.mesh_view = MeshView()
+            self.atlas_view.label_tree.labels_changed.connect(self.update_meshes)
+        self.mesh_view.show()
+        self.update_meshes()
+
+    def update_meshes(self):
+        """Show the structures checked in the label tree in the 3D view.
+        Meshes that are not cached yet are extracted in a background thread,
+        and the view is updated once they are ready.
+        """
+        if self.mesh_view is None or not self.mesh_view.isVisible():
+            return
+        if self._mesh_loader is not None:
+            # extract the new selection once the current one is finished
+            self._meshes_pending = True
+            return
+        ids = self.atlas_view.label_tree.checked_roots()
+        self._mesh_loader = MeshLoader(self.atlas_view.atlas_data, ids)
+        self._mesh_loader.sig_progress.connect(self._mesh_progress)
+        self._mesh_loader.finished.connect(self._meshes_loaded)
+        self._mesh_loader.start()
+
+    def _mesh_progress(self, done, total):
+        self.statusLabel.setText("Extracting structure meshes (%d/%d)..." % (done, total))
+
+    def _meshes_loaded(self):
+        loader = self._mesh_loader
+        self._mesh_loader = None
+        self.statusLabel.setText("")
+        if loader.error is not None:
+            if not loader.canceled:
+                sys.excepthook(*loader.error)
+        elif not self._meshes_pending:
+            tree = self.atlas_view.label_tree
+            self.mesh_view.set_structures(loader.meshes, dict((id, tree.label_color(id)) for id in loader.meshes))
+        if self._meshes_pending:
+            self._meshes_pending = False
+            self.update_meshes()
+
     # mouse_point[0] contains the Point object.
     # mouse_point[1] contains the structure id at Point
     def mouseClicked(self, mouse_point):
@@ -140,96 +275,53 @@ class AtlasViewer(QtGui.QWidget):
     # Returns two strings. One used for display in a label and the other to put in the clipboard
     # PIR orientation where x axis = Anterior-to-Posterior, y axis = Superior-to-Inferior and z axis = Left-to-Right
     def getCcfPoint(self, mouse_point):
-
-        axis = self.displayCtrl.params['Orientation']
+        atlas_data = self.atlas_view.atlas_data
 
         # find real lims id
-        lims_str_id = (key for key, value in self.label._info[-1]['ai_ontology_map'] if value == mouse_point[1]).next()
-        
-        # compute the 4x4 transform matrix
-        a = self.scale_point_to_CCF(self.atlas_view.line_roi.origin)
-        ab = self.scale_vector_to_PIR(self.atlas_view.line_roi.ab_vector)
-        ac = self.scale_vector_to_PIR(self.atlas_view.line_roi.ac_vector)
-        
-        M0, M0i = points_to_aff.points_to_aff(a, np.array(ab), np.array(ac))
+        lims_str_id = atlas_data.to_allen_ids(mouse_point[1])
+
+        # LIMS transform of the displayed slice; stacks written by
+        # extract_section_stack use the same convention (see section_transforms)
+        shape, origin, vectors = self.atlas_view.current_section()
+        ob = section_transforms(atlas_data.ccf_transform(), shape, origin, vectors)[0]
+        M0, M0i = points_to_aff.lims_obj_to_aff(ob)
+
+        # Find what the mouse point position is relative to the slice; the
+        # first image axis is ac and the second ab
+        p = (mouse_point[0].pos().x() / shape[0], mouse_point[0].pos().y() / shape[1])
 
-        # Find what the mouse point position is relative to the coordinate
-        ab_length = np.linalg.norm(self.atlas_view.line_roi.ab_vector)
-        ac_length = np.linalg.norm(self.atlas_view.line_roi.ac_vector)        
-        p = (mouse_point[0].pos().x()/ac_length, mouse_point[0].pos().y()/ab_length)
-        
         ccf_location = np.dot(M0i, [p[1], p[0], 0, 1]) # use the inverse transform matrix and the mouse point
-        
+
         # These should be x, y, z
         p1 = float(ccf_location[0])
         p2 = float(ccf_location[1])
         p3 = float(ccf_location[2])
 
-        if axis == 'right':
-            point = "x: " + str(p1) + " y: " + str(p2) + " z: " + str(p3) + " StructureID: " + str(lims_str_id)
-            clipboard_text = str(p1) + ";" + str(p2) + ";" + str(p3) + ";" + str(lims_str_id)
-        elif axis == 'anterior':
-            point = "x: " + str(p3) + " y: " + str(p2) + " z: " + str(p1) + " StructureID: " + str(lims_str_id)
-            clipboard_text = str(p3) + ";" + str(p2) + ";" + str(p1) + ";" + str(lims_str_id)
-        elif axis == 'dorsal':
-            point = "x: " + str(p2) + " y: " + str(p3) + " z: " + str(p1) + " StructureID: " + str(lims_str_id)
-            clipboard_text = str(p2) + ";" + str(p3) + ";" + str(p1) + ";" + str(lims_str_id)
-        else:
-            point = 'N/A'
-            clipboard_text = 'NULL'
-
-        # Convert matrix transform to a LIMS dictionary
-        ob = points_to_aff.aff_to_lims_obj(M0, M0i)
+        point = "x: " + str(p1) + " y: " + str(p2) + " z: " + str(p3) + " StructureID: " + str(lims_str_id)
+        clipboard_text = str(p1) + ";" + str(p2) + ";" + str(p3) + ";" + str(lims_str_id)
 
         # clipboard_text = "{};{}".format(clipboard_text, roi_params)
         clipboard_text = "{};{}".format(clipboard_text, ob)
 
         return point, clipboard_text
-    
-    def scale_point_to_CCF(self, point):
-        """
-        Returns a tuple (x, y, z) scaled from Item coordinates to CCF coordinates
-        
-        Point is a tuple with values x, y, z (ordered) 
-        """
-        vxsize = self.atlas._info[-1]['vxsize'] * 1e6
-        p_to_ccf = ((self.atlas_view.atlas.shape[1] - point[0]) * vxsize,
-                    (self.atlas_view.atlas.shape[2] - point[1]) * vxsize,
-                    (self.atlas_view.atlas.shape[0] - point[2]) * vxsize)
-        return p_to_ccf
-    
-    def scale_vector_to_PIR(self, vector):
-        """
-        Returns a list representing a vector. The new vector is scaled to CCF coordinate size. Also orients the vector to PIR orientaion.
-        
-        Vector must me specified as a list
-        """
-        p_to_ccf = []
-        for p in vector:
-            p_to_ccf.append(-(p * self.atlas._info[-1]['vxsize'] * 1e6))  # Need to use negative since using PIR orientation
-        return p_to_ccf
 
-    def ccf_point_to_view(self, pos):
+    def ccf_point_to_voxel(self, pos):
         """
-        This function translates a ccf's position to the view's coordinates.
-                
-        The pos is a tuple with values x, y, z
+        Returns the atlas voxel coordinates of a CCF position (x, y, z in um)
         """
-        vxsize = self.atlas._info[-1]['vxsize'] * 1e6
-        return ((self.atlas_view.atlas.shape[1] - (pos[0] / vxsize)) * self.atlas_view.scale[0],
-                (self.atlas_view.atlas.shape[2] - (pos[1] / vxsize)) * self.atlas_view.scale[1],
-                (self.atlas_view.atlas.shape[0] - (pos[2] / vxsize)) * self.atlas_view.scale[1])
+        m = self.atlas_view.atlas_data.ccf_transform()
+        return np.linalg.solve(m, [pos[0] * 1e-6, pos[1] * 1e-6, pos[2] * 1e-6, 1])[:3]
 
-    def vector_to_view(self, vector):
+    def voxel_to_view(self, voxel):
         """
-        Scales vector to view coordinate size. vector is a tuple with x, y, z (in that order)   
+        This function translates atlas voxel coordinates (a position, or a vector) to the view's
+        coordinates: the x and y axes of the ortho image and the depth along the slider axis.
         """
-        vxsize = self.atlas._info[-1]['vxsize'] * 1e6
-        new_point = ((vector[0] / vxsize) * self.atlas_view.scale[0],
-                     (vector[1] / vxsize) * self.atlas_view.scale[1],
-                     (vector[2] / vxsize) * self.atlas_view.scale[1])  
-        return new_point
-      
+        atlas_data = self.atlas_view.atlas_data
+        order = atlas_data.orientation_order(self.atlas_view.display_ctrl.params['Orientation'])
+        vxsize = atlas_data.image._info[-1]['vxsize']
+        return (voxel[order[1]] * vxsize, voxel[order[2]] * vxsize, voxel[order[0]] * vxsize)
+
     # These are here to test. Add to coord_arg to test
     # to_pos = self.st_to_tuple(coord_args[5])
     # to_size = self.st_to_tuple(coord_args[6])
@@ -237,27 +329,23 @@ class AtlasViewer(QtGui.QWidget):
     # to_ac_angle = float(coord_args[8])
     # orientation = coord_args[9]    
     def coordinateSubmitted(self):
-        if self.displayCtrl.params['Orientation'] != "right":
+        if self.atlas_view.display_ctrl.params['Orientation'] != "right":
             displayError('Set Coordinate function is only supported with Right orientation')
             return
         
         coord_args = str(self.coordinateCtrl.line.text()).split(';')
+        if len(coord_args) < 3:
+            return
         
-        vxsize = self.atlas._info[-1]['vxsize'] * 1e6
         x = float(coord_args[0])
         y = float(coord_args[1])
         z = float(coord_args[2])
         
-        if len(coord_args) < 3:
-            return
-        
         if len(coord_args) <= 4:
             # When only 4 points are given, assume point needs to be set using orientation == 'right'
-            translated_x = (self.atlas_view.atlas.shape[1] - (float(coord_args[0])/vxsize)) * self.atlas_view.scale[0] 
-            translated_y = (self.atlas_view.atlas.shape[2] - (float(coord_args[1])/vxsize)) * self.atlas_view.scale[0] 
-            translated_z = (self.atlas_view.atlas.shape[0] - (float(coord_args[2])/vxsize)) * self.atlas_view.scale[0] 
+            translated_x, translated_y, translated_z = self.voxel_to_view(self.ccf_point_to_voxel((x, y, z)))
             roi_origin = (translated_x, 0.0)
-            to_size = (self.atlas_view.atlas.shape[2] * self.atlas_view.scale[1], 0.0) 
+            to_size = (self.atlas_view.atlas_data.shape[1] * self.atlas_view.atlas_data.image._info[-1]['vxsize'], 0.0)
             to_ab_angle = 90
             to_ac_angle = 0
             target_p1 = translated_z 
@@ -265,16 +353,16 @@ class AtlasViewer(QtGui.QWidget):
         else:
             transform = literal_eval(coord_args[4])
 
-            # Use LIMS matrices to get the origin and vectors of the plane
+            # Use LIMS matrices to get the origin and vectors of the plane (see section_geometry)
             M1, M1i = points_to_aff.lims_obj_to_aff(transform)
-            origin, ab_vector, ac_vector = points_to_aff.aff_to_origin_and_vectors(M1i)
-            
-            target_p1, target_p2 = self.get_target_position([x, y, z, 1], M1, ab_vector, ac_vector, vxsize)
+            origins, axes = section_geometry(self.atlas_view.atlas_data.ccf_transform(), [transform])
             
             # Put the origin and vectors back to view coordinates
-            roi_origin = np.array(self.ccf_point_to_view(origin))
-            ab_vector = -np.array(self.vector_to_view(ab_vector))
-            ac_vector = -np.array(self.vector_to_view(ac_vector))
+            roi_origin = np.array(self.voxel_to_view(origins[0]))
+            ac_vector = np.array(self.voxel_to_view(axes[0, 0]))
+            ab_vector = np.array(self.voxel_to_view(axes[0, 1]))
+
+            target_p1, target_p2 = self.get_target_position([x, y, z, 1], M1, ab_vector, ac_vector)
                 
             to_ac_angle = self.atlas_view.line_roi.get_ac_angle(ac_vector)
             
@@ -286,23 +374,28 @@ class AtlasViewer(QtGui.QWidget):
             to_ab_angle = self.atlas_view.line_roi.get_ab_angle(ab_vector)
         
         self.target.setPos(target_p1, target_p2)
+        self.atlas_view.angle_slider.setValue(int(to_ac_angle))
         self.atlas_view.line_roi.setPos(pg.Point(roi_origin[0], roi_origin[1]))
         self.atlas_view.line_roi.setSize(pg.Point(to_size))
         self.atlas_view.line_roi.setAngle(to_ab_angle) 
-        self.atlas_view.slider.setValue(int(to_ac_angle))
         self.target.setVisible(True)  # TODO: keep target visible when coming back to the same slice... how?
        
-    def get_target_position(self, ccf_location, M, ab_vector, ac_vector, vxsize):
+    def get_target_position(self, ccf_location, M, ab_vector, ac_vector):
         """
         Use affine transform matrix M to map ccf coordinate back to original coordinates  
         """
         img_location = np.dot(M, ccf_location)
         
-        p1 = (np.linalg.norm(ac_vector) / vxsize * img_location[1]) * self.atlas_view.scale[0]
-        p2 = (np.linalg.norm(ab_vector) / vxsize * img_location[0]) * self.atlas_view.scale[0]
+        p1 = np.linalg.norm(ac_vector) * img_location[1]
+        p2 = np.linalg.norm(ab_vector) * img_location[0]
         
         return p1, p2
 
+    def toggle_timing(self):
+        """Turn timing instrumentation and its overlay on or off.
+        """
+        self.atlas_view.set_timing(not self.atlas_view.timer.enabled)
+
     def slider_up(self):
         self.atlas_view.slider.triggerAction(QtGui.QAbstractSlider.SliderSingleStepAdd)
         
@@ -330,12 +423,68 @@ class AtlasViewer(QtGui.QWidget):
         self.target.setVisible(False)
     
     def closeEvent(self, ev):
+        if self._mesh_loader is not None:
+            self._mesh_loader.cancel()
+            self._mesh_loader.wait()
+        if self.mesh_view is not None:
+            self.mesh_view.close()
         self.view1.close()
         self.view2.close()
         self.atlas_view.close()
 
     
 
+class VolumeLoader(QtCore.QThread):
+    """Thread that reads atlas volumes into memory (see
+    CCFAtlasData.read_volumes). The result is stored in *volumes*, or any
+    exception (as sys.exc_info()) in *error*.
+    """
+    def __init__(self, atlas_data):
+        QtCore.QThread.__init__(self)
+        self.atlas_data = atlas_data
+        self.volumes = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.volumes = self.atlas_data.read_volumes()
+        except Exception:
+            self.error = sys.exc_info()
+
+
+class MeshLoader(QtCore.QThread):
+    """Thread that extracts (or loads) the surface meshes of *structures*
+    (see CCFAtlasData.structure_meshes). The result is stored in *meshes*, or
+    any exception (as sys.exc_info()) in *error*. *sig_progress(done, total)*
+    is emitted as structures are finished.
+    """
+    sig_progress = QtCore.Signal(object, object)  # done, total
+
+    def __init__(self, atlas_data, structures):
+        QtCore.QThread.__init__(self)
+        self.atlas_data = atlas_data
+        self.structures = structures
+        self.meshes = None
+        self.error = None
+        self.canceled = False
+
+    def cancel(self):
+        """Stop extracting at the next finished structure.
+        """
+        self.canceled = True
+
+    def run(self):
+        try:
+            self.meshes = self.atlas_data.structure_meshes(self.structures, progress=self._progress)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def _progress(self, done, total):
+        self.sig_progress.emit(done, total)
+        if self.canceled:
+            raise Exception("User cancelled mesh extraction.")
+
+
 class CoordinatesCtrl(QtGui.QWidget):
     coordinateSubmitted = QtCore.Signal()
     
@@ -378,7 +527,7 @@ class CoordinatesCtrl(QtGui.QWidget):
     
     def target_within_range(self, x, y, z):
 
-        vxsize = atlas._info[-1]['vxsize'] * 1e6
+        vxsize = self.vxsize
         error = ""
         if z > (self.atlas_shape[2] * vxsize) or z < 0:
             error += "z coordinate {} is not within CCF range".format(z)
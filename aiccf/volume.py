@@ -0,0 +1,179 @@
+"""Array-like views of atlas volumes that may live on disk.
+
+Nothing in this module depends on Qt, so it can be used from worker
+processes and headless scripts.
+"""
+import numpy as np
+
+
+class LazyVolume(object):
+    """Read-only view of a volume that is stored on disk (usually an HDF5
+    dataset), supporting the subset of ndarray behavior used by the viewer.
+
+    Transposing and slicing with only slice objects return a new LazyVolume
+    without reading anything; indexing with an integer, or converting with
+    np.asarray(), reads just the requested region from disk.
+    """
+    def __init__(self, data, order=None, slices=None):
+        self._data = data
+        if order is None:
+            order = tuple(range(data.ndim))
+        if slices is None:
+            slices = tuple((0, n, 1) for n in data.shape)
+        # view axis i corresponds to data axis order[i]; slices are
+        # (start, stop, step) per data axis
+        self._order = tuple(order)
+        self._slices = tuple(slices)
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    @property
+    def ndim(self):
+        return len(self._order)
+
+    @property
+    def shape(self):
+        return tuple(_slice_len(*self._slices[ax]) for ax in self._order)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def transpose(self, *axes):
+        if len(axes) == 1 and not isinstance(axes[0], int):
+            axes = axes[0]
+        if len(axes) == 0:
+            axes = range(self.ndim)[::-1]
+        return LazyVolume(self._data, [self._order[i] for i in axes], self._slices)
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        if Ellipsis in index:
+            i = index.index(Ellipsis)
+            index = index[:i] + (slice(None),) * (self.ndim - len(index) + 1) + index[i+1:]
+        if len(index) > self.ndim:
+            raise IndexError("too many indices for %d-dimensional volume" % self.ndim)
+        index = index + (slice(None),) * (self.ndim - len(index))
+
+        slices = list(self._slices)
+        scalar = []
+        for i, ax in enumerate(self._order):
+            start, stop, step = slices[ax]
+            n = _slice_len(start, stop, step)
+            ind = index[i]
+            if isinstance(ind, slice):
+                a, b, c = ind.indices(n)
+                if c < 1:
+                    raise IndexError("LazyVolume does not support negative steps")
+                slices[ax] = (start + a*step, min(stop, start + max(a, b)*step), step*c)
+            else:
+                ind = int(ind)
+                if ind < 0:
+                    ind += n
+                if ind < 0 or ind >= n:
+                    raise IndexError("index %d is out of bounds for axis %d with size %d" % (index[i], i, n))
+                slices[ax] = (start + ind*step, start + ind*step + 1, 1)
+                scalar.append(ax)
+
+        view = LazyVolume(self._data, [ax for ax in self._order if ax not in scalar], slices)
+        if len(scalar) == 0:
+            return view
+        return view.read(scalar)
+
+    def read(self, squeeze=()):
+        """Read the region covered by this view from disk and return it as an
+        ndarray. Data axes listed in *squeeze* (length 1) are removed.
+        """
+        sel = tuple(slice(*s) for s in self._slices)
+        data = np.asarray(self._data[sel])
+        order = list(self._order)
+        if len(squeeze) > 0:
+            data = data.reshape([data.shape[ax] for ax in range(data.ndim) if ax not in squeeze])
+            remaining = [ax for ax in range(len(self._slices)) if ax not in squeeze]
+            order = [remaining.index(ax) for ax in order]
+        return data.transpose(order)
+
+    def __array__(self, dtype=None):
+        data = self.read()
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def reopen(self):
+        """Return a copy of this view with its own handle on the underlying
+        HDF5 file, for use in another thread or process.
+        """
+        if isinstance(self._data, np.ndarray):
+            return self
+        return LazyVolume(_open_dataset(*_dataset_source(self._data)), self._order, self._slices)
+
+    def __getstate__(self):
+        # HDF5 handles cannot be pickled; store where to reopen them instead
+        state = self.__dict__.copy()
+        if not isinstance(self._data, np.ndarray):
+            state['_data'] = _dataset_source(self._data)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self._data, tuple):
+            self._data = _open_dataset(*self._data)
+
+
+def contiguous_copy(volume, out=None, chunk_size=2**24):
+    """Copy *volume* (an ndarray or LazyVolume, possibly transposed) into a
+    C-contiguous array, *chunk_size* voxels (whole planes along axis 0) at a
+    time. If *out* is not given, a new array is allocated.
+    """
+    if out is None:
+        out = np.empty(volume.shape, dtype=volume.dtype)
+    n = volume.shape[0]
+    step = max(1, chunk_size // max(1, int(np.prod(volume.shape[1:]))))
+    for start in range(0, n, step):
+        stop = min(start + step, n)
+        out[start:stop] = np.asarray(volume[start:stop])
+    return out
+
+
+def gather(volume, index, slab=16):
+    """Return the values of *volume* at an (N,3) array of in-bounds integer
+    voxel *index* values.
+
+    For a LazyVolume, points are grouped by slabs of *slab* planes along
+    axis 0 and only the slabs that contain points are read.
+    """
+    index = np.asarray(index, dtype=int)
+    if isinstance(volume, np.ndarray):
+        return volume[index[:, 0], index[:, 1], index[:, 2]]
+
+    out = np.empty(len(index), dtype=volume.dtype)
+    slab_ids = index[:, 0] // slab
+    order = np.argsort(slab_ids, kind='mergesort')
+    bounds = np.searchsorted(slab_ids[order], np.arange(slab_ids.max() + 2) if len(index) > 0 else [0])
+    for s in range(len(bounds) - 1):
+        sel = order[bounds[s]:bounds[s+1]]
+        if len(sel) == 0:
+            continue
+        data = np.asarray(volume[s*slab:(s+1)*slab])
+        ind = index[sel]
+        out[sel] = data[ind[:, 0] - s*slab, ind[:, 1], ind[:, 2]]
+    return out
+
+
+def _slice_len(start, stop, step):
+    return max(0, (stop - start + step - 1) // step)
+
+
+def _dataset_source(dataset):
+    return (dataset.file.filename, dataset.name)
+
+
+def _open_dataset(filename, name):
+    import h5py
+    return h5py.File(filename, 'r')[name]
@@ -0,0 +1,147 @@
+import os, hashlib, threading
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from aiccf.download import fetch, fetch_all
+
+
+FILES = {
+    '/atlas.nrrd': os.urandom(300000),
+    '/labels.nrrd': os.urandom(200000),
+    '/ontology.json': os.urandom(5000),
+}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    # paths under /norange are served without Range support
+    requests = []
+
+    def do_GET(self):
+        ranges = not self.path.startswith('/norange')
+        path = self.path[len('/norange'):] if not ranges else self.path
+        data = FILES.get(path)
+        if data is None:
+            self.send_error(404)
+            return
+        range_header = self.headers.get('Range')
+        Handler.requests.append((self.path, range_header))
+
+        if ranges and range_header is not None:
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(data))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+            body = data[start:]
+        else:
+            self.send_response(200)
+            body = data
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d' % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def write_partial(dest, data):
+    with open(dest + '.partial', 'wb') as fh:
+        fh.write(data)
+
+
+def read(filename):
+    with open(filename, 'rb') as fh:
+        return fh.read()
+
+
+def test_fetch(server, tmpdir):
+    dest = str(tmpdir.join('atlas.nrrd'))
+    data = FILES['/atlas.nrrd']
+    result = fetch(server + '/atlas.nrrd', dest, chunk_size=65536)
+    assert read(dest) == data
+    assert not os.path.exists(dest + '.partial')
+    assert result['size'] == len(data) and result['bytes'] == len(data) and result['resumed_from'] == 0
+
+
+def test_fetch_resumes_with_range(server, tmpdir):
+    # the server answers 206 with the rest of the file
+    dest = str(tmpdir.join('atlas.nrrd'))
+    data = FILES['/atlas.nrrd']
+    write_partial(dest, data[:100000])
+    del Handler.requests[:]
+    calls = []
+    result = fetch(server + '/atlas.nrrd', dest, chunk_size=65536, progress=lambda done, total: calls.append((done, total)))
+    assert Handler.requests == [('/atlas.nrrd', 'bytes=100000-')]
+    assert read(dest) == data
+    assert result['resumed_from'] == 100000 and result['bytes'] == len(data) - 100000
+    assert calls[0] == (100000, len(data)) and calls[-1] == (len(data), len(data))
+
+
+def test_fetch_restarts_without_range(server, tmpdir):
+    # the server ignores the Range header and answers 200 with the whole file
+    dest = str(tmpdir.join('atlas.nrrd'))
+    data = FILES['/atlas.nrrd']
+    write_partial(dest, b'x' * 100000)
+    result = fetch(server + '/norange/atlas.nrrd', dest, chunk_size=65536)
+    assert read(dest) == data
+    assert result['resumed_from'] == 0 and result['bytes'] == len(data)
+
+
+def test_fetch_complete_partial(server, tmpdir):
+    # the partial file is already complete; the server answers 416
+    dest = str(tmpdir.join('labels.nrrd'))
+    data = FILES['/labels.nrrd']
+    write_partial(dest, data)
+    result = fetch(server + '/labels.nrrd', dest, checksum=('md5', hashlib.md5(data).hexdigest()))
+    assert read(dest) == data
+    assert not os.path.exists(dest + '.partial')
+    assert result['bytes'] == 0 and result['size'] == len(data)
+
+
+def test_fetch_checksum_mismatch(server, tmpdir):
+    dest = str(tmpdir.join('ontology.json'))
+    with pytest.raises(IOError):
+        fetch(server + '/ontology.json', dest, checksum=('md5', '0' * 32))
+    assert not os.path.exists(dest) and not os.path.exists(dest + '.partial')
+
+
+def test_fetch_all(server, tmpdir):
+    names = ['atlas.nrrd', 'labels.nrrd', 'ontology.json']
+    jobs = [{'url': server + '/' + name, 'dest': str(tmpdir.join(name)), 'chunk_size': 4096} for name in names]
+    # one download resumes from a partial file
+    write_partial(jobs[0]['dest'], FILES['/atlas.nrrd'][:1000])
+    calls = []
+    results = fetch_all(jobs, threads=2, progress=lambda done, total, rate: calls.append((done, total)),
+                        interval=0.001)
+    for name, job, result in zip(names, jobs, results):
+        assert result['dest'] == job['dest']
+        assert read(job['dest']) == FILES['/' + name]
+    assert results[0]['resumed_from'] == 1000
+    total = sum(len(data) for data in FILES.values())
+    assert calls[-1] == (total, total)
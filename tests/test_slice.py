@@ -0,0 +1,48 @@
+import numpy as np
+
+from aiccf.slice import section_transforms, section_geometry
+from aiccf import points_to_aff
+
+
+def ccf_transform(shape, vxsize):
+    # same as CCFAtlasData.ccf_transform for an atlas of *shape*
+    m = np.eye(4)
+    m[0, 0] = -vxsize
+    m[0, 3] = (shape[0] - 1) * vxsize
+    m[1, 1] = -vxsize
+    m[1, 3] = (shape[1] - 1) * vxsize
+    m[2, 2] = vxsize
+    return m
+
+
+def test_section_transforms_round_trip():
+    rng = np.random.RandomState(0)
+    ccf = ccf_transform((264, 160, 228), 50e-6)
+    shape = (40, 70)
+    origins = rng.uniform(0, 150, size=(5, 3))
+    vectors = rng.normal(size=(5, 2, 3))
+    vectors /= np.linalg.norm(vectors, axis=2)[..., None]
+
+    transforms = section_transforms(ccf, shape, origins, vectors)
+    out_origins, axes = section_geometry(ccf, transforms)
+    assert np.allclose(out_origins, origins)
+    assert np.allclose(axes, vectors * np.array(shape)[None, :, None])
+
+
+def test_section_transforms_match_ccf_transform():
+    # a pixel (i, j) of a section maps to the same CCF point (um) through its
+    # LIMS transform (as in the viewer) and through the atlas voxel it samples
+    ccf = ccf_transform((264, 160, 228), 50e-6)
+    shape = (30, 20)
+    origin = np.array([100., 40., 12.])
+    vectors = np.array([[0.6, 0., 0.8], [0., -1., 0.]])
+    ob = section_transforms(ccf, shape, origin, vectors)[0]
+    M, Mi = points_to_aff.lims_obj_to_aff(ob)
+
+    for i, j in [(0, 0), (7, 11), (29, 19)]:
+        voxel = origin + i * vectors[0] + j * vectors[1]
+        expected = np.dot(ccf, list(voxel) + [1])[:3] * 1e6
+        point = np.dot(Mi, [j / float(shape[1]), i / float(shape[0]), 0, 1])
+        assert np.allclose(point, expected)
+        # and back to section coordinates
+        assert np.allclose(np.dot(M, list(expected) + [1])[:2], [j / float(shape[1]), i / float(shape[0])])
@@ -1,23 +1,78 @@
-import sys, os, traceback
+import sys, os, time, traceback
 sys.path.append(os.path.join(os.path.dirname(__file__)))
-import pyqtgraph as pg
 
-from aiccf.data import CCFAtlasData
-from aiccf.viewer import AtlasViewer
+
+class StartupProfile(object):
+    """Records how long each phase of startup takes (enabled with
+    --profile-startup).
+    """
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.start = self.last = time.time()
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        if not self.enabled:
+            return
+        print("Startup profile:")
+        for phase, dt in self.phases:
+            print("    %-28s %8.3f s" % (phase, dt))
+        print("    %-28s %8.3f s" % ('total', self.last - self.start))
 
 
 if __name__ == '__main__':
+    # --lazy: keep atlas volumes on disk and read only the regions being viewed
+    lazy = '--lazy' in sys.argv[1:]
+    # --profile-startup: print the time taken by each phase of startup
+    profile = StartupProfile('--profile-startup' in sys.argv[1:])
+    # --timing: show hot-path timing statistics (toggle with Ctrl+Shift+T)
+    # --trace=FILE: also write all timing records to FILE as a Chrome trace on exit
+    trace = [arg.split('=', 1)[1] for arg in sys.argv[1:] if arg.startswith('--trace=')]
+    timing = '--timing' in sys.argv[1:] or len(trace) > 0
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    resolution = int(args[0]) if len(args) == 1 else None
 
-    app = pg.mkQApp()
+    # heavy modules are imported only now so that their cost shows up in the profile
+    import pyqtgraph as pg
+    profile.mark('import pyqtgraph')
+    from aiccf.data import CCFAtlasData
+    profile.mark('import aiccf.data')
+    from aiccf.viewer import AtlasViewer
+    profile.mark('import aiccf.viewer')
 
+    app = pg.mkQApp()
     v = AtlasViewer()
     v.setWindowTitle('CCF Viewer')
+    v.atlas_view.set_timing(timing)
     v.show()
+    profile.mark('create window')
+    app.processEvents()
+    profile.mark('show window')
 
-    resolution = int(sys.argv[1]) if len(sys.argv) == 2 else None
-    atlas_data = CCFAtlasData(resolution=resolution)
-    
+    # Open the cache files without reading the volumes so that the first
+    # image appears quickly; unless --lazy was given, the volumes are then
+    # read into memory in the background.
+    atlas_data = CCFAtlasData(resolution=resolution, lazy=True)
+    profile.mark('open atlas cache')
     v.set_data(atlas_data)
+    app.processEvents()
+    profile.mark('first image')
+
+    if lazy:
+        profile.report()
+    else:
+        def volumes_loaded():
+            profile.mark('load volumes (background)')
+            profile.report()
+        v.sig_volumes_loaded.connect(volumes_loaded)
+        v.load_volumes()
 
     if sys.flags.interactive == 0:
         app.exec_()
+        if len(trace) > 0:
+            v.atlas_view.timer.write_chrome_trace(trace[0])